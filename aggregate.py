@@ -0,0 +1,249 @@
+import argparse
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from compiler import Program
+from outofcore import DEFAULT_CHUNK_ROWS, as_program, column_rows, slices, release, csv_chunks, peak_rss_mb
+from vectorized import run_program, scratch_buffers, evaluate_columns
+
+
+# -------------------------------
+# Mergeable aggregate state
+# -------------------------------
+
+class Aggregate:
+    """
+    Running count, sum, min, max and (optionally) histogram of a stream of values,
+    in O(1) memory. The sum is compensated: each chunk is summed pairwise with the
+    rounding error of every addition kept (see _chunk_sum), and the chunk sums are
+    accumulated with Neumaier's variant of Kahan summation, so the error does not grow
+    with the number of chunks. Two states over disjoint parts of a dataset merge() into
+    the state of the whole, in any order.
+    """
+
+    def __init__(self, edges: Optional[Sequence[float]] = None):
+        self.count = 0
+        self.total = 0.0
+        self.compensation = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.edges = None if edges is None else np.asarray(edges, dtype=float)
+        # values outside [edges[0], edges[-1]] are counted in `outside`, not in a bin
+        self.histogram = None if edges is None else np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.outside = 0
+
+    def _add(self, value: float):
+        total = self.total + value
+        if not math.isfinite(total):
+            # inf - inf in the error term would turn an infinite sum into nan
+            self.total = total
+            return
+        if abs(self.total) >= abs(value):
+            self.compensation += (self.total - total) + value
+        else:
+            self.compensation += (value - total) + self.total
+        self.total = total
+
+    def update(self, values: np.ndarray) -> 'Aggregate':
+        """Fold one chunk of values into the state."""
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        total, error = _chunk_sum(values)
+        self._add(total)
+        self._add(error)
+        # min()/max() rather than np.minimum: a nan anywhere makes both nan, like np.min over everything
+        self.minimum = min(self.minimum, float(np.min(values)), key=_nan_first)
+        self.maximum = max(self.maximum, float(np.max(values)), key=_nan_last)
+        if self.histogram is not None:
+            counts, _ = np.histogram(values, self.edges)
+            self.histogram += counts
+            self.outside += len(values) - int(counts.sum())
+        return self
+
+    def merge(self, other: 'Aggregate') -> 'Aggregate':
+        """The state of both inputs together; neither input changes."""
+        if (self.edges is None) != (other.edges is None) or \
+                (self.edges is not None and not np.array_equal(self.edges, other.edges)):
+            raise ValueError("Cannot merge aggregates with different histogram edges")
+        merged = Aggregate(self.edges)
+        merged.count = self.count + other.count
+        merged.total, merged.compensation = self.total, self.compensation
+        merged._add(other.total)
+        merged._add(other.compensation)
+        merged.minimum = min(self.minimum, other.minimum, key=_nan_first)
+        merged.maximum = max(self.maximum, other.maximum, key=_nan_last)
+        if merged.histogram is not None:
+            merged.histogram = self.histogram + other.histogram
+            merged.outside = self.outside + other.outside
+        return merged
+
+    @property
+    def sum(self) -> float:
+        return self.total + self.compensation
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def to_dict(self) -> dict:
+        result = {'count': self.count, 'sum': self.sum, 'mean': self.mean,
+                  'min': self.minimum if self.count else math.nan, 'max': self.maximum if self.count else math.nan}
+        if self.histogram is not None:
+            result['edges'] = self.edges.tolist()
+            result['histogram'] = self.histogram.tolist()
+            result['outside'] = self.outside
+        return result
+
+
+def _chunk_sum(values: np.ndarray) -> Tuple[float, float]:
+    """
+    Pairwise sum of one chunk and the sum of the rounding errors of its additions,
+    as whole-array steps: every level adds the two halves and keeps Knuth's TwoSum
+    error of each addition. total + error is as accurate as twice the precision.
+    """
+    values = np.asarray(values, dtype=float)
+    error = 0.0
+    with np.errstate(invalid='ignore'):
+        while len(values) > 1:
+            half = len(values) // 2
+            a, b = values[:half], values[half:2 * half]
+            total = a + b
+            b_virtual = total - a
+            error += float(np.sum((a - (total - b_virtual)) + (b - b_virtual)))
+            values = np.append(total, values[2 * half:]) if len(values) % 2 else total
+    total = float(values[0])
+    # with inf or nan in the chunk the error terms are nan; the plain sum is the answer
+    return (total, error) if math.isfinite(total) else (total, 0.0)
+
+
+# nan sorts below everything for min() and above everything for max(), so it wins both
+def _nan_first(value: float) -> Tuple[bool, float]:
+    return (not math.isnan(value), value)
+
+
+def _nan_last(value: float) -> Tuple[bool, float]:
+    return (math.isnan(value), value)
+
+
+# -------------------------------
+# Streaming aggregation
+# -------------------------------
+# Every chunk is evaluated into the same scratch output and folded into the state right
+# away; no result column is ever built.
+
+def aggregate_chunks(program: Program, chunks: Iterator[Tuple[int, Dict[str, np.ndarray]]],
+                     edges: Optional[Sequence[float]] = None, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Aggregate:
+    state = Aggregate(edges)
+    buffers = scratch_buffers(program, chunk_rows)
+    out = np.empty(chunk_rows)
+    for _, columns in chunks:
+        rows = len(next(iter(columns.values()))) if columns else 1
+        state.update(run_program(program, columns, out[:rows], buffers))
+    return state
+
+
+def aggregate(expr, columns: Dict[str, np.ndarray], edges: Optional[Sequence[float]] = None,
+              chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Aggregate:
+    """Aggregate an expression over arrays or memory maps of equal length."""
+    program = as_program(expr)
+    columns = {name: columns[name] for name in program.variables}
+    rows = column_rows(columns)
+    return aggregate_chunks(program, slices(columns, rows, chunk_rows), edges, chunk_rows)
+
+
+def aggregate_npy(expr, inputs: Dict[str, str], edges: Optional[Sequence[float]] = None, start: int = 0,
+                  stop: Optional[int] = None, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Aggregate:
+    """
+    Aggregate over rows [start, stop) of memory-mapped .npy files, one per variable.
+    Pages are released after every chunk, so the resident set stays at a few chunks.
+    Workers that each take a row range return states that merge into the total.
+    """
+    program = as_program(expr)
+    columns = {name: np.load(inputs[name], mmap_mode='r') for name in program.variables}
+    rows = column_rows(columns)
+    stop = rows if stop is None else min(stop, rows)
+
+    def chunks():
+        for offset, chunk in slices({name: column[start:stop] for name, column in columns.items()},
+                                    stop - start, chunk_rows):
+            yield offset, chunk
+            for column in columns.values():
+                release(column, start + offset, min(start + offset + chunk_rows, stop))
+
+    return aggregate_chunks(program, chunks(), edges, chunk_rows)
+
+
+def aggregate_csv(expr, csv_path: str, edges: Optional[Sequence[float]] = None,
+                  chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Aggregate:
+    """Aggregate over a csv file with a header row; variables are looked up by column name."""
+    program = as_program(expr)
+    return aggregate_chunks(program, csv_chunks(csv_path, program.variables, chunk_rows), edges, chunk_rows)
+
+
+# -------------------------------
+# Benchmark: peak RSS and throughput, streaming vs. evaluate-then-aggregate
+# -------------------------------
+
+BENCH_EXPRESSION = '(x * 1.5 + y ^ 2) @ (x $ z) - ~y % 7'
+BENCH_EDGES = np.linspace(-10, 110, 25)
+
+
+def _bench(mode: str, directory: str, workers: int):
+    inputs = {name: os.path.join(directory, name + '.npy') for name in 'xyz'}
+    start = time.perf_counter()
+    if mode == 'streaming':
+        state = aggregate_npy(BENCH_EXPRESSION, inputs, BENCH_EDGES)
+    elif mode == 'parallel':
+        rows = len(np.load(inputs['x'], mmap_mode='r'))
+        step = -(-rows // workers)
+        with ProcessPoolExecutor(workers) as executor:
+            parts = executor.map(aggregate_npy, [BENCH_EXPRESSION] * workers, [inputs] * workers,
+                                 [BENCH_EDGES] * workers, range(0, rows, step), range(step, rows + step, step))
+            state = Aggregate(BENCH_EDGES)
+            for part in parts:
+                state = state.merge(part)
+    else:
+        values = evaluate_columns(BENCH_EXPRESSION, {name: np.load(path) for name, path in inputs.items()})
+        state = Aggregate(BENCH_EDGES)
+        state.count, state.total = len(values), float(np.sum(values))
+        state.minimum, state.maximum = float(np.min(values)), float(np.max(values))
+        state.histogram = np.histogram(values, BENCH_EDGES)[0]
+    elapsed = time.perf_counter() - start
+    print(f'{mode:<11} {state.count / elapsed / 1e6:8.2f}M rows/s  peak RSS {peak_rss_mb():8.1f}MB  '
+          f'sum {state.sum:.17g}  min {state.minimum:.6g}  max {state.maximum:.6g}')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Streaming aggregation benchmark')
+    arg_parser.add_argument('--rows', type=int, default=20_000_000)
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    arg_parser.add_argument('--mode', choices=['streaming', 'parallel', 'materialize'])
+    arg_parser.add_argument('--dir')
+    args = arg_parser.parse_args()
+    if args.mode:
+        _bench(args.mode, args.dir, args.workers)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            rng = np.random.default_rng(0)
+            for name in 'xyz':
+                column = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                                   dtype=np.float64, shape=(args.rows,))
+                for start in range(0, args.rows, DEFAULT_CHUNK_ROWS):
+                    stop = min(start + DEFAULT_CHUNK_ROWS, args.rows)
+                    column[start:stop] = rng.uniform(1, 10, stop - start)
+                column.flush()
+                del column
+            print(f'{args.rows} rows, {BENCH_EXPRESSION}, {args.workers} parallel workers')
+            # separate processes, so each peak RSS belongs to one mode only
+            for mode in ('streaming', 'parallel', 'materialize'):
+                subprocess.run([sys.executable, __file__, '--mode', mode, '--dir', directory,
+                                '--workers', str(args.workers)], check=True)
@@ -0,0 +1,346 @@
+import argparse
+import math
+import random
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode, \
+    WindowNode, Factorial, Modulo, Power, Divide, OPERATORS, \
+    parse_tokens_checked, tokenize
+
+
+# -------------------------------
+# Status codes
+# -------------------------------
+# What Calculator.evaluate would have raised for a line, as a small integer.
+
+OK = 0
+SYNTAX_ERROR = 1      # Exception from the parser, or tokens left over after the expression
+UNBOUND_VARIABLE = 2  # NameError
+DIVISION_BY_ZERO = 3  # TypeError from /, ZeroDivisionError from % and ^
+DOMAIN_ERROR = 4      # ValueError: factorial of a negative number
+OVERFLOW = 5          # OverflowError from ^ and !
+TYPE_ERROR = 6        # TypeError: a complex operand of an operator that orders its operands
+NOT_REAL = 7          # nothing raised, but the result is complex and has no float64 value
+TOO_DEEP = 8          # RecursionError: nested deeper than the parser or the tree walk can go
+
+STATUS_NAMES = ('ok', 'syntax error', 'unbound variable', 'division by zero', 'domain error', 'overflow',
+                'type error', 'not real', 'too deep')
+
+
+class _Failure:
+    __slots__ = ('status', 'message')
+
+    def __init__(self, status: int, message: str):
+        self.status = status
+        self.message = message
+
+
+# -------------------------------
+# Operators with their failures as values
+# -------------------------------
+# One function per operator that can fail: it returns the operator's value, or a _Failure
+# where Operator.evaluate would raise. The others run their Operator.evaluate as is.
+
+# the largest argument of math.gamma with a finite result, found once by bisection
+def _gamma_limit() -> float:
+    low, high = 170.0, 172.0
+    while math.nextafter(low, high) < high:
+        middle = (low + high) / 2
+        try:
+            math.gamma(middle)
+            low = middle
+        except OverflowError:
+            high = middle
+    return low
+
+
+_GAMMA_LIMIT = _gamma_limit()
+
+
+def _ordered(op) -> Callable:
+    # comparisons, @, & and %: Python refuses to order complex numbers
+    def safe(x, y):
+        if type(x) is complex or type(y) is complex:
+            return _Failure(TYPE_ERROR, f"'{op.symbol}' is not defined for complex numbers")
+        return op.evaluate(x, y)
+    return safe
+
+
+def _factorial(x):
+    if type(x) is complex:
+        return _Failure(TYPE_ERROR, "'!' is not defined for complex numbers")
+    if x < 0:
+        return _Failure(DOMAIN_ERROR, "Factorial is only defined for non-negative numbers.")
+    if _GAMMA_LIMIT < x + 1 < math.inf:
+        return _Failure(OVERFLOW, "math range error")
+    return math.gamma(x + 1)
+
+
+def _divide(x, y):
+    if y == 0:
+        return _Failure(DIVISION_BY_ZERO, "Division is only defined for non-zero numbers.")
+    return x / y
+
+
+def _modulo(x, y):
+    if type(x) is complex or type(y) is complex:
+        return _Failure(TYPE_ERROR, "'%' is not defined for complex numbers")
+    if y == 0:
+        return _Failure(DIVISION_BY_ZERO, "Modulo by zero")
+    return x % y
+
+
+def _power(x, y):
+    # 0.0 ** -inf is inf, like in Calculator
+    if x == 0 and type(x) is float and type(y) is not complex and y < 0 and y != -math.inf:
+        return _Failure(DIVISION_BY_ZERO, "0.0 cannot be raised to a negative power")
+    # overflow, and 0 to a complex power, cost too much to rule out up front; both are
+    # rare, and neither leaves this frame
+    try:
+        return x ** y
+    except OverflowError:
+        return _Failure(OVERFLOW, "Numerical result out of range")
+    except ZeroDivisionError as e:
+        return _Failure(DIVISION_BY_ZERO, str(e))
+
+
+_SAFE: Dict[type, Callable] = {
+    Factorial: _factorial, Divide: _divide, Modulo: _modulo, Power: _power,
+    **{type(OPERATORS[symbol]): _ordered(OPERATORS[symbol]) for symbol in ('@', '&', '<', '>', '<=', '>=')},
+}
+# the function to call for every registered operator, looked up by the operator itself
+_SAFE_BY_OP: Dict[object, Callable] = {op: _SAFE.get(type(op), op.evaluate) for op in OPERATORS.values()}
+
+
+def _safe(op) -> Callable:
+    return _SAFE.get(type(op), op.evaluate)
+
+
+# -------------------------------
+# Evaluation without exceptions
+# -------------------------------
+
+def _value(node: Node, variables: dict, failed: list):
+    """The node's value, or failed[:] = [node, _Failure] and None."""
+    kind = type(node)
+    if kind is NumberNode:
+        return node.value
+    if kind is VariableNode:
+        value = variables.get(node.name)
+        if value is None:
+            failed[:] = [node, _Failure(UNBOUND_VARIABLE, f"Unbound variable: {node.name}")]
+        return value
+    if kind is UnaryOpNode:
+        child = _value(node.child, variables, failed)
+        if child is None:
+            return None
+        result = (_SAFE_BY_OP.get(node.op) or _safe(node.op))(child)
+    elif kind is LogicalOpNode:
+        left = _value(node.left, variables, failed)
+        if left is None:
+            return None
+        decided = node.op.decided_by(left)
+        if decided is not None:
+            return decided
+        right = _value(node.right, variables, failed)
+        if right is None:
+            return None
+        result = node.op.evaluate(left, right)
+    elif kind is BinaryOpNode:
+        left = _value(node.left, variables, failed)
+        if left is None:
+            return None
+        right = _value(node.right, variables, failed)
+        if right is None:
+            return None
+        result = (_SAFE_BY_OP.get(node.op) or _safe(node.op))(left, right)
+    elif kind is WindowNode:
+        # every line is a series of one sample, as in Calculator.evaluate
+        return _value(node.child, variables, failed)
+    else:
+        raise TypeError(f"Cannot evaluate node of type {kind.__name__} in bulk")
+    if type(result) is _Failure:
+        failed[:] = [node, result]
+        return None
+    return result
+
+
+def _position(line: str, tokens: List[str], token: int) -> int:
+    # tokenize() drops the spaces, so the token starts after this many other characters;
+    # only failures need it, so it is worked out only then
+    before = sum(len(text) for text in tokens[:token])
+    characters = [at for at, character in enumerate(line) if character != ' ']
+    return characters[before] if before < len(characters) else len(line)
+
+
+def _children(node: Node) -> List[Node]:
+    if isinstance(node, (UnaryOpNode, WindowNode)):
+        return [node.child]
+    if isinstance(node, BinaryOpNode):
+        return [node.left, node.right]
+    if isinstance(node, NaryOpNode):
+        return node.children
+    return []
+
+
+def _deepest(node: Node, origins: dict) -> int:
+    # the token of the deepest node, found without recursion: where the tree walk ran out
+    deepest, at = -1, 0
+    pending = [(node, 0)]
+    while pending:
+        current, depth = pending.pop()
+        if depth > deepest and current in origins:
+            deepest, at = depth, origins[current]
+        pending.extend((child, depth + 1) for child in _children(current))
+    return at
+
+
+def _nesting(tokens: List[str]) -> int:
+    # the token where open parentheses plus a run of prefix operators are deepest: where the parser ran out
+    depth = prefix = deepest = at = 0
+    for index, token in enumerate(tokens):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        op = OPERATORS.get(token)
+        prefix = prefix + 1 if op is not None and op.arity == 1 and token != '!' else 0
+        if depth + prefix > deepest:
+            deepest, at = depth + prefix, index
+    return at
+
+
+def check(line: str, variables: Optional[Dict[str, float]] = None) -> Tuple[int, int, Optional[str], object]:
+    """
+    (status, position, message, value) of one expression, where Calculator.evaluate would
+    return or raise. position is the character offset of the token at fault (the operator
+    that failed, the unbound name, the token the parser stopped at), -1 when status is OK.
+    Unlike Calculator.evaluate, tokens left over after the expression are a syntax error.
+    A complex value comes back as is; evaluate_lines() reports it as NOT_REAL.
+    """
+    tokens = tokenize(line)
+    origins = {}
+    try:
+        node, stop, message = parse_tokens_checked(tokens, OPERATORS, 0, origins)
+    except RecursionError:
+        return TOO_DEEP, _position(line, tokens, _nesting(tokens)), 'Expression is nested too deeply', None
+    if node is None:
+        return SYNTAX_ERROR, _position(line, tokens, stop), message, None
+    if stop < len(tokens):
+        return SYNTAX_ERROR, _position(line, tokens, stop), f'Unexpected token: {tokens[stop]}', None
+    failed = []
+    try:
+        value = _value(node, variables or {}, failed)
+    except RecursionError:
+        return TOO_DEEP, _position(line, tokens, _deepest(node, origins)), 'Expression is nested too deeply', None
+    if failed:
+        at, failure = failed
+        return failure.status, _position(line, tokens, origins[at]), failure.message, None
+    return OK, -1, None, value
+
+
+class BulkResult:
+    """
+    The outcome of every line as parallel arrays: `values` (nan unless the status is OK),
+    `status` codes, and where a line failed the character `position` in it (-1 otherwise)
+    and a message.
+    """
+
+    def __init__(self, count: int):
+        self.values = np.full(count, np.nan)
+        self.status = np.zeros(count, np.uint8)
+        self.position = np.full(count, -1, np.int64)
+        self.messages: List[Optional[str]] = [None] * count
+
+    def __len__(self) -> int:
+        return len(self.status)
+
+    @property
+    def ok(self) -> np.ndarray:
+        return self.status == OK
+
+    def outcome(self, line: int) -> Tuple[int, int, Optional[str]]:
+        return int(self.status[line]), int(self.position[line]), self.messages[line]
+
+    def errors(self) -> Iterator[Tuple[int, int, int, str]]:
+        """(line, status, position, message) of every line that did not evaluate."""
+        for line in np.flatnonzero(self.status != OK):
+            yield (int(line),) + self.outcome(line)
+
+
+def evaluate_lines(lines: Iterable[str], variables: Optional[Dict[str, float]] = None) -> BulkResult:
+    """
+    Evaluate one expression per line, like Calculator.evaluate, into a BulkResult.
+    Invalid lines get a status code instead of an exception, so a batch full of them costs
+    about what a valid one does. Variables are taken as floats, like the vectorized engines.
+    """
+    lines = list(lines)
+    variables = {name: float(value) for name, value in (variables or {}).items()}
+    result = BulkResult(len(lines))
+    values, status, position, messages = result.values, result.status, result.position, result.messages
+    for index, line in enumerate(lines):
+        code, at, message, value = check(line, variables)
+        if code == OK and type(value) is complex:
+            code, message = NOT_REAL, f"Complex result: {value!r}"
+        if code == OK:
+            values[index] = value
+        else:
+            status[index], position[index], messages[index] = code, at, message
+    return result
+
+
+# -------------------------------
+# Benchmark: lines/second at 0%, 10% and 50% invalid lines, against
+# Calculator.evaluate with try/except around every line
+# -------------------------------
+
+_VALID = ['(x * {k} + {m}) @ y ^ 2 - {m}! / (x + {k})', '{k} $ x - ~y * ({m} + x) % 7',
+          'x < {k} && y >= {m} || x == y', '({k} - x) ^ 2 + (y - {m}) ^ 2']
+_INVALID = ['(x * {k} + {m} @ y ^ 2', 'x + {k} * # {m}', '{k} * (y - y / ({m} - {m}))', '(x - {k} - 100)! + y',
+            'x * {k} + z', '{k} % (x - x) + {m}', '{k} * * y']
+
+
+def _lines(count: int, invalid: float, rng: random.Random) -> List[str]:
+    lines = []
+    for _ in range(count):
+        templates = _INVALID if rng.random() < invalid else _VALID
+        lines.append(rng.choice(templates).format(k=rng.randrange(1, 50), m=rng.randrange(1, 6)))
+    return lines
+
+
+def _with_exceptions(lines: List[str], variables: Dict[str, float]) -> List[Tuple[object, Optional[str]]]:
+    calculator = Calculator()
+    outcomes = []
+    for line in lines:
+        try:
+            outcomes.append((calculator.evaluate(line, **variables), None))
+        except Exception as e:
+            outcomes.append((None, type(e).__name__))
+    return outcomes
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Exception-free bulk evaluation benchmark')
+    arg_parser.add_argument('--lines', type=int, default=50_000)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    variables = {'x': 1.5, 'y': 2.5}
+
+    def best(run) -> float:
+        seconds = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    for invalid in (0.0, 0.1, 0.5):
+        lines = _lines(args.lines, invalid, random.Random(0))
+        raising = best(lambda: _with_exceptions(lines, variables))
+        bulk = best(lambda: evaluate_lines(lines, variables))
+        failures = int((~evaluate_lines(lines, variables).ok).sum())
+        print(f'{invalid:4.0%} invalid: try/except {args.lines / raising:8.0f} lines/s, '
+              f'bulk {args.lines / bulk:8.0f} lines/s ({raising / bulk:.2f}x), {failures} failures with positions')
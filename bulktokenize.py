@@ -0,0 +1,264 @@
+import argparse
+import mmap
+import os
+import re
+import tempfile
+import time
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from chatv3 import SIGN_PREFIX_TOKENS, TWO_CHAR_TOKENS, tokenize, iter_token_spans
+
+# bytes per scan; blocks end on a line boundary
+BLOCK_SIZE = 1 << 18
+
+# blocks with these bytes take the per-line path: non-ASCII text needs str.isalpha and
+# friends, NUL is the separator of the fast path
+_UNUSUAL = re.compile(rb'[\x80-\xff\x00]')
+_SIGN_PREFIX = np.array(sorted(token.encode()[0] for token in SIGN_PREFIX_TOKENS if len(token) == 1), np.uint8)
+_PAIRS = [tuple(token.encode()) for token in TWO_CHAR_TOKENS]
+_SPACE, _NEWLINE, _BANG, _MINUS, _DOT, _EQUALS = 32, 10, 33, 45, 46, 61
+
+
+def _blocks(buffer, size: int, block_size: int) -> Iterator[Tuple[int, int]]:
+    position = 0
+    while position < size:
+        end = min(position + block_size, size)
+        if end < size:
+            cut = buffer.rfind(b'\n', position, end)
+            if cut < 0:
+                # a line longer than the block: take all of it
+                cut = buffer.find(b'\n', end)
+            end = size if cut < 0 else cut + 1
+        yield position, end
+        position = end
+
+
+def _open(path: str):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None, 0
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), size
+
+
+def _lines_of(buffer, start: int, end: int) -> List[bytes]:
+    lines = buffer[start:end].split(b'\n')
+    return lines[:-1] if buffer[end - 1] == _NEWLINE else lines
+
+
+# -------------------------------
+# Vectorized scan of an ASCII block
+# -------------------------------
+# tokenize() drops every space and then decides token by token. The same decisions
+# as whole-array operations on the bytes without spaces:
+#   names    a letter or '_' starts one, digits right after it continue it
+#   numbers  runs of digits and dots outside names; a run splits only in its leading
+#            dots, where a dot not followed by a digit is a token of its own
+#   pairs    TWO_CHAR_TOKENS ('<=', '&&', ...) are one token, taken greedily from the left,
+#            so in a run of overlapping pairs ('&&&', '<==') every other byte ends one;
+#            '!=' followed by '=' is not a pair ('5!==3' is 5! == 3)
+#   '-'      always starts a token; after a line start or a SIGN_PREFIX_TOKENS token
+#            it is a sign and the digit/dot run right after it belongs to it
+#   others   every other byte (and '\n', the line break) is a token of its own
+
+def _previous(values: np.ndarray, first) -> np.ndarray:
+    shifted = np.empty_like(values)
+    shifted[:1] = first
+    shifted[1:] = values[:-1]
+    return shifted
+
+
+def _scan(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    For the bytes of one ASCII block: their positions without spaces, the bytes at those
+    positions and a mask of the bytes that start a token (newlines included).
+    """
+    positions = np.flatnonzero(data != _SPACE)
+    chars = data[positions]
+    index = np.arange(len(chars))
+    digit = (chars >= 48) & (chars <= 57)
+    dot = chars == _DOT
+    letter = ((chars | 32) >= 97) & ((chars | 32) <= 122) | (chars == 95)
+    minus = chars == _MINUS
+    newline = chars == _NEWLINE
+
+    alnum = letter | digit
+    run_start = np.maximum.accumulate(np.where(alnum & ~_previous(alnum, False), index, -1))
+    name = alnum & (np.maximum.accumulate(np.where(letter, index, -1)) >= run_start)
+
+    number = (digit | dot) & ~name
+    number_start = number & ~_previous(number, False)
+    run_start = np.maximum.accumulate(np.where(number_start, index, -1))
+    last_digit = np.maximum.accumulate(np.where(digit & number, index, -1))
+    leading_dot = dot & (_previous(last_digit, -1) < run_start)
+    before = _previous(chars, _NEWLINE)
+    after = np.empty_like(chars)
+    after[:-1] = chars[1:]
+    after[-1:] = _NEWLINE
+    # pair[i]: bytes i-1 and i can make a pair; second[i]: they do, byte i does not start a token
+    pair = np.zeros(len(chars), dtype=bool)
+    for first, last in _PAIRS:
+        pair |= (before == first) & (chars == last)
+    pair &= ~((before == _BANG) & (chars == _EQUALS) & (after == _EQUALS))
+    pair[:1] = False
+    pair_start = np.maximum.accumulate(np.where(pair & ~_previous(pair, False), index, -1))
+    second = pair & ((index - pair_start) % 2 == 0)
+    sign = minus & ((before == _NEWLINE) | np.isin(before, _SIGN_PREFIX) | _previous(second, False))
+    # a run that follows a sign is part of the signed number
+    absorbed = number_start & _previous(sign, False)
+    signed_run = number & absorbed[np.maximum(run_start, 0)]
+
+    starts = (name & ~_previous(name, False)) | ((number_start | leading_dot) & ~signed_run) | minus | newline \
+        | ~(alnum | dot | minus | second)
+    return positions, chars, starts
+
+
+# -------------------------------
+# Token streams
+# -------------------------------
+
+def _ascii_lines(data: np.ndarray) -> Iterator[List[str]]:
+    positions, chars, starts = _scan(data)
+    # a NUL before every token, then one decode and C-level splits instead of a loop per token
+    text = np.insert(chars, np.flatnonzero(starts), 0).tobytes().decode('ascii')
+    lines = text.split('\x00\n')
+    if data[-1] == _NEWLINE:
+        lines.pop()  # the text after the last newline
+    for line in lines:
+        yield line[1:].split('\x00') if line else []
+
+
+def iter_token_lines(path: str, block_size: int = BLOCK_SIZE) -> Iterator[List[str]]:
+    """
+    The tokens of every line of a memory-mapped file, exactly as tokenize(line) returns
+    them. Lines end at b'\\n' only. ASCII blocks are scanned as byte arrays; lines with
+    non-ASCII (or NUL) bytes are decoded and go through tokenize().
+    """
+    buffer, size = _open(path)
+    if buffer is None:
+        return
+    with buffer:
+        data = np.frombuffer(buffer, np.uint8)
+        try:
+            for start, end in _blocks(buffer, size, block_size):
+                if _UNUSUAL.search(buffer, start, end) is None:
+                    yield from _ascii_lines(data[start:end])
+                else:
+                    for line in _lines_of(buffer, start, end):
+                        yield tokenize(line.decode('utf-8'))
+        finally:
+            # the array view has to go before the mapping can close
+            del data
+
+
+# -------------------------------
+# Token offset arrays
+# -------------------------------
+
+class TokenOffsets:
+    """
+    Byte offsets of every token in a file, CSR style: the tokens of line i are
+    starts[lines[i]:lines[i + 1]] (and the matching ends). A token's text is the bytes
+    in [start, end) without spaces. No per-token or per-line objects are kept.
+    """
+
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, lines: np.ndarray):
+        self.starts = starts
+        self.ends = ends
+        self.lines = lines
+
+    def __len__(self) -> int:
+        return len(self.lines) - 1
+
+    def tokens(self, buffer, line: int) -> List[str]:
+        first, stop = self.lines[line], self.lines[line + 1]
+        return [bytes(buffer[a:b]).replace(b' ', b'').decode('utf-8')
+                for a, b in zip(self.starts[first:stop], self.ends[first:stop])]
+
+
+def _ascii_offsets(data: np.ndarray, offset: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(starts, ends, is_newline) of every token of one ASCII block, newlines included."""
+    positions, chars, starts = _scan(data)
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(chars))[:len(first)] - 1  # a block of spaces only has no tokens
+    return positions[first] + offset, positions[last] + offset + 1, chars[first] == _NEWLINE
+
+
+def _slow_offsets(buffer, start: int, end: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    starts, ends, newline = [], [], []
+    for line in _lines_of(buffer, start, end):
+        text = line.decode('utf-8')
+        # character index -> byte offset in the file
+        offsets = [start]
+        for ch in text:
+            offsets.append(offsets[-1] + len(ch.encode('utf-8')))
+        for _, token_start, token_end in iter_token_spans(text):
+            starts.append(offsets[token_start])
+            ends.append(offsets[token_end])
+            newline.append(False)
+        start += len(line) + 1
+        if start <= end:  # not a last line without '\n'
+            starts.append(start - 1)
+            ends.append(start)
+            newline.append(True)
+    return np.array(starts, np.int64), np.array(ends, np.int64), np.array(newline, bool)
+
+
+def token_offsets(path: str, block_size: int = BLOCK_SIZE) -> TokenOffsets:
+    """Token offsets of every line, like iter_token_lines but as three int64 arrays."""
+    parts = []
+    buffer, size = _open(path)
+    if buffer is None:
+        return TokenOffsets(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(1, np.int64))
+    with buffer:
+        data = np.frombuffer(buffer, np.uint8)
+        for start, end in _blocks(buffer, size, block_size):
+            if _UNUSUAL.search(buffer, start, end) is None:
+                parts.append(_ascii_offsets(data[start:end], start))
+            else:
+                parts.append(_slow_offsets(buffer, start, end))
+        del data
+        last_line_open = buffer[size - 1] != _NEWLINE
+    starts, ends, newline = (np.concatenate(column) for column in zip(*parts))
+    breaks = np.flatnonzero(newline)
+    # the number of real tokens before each newline is where the next line starts
+    lines = [np.zeros(1, np.int64), breaks - np.arange(len(breaks))]
+    if last_line_open:
+        lines.append(np.array([len(newline) - len(breaks)]))  # a last line without '\n'
+    return TokenOffsets(starts[~newline], ends[~newline], np.concatenate(lines).astype(np.int64))
+
+
+# -------------------------------
+# Benchmark: bytes/second vs. reading and tokenizing line by line
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Bulk tokenizer benchmark')
+    arg_parser.add_argument('--lines', type=int, default=200_000)
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'expressions.txt')
+        with open(path, 'w') as f:
+            for i in range(args.lines):
+                f.write(f'(x{i % 13} * {i}.25 - -{i % 7}) @ ~y ^ 2 $ {i % 5}! - 3 / (z + 1)\n')
+        size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        with open(path) as f:
+            expected = [tokenize(line[:-1]) for line in f]
+        line_by_line = time.perf_counter() - start
+
+        start = time.perf_counter()
+        streamed = list(iter_token_lines(path))
+        bulk = time.perf_counter() - start
+
+        start = time.perf_counter()
+        offsets = token_offsets(path)
+        offset_time = time.perf_counter() - start
+
+        assert streamed == expected and len(offsets) == len(expected)
+        print(f'{size / 1e6:.1f}MB, {args.lines} lines')
+        for name, elapsed in (('line by line', line_by_line), ('bulk tokens', bulk), ('bulk offsets', offset_time)):
+            print(f'{name:<13} {size / elapsed / 1e6:8.2f}MB/s')
@@ -0,0 +1,193 @@
+import pickle
+import struct
+import sys
+import time
+from array import array
+from typing import Tuple, Union
+
+from chatv3 import Calculator, Node
+from compiler import Program, LOAD_CONST, LOAD_VAR, UNARY, BINARY, REDUCE, SHORT, compile_node, skip
+
+# -------------------------------
+# Format, version 3 (all little-endian)
+# -------------------------------
+#   header     b'CALC', u16 version, u16 variable count, u32 constant count, u32 instruction count
+#   constants  float64 per constant
+#   code       u32 per instruction: argument << 3 | opcode; operator arguments index OPERATOR_SYMBOLS,
+#              REDUCE arguments are operand count << 5 | operator index, SHORT arguments are
+#              the length of the skipped code << 5 | operator index
+#   variables  per slot: u8 byte length, utf-8 name
+# The header is 16 bytes, so the constants and the code stay aligned for zero-copy views.
+# Version 2 added REDUCE, version 3 the comparison and logical operators and SHORT; older
+# data is a subset of the current format and still loads.
+
+MAGIC = b'CALC'
+VERSION = 3
+SUPPORTED_VERSIONS = (1, 2, 3)
+_HEADER = struct.Struct('<4sHHII')
+_OPCODE_BITS = 3
+_OPERATOR_BITS = 5
+_OPERATOR_MASK = (1 << _OPERATOR_BITS) - 1
+
+# append only: the position of a symbol is its code in every version
+OPERATOR_SYMBOLS = ('!', '~', '@', '&', '$', '%', '^', '*', '/', '+', '-',
+                    '<', '>', '<=', '>=', '==', '!=', '&&', '||')
+_OPERATOR_CODES = {symbol: code for code, symbol in enumerate(OPERATOR_SYMBOLS)}
+_OPERATORS = [Calculator().operators[symbol] for symbol in OPERATOR_SYMBOLS]
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def dumps(expr: Union[str, Node, Program]) -> bytes:
+    """Encode an expression (text, AST or compiled Program)."""
+    if isinstance(expr, str):
+        expr = Calculator().parse(expr)
+    program = expr if isinstance(expr, Program) else compile_node(expr)
+    words = array('I')
+    for opcode, arg in program.code:
+        if opcode in (UNARY, BINARY):
+            arg = _OPERATOR_CODES[arg.symbol]
+        elif opcode in (REDUCE, SHORT):
+            arg = arg[1] << _OPERATOR_BITS | _OPERATOR_CODES[arg[0].symbol]
+        words.append(arg << _OPCODE_BITS | opcode)
+    constants = array('d', program.constants)
+    if sys.byteorder != 'little':
+        words.byteswap()
+        constants.byteswap()
+    names = b''
+    for name in program.variables:
+        encoded = name.encode('utf-8')
+        if len(encoded) > 255:
+            raise ValueError(f"Variable name too long to encode: {name[:20]}...")
+        names += bytes([len(encoded)]) + encoded
+    header = _HEADER.pack(MAGIC, VERSION, len(program.variables), len(constants), len(words))
+    return header + constants.tobytes() + words.tobytes() + names
+
+
+class Bytecode:
+    """
+    A view over an encoded expression. Loading only checks the header and wraps the
+    constant pool and the code in memoryviews over the caller's buffer; nothing is
+    copied and no Node objects are built. Calling it runs the instructions in place.
+    """
+
+    def __init__(self, buffer: Buffer):
+        view = memoryview(buffer).cast('B')
+        if len(view) < _HEADER.size:
+            raise ValueError("Truncated bytecode header")
+        magic, version, variable_count, constant_count, code_count = _HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not calculator bytecode")
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported bytecode version {version}, expected one of {SUPPORTED_VERSIONS}")
+        code_start = _HEADER.size + 8 * constant_count
+        names_start = code_start + 4 * code_count
+        if len(view) < names_start:
+            raise ValueError("Truncated bytecode")
+        self.constants = view[_HEADER.size:code_start]
+        self.code = view[code_start:names_start]
+        if sys.byteorder == 'little':
+            self.constants = self.constants.cast('d')
+            self.code = self.code.cast('I')
+        else:
+            self.constants = _swapped('d', self.constants)
+            self.code = _swapped('I', self.code)
+        variables = []
+        position = names_start
+        for _ in range(variable_count):
+            length = view[position]
+            variables.append(bytes(view[position + 1:position + 1 + length]).decode('utf-8'))
+            position += 1 + length
+        self.variables: Tuple[str, ...] = tuple(variables)
+        self.operators = _OPERATORS
+
+    def __len__(self) -> int:
+        return len(self.code)
+
+    def __call__(self, *args: float, **kwargs: float) -> float:
+        if len(args) > len(self.variables):
+            raise TypeError(f"Expected at most {len(self.variables)} arguments, got {len(args)}")
+        values = list(args)
+        for name in self.variables[len(args):]:
+            if name not in kwargs:
+                raise NameError(f"Unbound variable: {name}")
+            values.append(kwargs[name])
+        constants = self.constants
+        operators = self.operators
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        code = iter(self.code)
+        for word in code:
+            opcode = word & 7
+            arg = word >> _OPCODE_BITS
+            if opcode == LOAD_CONST:
+                push(constants[arg])
+            elif opcode == LOAD_VAR:
+                push(values[arg])
+            elif opcode == UNARY:
+                stack[-1] = operators[arg].evaluate(stack[-1])
+            elif opcode == BINARY:
+                right = pop()
+                stack[-1] = operators[arg].evaluate(stack[-1], right)
+            elif opcode == REDUCE:
+                count = arg >> _OPERATOR_BITS
+                operands = stack[-count:]
+                del stack[-count:]
+                push(operators[arg & _OPERATOR_MASK].reduce(operands))
+            else:
+                decided = operators[arg & _OPERATOR_MASK].decided_by(stack[-1])
+                if decided is not None:
+                    stack[-1] = decided
+                    skip(code, (arg >> _OPERATOR_BITS) + 1)
+        return stack[0]
+
+    def program(self) -> Program:
+        """Decode into a Program, for the backends that take one (e.g. vectorized.run_program)."""
+        code = []
+        for word in self.code:
+            opcode = word & 7
+            arg = word >> _OPCODE_BITS
+            if opcode in (UNARY, BINARY):
+                arg = self.operators[arg]
+            elif opcode in (REDUCE, SHORT):
+                arg = (self.operators[arg & _OPERATOR_MASK], arg >> _OPERATOR_BITS)
+            code.append((opcode, arg))
+        return Program(code, list(self.constants), self.variables)
+
+
+def _swapped(typecode: str, view: memoryview) -> array:
+    values = array(typecode, view.tobytes())
+    values.byteswap()
+    return values
+
+
+def loads(buffer: Buffer) -> Bytecode:
+    return Bytecode(buffer)
+
+
+# -------------------------------
+# Benchmark: size and load time vs. pickle and reparsing
+# -------------------------------
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(20000)
+    calculator = Calculator()
+    for terms in (10, 100, 1000):
+        text = '+'.join(f'(x{i % 7} * {i}.5 ^ 2 $ ~{i})' for i in range(terms))
+        node = calculator.parse(text)
+        encoded = dumps(node)
+        pickled = pickle.dumps(node)
+        values = {f'x{i}': i + 0.5 for i in range(7)}
+        assert loads(encoded)(**values) == node.evaluate(values)
+        repeat = max(10000 // terms, 10)
+        timings = {}
+        for name, load in (('bytecode', lambda: loads(encoded)), ('pickle', lambda: pickle.loads(pickled)),
+                           ('reparse', lambda: calculator.parse(text))):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                load()
+            timings[name] = (time.perf_counter() - start) / repeat
+        print(f'{terms:>5} terms: size bytecode {len(encoded):>7}B, pickle {len(pickled):>7}B, text {len(text):>7}B | '
+              f'load bytecode {timings["bytecode"] * 1e6:9.1f}us, pickle {timings["pickle"] * 1e6:9.1f}us, '
+              f'reparse {timings["reparse"] * 1e6:9.1f}us')
@@ -1,7 +1,10 @@
 import re
 import math
+import time
 from abc import ABC, abstractmethod
-from typing import List
+from functools import lru_cache, reduce
+from types import MappingProxyType
+from typing import Iterator, List, Mapping, Optional, Tuple
 
 
 # -------------------------------
@@ -9,6 +12,11 @@ from typing import List
 # -------------------------------
 
 class Operator(ABC):
+    # אופרטור אסוציאטיבי יודע לצמצם שרשרת שלמה בקריאה אחת (ראו NaryOpNode)
+    associative = False
+    # אופרטור עם קיצור (&&, ||) מחשב את הצד הימני רק אם השמאלי לא הכריע (ראו LogicalOpNode)
+    short_circuit = False
+
     def __init__(self, symbol: str, precedence: int, arity: int, right_association : bool = False):
         self.symbol = symbol
         self.precedence = precedence
@@ -41,20 +49,30 @@ class Negative(Operator):
 
 
 class Max(Operator):
+    associative = True
+
     def __init__(self):
         super().__init__('@', 5, 2)
 
     def evaluate(self, x: float, y: float) -> float:
         return max(x, y)
 
+    def reduce(self, values: List[float]) -> float:
+        return max(values)
+
 
 class Min(Operator):
+    associative = True
+
     def __init__(self):
         super().__init__('&', 5, 2)
 
     def evaluate(self, x: float, y: float) -> float:
         return min(x, y)
 
+    def reduce(self, values: List[float]) -> float:
+        return min(values)
+
 
 class Average(Operator):
     def __init__(self):
@@ -81,12 +99,17 @@ class Power(Operator):
 
 
 class Multiply(Operator):
+    associative = True
+
     def __init__(self):
         super().__init__('*', 3, 2)
 
     def evaluate(self, x: float, y: float) -> float:
         return x * y
 
+    def reduce(self, values: List[float]) -> float:
+        return math.prod(values)
+
 
 class Divide(Operator):
     def __init__(self):
@@ -99,12 +122,22 @@ class Divide(Operator):
 
 
 class Add(Operator):
+    associative = True
+
     def __init__(self):
         super().__init__('+', 1, 2)
 
     def evaluate(self, x: float, y: float) -> float:
         return x + y
 
+    def reduce(self, values: List[float]) -> float:
+        # fsum מעגל את הסכום המדויק פעם אחת, ולכן יכול להיות שונה בספרה האחרונה מחיבור משמאל לימין.
+        # אינסופים הפוכים, גלישה ומספרים מרוכבים נשארים עם ההתנהגות של חיבור רגיל
+        try:
+            return math.fsum(values)
+        except (ValueError, OverflowError, TypeError):
+            return reduce(self.evaluate, values)
+
 
 class Subtract(Operator):
     def __init__(self):
@@ -114,13 +147,115 @@ class Subtract(Operator):
         return x - y
 
 
+# -------------------------------
+# השוואות ואופרטורים לוגיים: התוצאה היא 1.0 (אמת) או 0.0 (שקר)
+# -------------------------------
+
+class Less(Operator):
+    def __init__(self):
+        super().__init__('<', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x < y else 0.0
+
+
+class Greater(Operator):
+    def __init__(self):
+        super().__init__('>', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x > y else 0.0
+
+
+class LessEqual(Operator):
+    def __init__(self):
+        super().__init__('<=', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x <= y else 0.0
+
+
+class GreaterEqual(Operator):
+    def __init__(self):
+        super().__init__('>=', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x >= y else 0.0
+
+
+class Equal(Operator):
+    def __init__(self):
+        super().__init__('==', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x == y else 0.0
+
+
+class NotEqual(Operator):
+    def __init__(self):
+        super().__init__('!=', 0, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x != y else 0.0
+
+
+class And(Operator):
+    short_circuit = True
+
+    def __init__(self):
+        super().__init__('&&', -1, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x and y else 0.0
+
+    def decided_by(self, x: float) -> Optional[float]:
+        # צד שמאלי שקרי מכריע: התוצאה 0.0 בלי לחשב את הצד הימני
+        return None if x else 0.0
+
+
+class Or(Operator):
+    short_circuit = True
+
+    def __init__(self):
+        super().__init__('||', -2, 2)
+
+    def evaluate(self, x: float, y: float) -> float:
+        return 1.0 if x or y else 0.0
+
+    def decided_by(self, x: float) -> Optional[float]:
+        return 1.0 if x else None
+
+
+# רישום האופרטורים המשותף: לקריאה בלבד, ולכן בטוח לשיתוף בין threads
+OPERATORS: Mapping[str, Operator] = MappingProxyType({
+    '!': Factorial(), '~': Negative(), '@': Max(), '&': Min(), '$': Average(),
+    '%': Modulo(), '^': Power(), '*': Multiply(), '/': Divide(), '+': Add(), '-': Subtract(),
+    '<': Less(), '>': Greater(), '<=': LessEqual(), '>=': GreaterEqual(), '==': Equal(), '!=': NotEqual(),
+    '&&': And(), '||': Or()
+})
+
+
+def lowest_precedence(operators: Mapping[str, Operator]) -> int:
+    # ביטוי שלם (וגם ביטוי בתוך סוגריים) מתחיל מהעדיפות הנמוכה ביותר, כרגע || עם 2-
+    return min(op.precedence for op in operators.values())
+
+
+_LOWEST = lowest_precedence(OPERATORS)
+
+# פונקציות חלון, למשל mavg(x, 5): שם הפונקציה והאופרטור שמצמצם את הדגימות שבחלון.
+# mavg הוא ממוצע של כל החלון ולא ה-$ הבינארי; ראו WindowNode
+WINDOWS: Mapping[str, Operator] = MappingProxyType({
+    'mavg': OPERATORS['$'], 'rmax': OPERATORS['@'], 'rmin': OPERATORS['&'], 'rsum': OPERATORS['+']
+})
+
+
 # -------------------------------
 # הגדרת צמתי העץ (AST)
 # -------------------------------
 
 class Node(ABC):
     @abstractmethod
-    def evaluate(self) -> float:
+    def evaluate(self, variables: Optional[dict] = None) -> float:
         pass
 
 
@@ -128,17 +263,27 @@ class NumberNode(Node):
     def __init__(self, value: float):
         self.value = value
 
-    def evaluate(self) -> float:
+    def evaluate(self, variables: Optional[dict] = None) -> float:
         return self.value
 
 
+class VariableNode(Node):
+    def __init__(self, name: str):
+        self.name = name
+
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        if variables is None or self.name not in variables:
+            raise NameError(f"Unbound variable: {self.name}")
+        return variables[self.name]
+
+
 class UnaryOpNode(Node):
     def __init__(self, op: Operator, child: Node):
         self.op = op
         self.child = child
 
-    def evaluate(self) -> float:
-        return self.op.evaluate(self.child.evaluate())
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        return self.op.evaluate(self.child.evaluate(variables))
 
 
 class BinaryOpNode(Node):
@@ -147,8 +292,46 @@ class BinaryOpNode(Node):
         self.left = left
         self.right = right
 
-    def evaluate(self) -> float:
-        return self.op.evaluate(self.left.evaluate(), self.right.evaluate())
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        return self.op.evaluate(self.left.evaluate(variables), self.right.evaluate(variables))
+
+
+class LogicalOpNode(BinaryOpNode):
+    # && ו-|| עם קיצור: אם הצד השמאלי מכריע, הצד הימני לא מחושב בכלל (גם לא השגיאות שבו)
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        left = self.left.evaluate(variables)
+        decided = self.op.decided_by(left)
+        if decided is not None:
+            return decided
+        return self.op.evaluate(left, self.right.evaluate(variables))
+
+
+def binary_node(op: Operator, left: Node, right: Node) -> BinaryOpNode:
+    return LogicalOpNode(op, left, right) if op.short_circuit else BinaryOpNode(op, left, right)
+
+
+class NaryOpNode(Node):
+    # שרשרת של אופרטור אסוציאטיבי אחד (a+b+c+...) כצומת אחד שמחושב ב-reduce יחיד
+    def __init__(self, op: Operator, children: List[Node]):
+        self.op = op
+        self.children = children
+
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        return self.op.reduce([child.evaluate(variables) for child in self.children])
+
+
+class WindowNode(Node):
+    # פונקציית חלון: האופרטור מצמצם את size הערכים האחרונים של child לאורך סדרה של דגימות
+    # (בתחילת הסדרה, את מה שיש). סדרות מחושבות ב-stream.Stream וב-vectorized.evaluate_array;
+    # חישוב בודד הוא סדרה של דגימה אחת, ולכן הערך שלו הוא הערך של child
+    def __init__(self, name: str, op: Operator, child: Node, size: int):
+        self.name = name
+        self.op = op
+        self.child = child
+        self.size = size
+
+    def evaluate(self, variables: Optional[dict] = None) -> float:
+        return self.child.evaluate(variables)
 
 
 # -------------------------------
@@ -156,6 +339,7 @@ class BinaryOpNode(Node):
 # -------------------------------
 
 class Parser:
+    # עטיפה עם מצב מעל רשימת טוקנים; הדקדוק עצמו נמצא רק ב-parse_tokens
     def __init__(self, tokens: List[str], operators: dict):
         self.tokens = tokens
         self.pos = 0
@@ -170,69 +354,165 @@ class Parser:
         self.pos += 1
 
     def parse(self) -> Node:
-        return self.parse_expression(0)
+        node, self.pos = parse_tokens(self.tokens, self.operators, self.pos)
+        return node
+
+
+def parse(expression: str, operators: Mapping[str, Operator] = OPERATORS) -> Node:
+    """
+    בניית העץ של ביטוי, בלי מצב משותף.
+    הפונקציה reentrant, ואפשר לקרוא לה במקביל מכמה threads.
+    """
+    return parse_tokens(tokenize(expression), operators)[0]
+
+
+def parse_tokens(tokens: List[str], operators: Mapping[str, Operator] = OPERATORS, pos: int = 0) -> Tuple[Node, int]:
+    """
+    מחזירה את העץ של הביטוי שמתחיל ב-pos ואת המיקום שאחריו.
+    שגיאת תחביר נזרקת כ-Exception.
+    """
+    node, pos, error = parse_tokens_checked(tokens, operators, pos)
+    if node is None:
+        raise Exception(error)
+    return node, pos
 
-    def parse_primary(self) -> Node:
-        token = self.current()
-        if token is None:
-            raise Exception('Unexpected end of input')
+
+def _is_number(token: str) -> bool:
+    # מספר כפי ש-tokenize בונה אותו ו-float מקבל: ספרות עם נקודה אחת לכל היותר, אולי עם מינוס
+    return token.lstrip('-').replace('.', '', 1).isdecimal()
+
+
+# (צומת, מיקום, הודעה); הכינוי מחושב פעם אחת, ולא בכל הגדרה של פונקציה פנימית
+_Parsed = Tuple[Optional[Node], int, Optional[str]]
+
+
+def parse_tokens_checked(tokens: List[str], operators: Mapping[str, Operator] = OPERATORS, pos: int = 0,
+                         origins: Optional[dict] = None) -> _Parsed:
+    """
+    הדקדוק לפי סדר העדיפויות, בלי חריגות: המיקום עובר כפרמטר ומוחזר יחד עם הצומת.
+    מחזירה (צומת, המיקום שאחריו, None), ובשגיאת תחביר (None, מיקום הטוקן השגוי, הודעה).
+    אם origins הוא dict, נרשם בו לכל צומת של אופרטור, משתנה או חלון המיקום של הטוקן שלו.
+    """
+    count = len(tokens)
+    lowest = _LOWEST if operators is OPERATORS else lowest_precedence(operators)
+    factorial = operators.get('!')
+    if factorial is not None and factorial.arity != 1:
+        factorial = None
+
+    def is_postfix(pos: int) -> bool:
+        return factorial is not None and pos < count and tokens[pos] == '!'
+
+    def parse_primary(pos: int) -> _Parsed:
+        if pos >= count:
+            return None, pos, 'Unexpected end of input'
+        token = tokens[pos]
         if token == '(':
-            self.consume()
-            node = self.parse_expression(0)
-            if self.current() != ')':
-                raise Exception('Missing closing parenthesis')
-            self.consume()  # Consume ')'
-            return node
-        # טיפול באופרטור חד־ערכי (prefix) – למשל, ~
-        if token in self.operators and self.operators[token].arity == 1 and token not in ['!']:
-            op = self.operators[token]
-            self.consume()
-            child = self.parse_expression(op.precedence)
-            return UnaryOpNode(op, child)
-        # צפוי מספר (כולל מספר עם מינוס כחלק מהליטרל)
-        try:
-            value = float(token)
-            self.consume()
-            return NumberNode(value)
-        except ValueError:
-            raise Exception(f'Invalid token: {token}')
-
-    def parse_expression(self, min_prec: int) -> Node:
-        left = self.parse_primary()
-        # טיפול באופרטורים חד־ערכיים בצורה postfix (כמו עצרת !)
-        while self.current() in self.operators and self.operators[self.current()].arity == 1 and self.current() == '!':
-            op = self.operators[self.current()]
-            self.consume()
-            left = UnaryOpNode(op, left)
-        while True:
-            token = self.current()
-            if token is None or token not in self.operators or self.operators[token].arity != 2:
+            node, pos, error = parse_expression(pos + 1, lowest)
+            if node is None:
+                return None, pos, error
+            if pos >= count or tokens[pos] != ')':
+                return None, pos, 'Missing closing parenthesis'
+            return node, pos + 1, None
+        if token in operators and operators[token].arity == 1 and token != '!':
+            op = operators[token]
+            child, end, error = parse_expression(pos + 1, op.precedence)
+            if child is None:
+                return None, end, error
+            node = UnaryOpNode(op, child)
+            if origins is not None:
+                origins[node] = pos
+            return node, end, None
+        if token in WINDOWS and pos + 1 < count and tokens[pos + 1] == '(':
+            return parse_window(pos)
+        if token.isidentifier():
+            node = VariableNode(token)
+            if origins is not None:
+                origins[node] = pos
+            return node, pos + 1, None
+        if _is_number(token):
+            return NumberNode(float(token)), pos + 1, None
+        return None, pos, f'Invalid token: {token}'
+
+    def parse_window(pos: int) -> _Parsed:
+        # name ( ביטוי , גודל ) כאשר הגודל הוא מספר שלם וחיובי
+        child, end, error = parse_expression(pos + 2, lowest)
+        if child is None:
+            return None, end, error
+        if end >= count or tokens[end] != ',':
+            return None, end, 'Missing comma'
+        size = tokens[end + 1] if end + 1 < count else None
+        if size is None:
+            return None, end + 1, 'Unexpected end of input'
+        if not size.isdecimal() or int(size) == 0:
+            return None, end + 1, f'Invalid window size: {size}'
+        if end + 2 >= count or tokens[end + 2] != ')':
+            return None, end + 2, 'Missing closing parenthesis'
+        node = WindowNode(tokens[pos], WINDOWS[tokens[pos]], child, int(size))
+        if origins is not None:
+            origins[node] = pos
+        return node, end + 3, None
+
+    def parse_expression(pos: int, min_prec: int) -> _Parsed:
+        left, pos, error = parse_primary(pos)
+        if left is None:
+            return None, pos, error
+        while is_postfix(pos):
+            left = UnaryOpNode(factorial, left)
+            if origins is not None:
+                origins[left] = pos
+            pos += 1
+        while pos < count:
+            at = pos
+            op = operators.get(tokens[at])
+            if op is None or op.arity != 2 or op.precedence < min_prec:
                 break
-            op = self.operators[token]
-            prec = op.precedence
-            assoc = 'right' if op.right_association  else 'left'
-            if prec < min_prec:
-                break
-            self.consume()
-            next_min = prec + 1 if assoc == 'left' else prec
-            right = self.parse_expression(next_min)
-            left = BinaryOpNode(op, left, right)
-            # טיפול באופרטור postfix נוסף אם קיים
-            while self.current() in self.operators and self.operators[
-                self.current()].arity == 1 and self.current() == '!':
-                op_post = self.operators[self.current()]
-                self.consume()
-                left = UnaryOpNode(op_post, left)
-        return left
+            right, pos, error = parse_expression(at + 1, op.precedence if op.right_association else op.precedence + 1)
+            if right is None:
+                return None, pos, error
+            left = binary_node(op, left, right)
+            if origins is not None:
+                origins[left] = at
+            while is_postfix(pos):
+                left = UnaryOpNode(factorial, left)
+                if origins is not None:
+                    origins[left] = pos
+                pos += 1
+        return left, pos, None
+
+    return parse_expression(pos, lowest)
+
+
+# העצים לא משתנים אחרי הבנייה, אז אפשר לשתף אותם; lru_cache בטוח לשימוש מכמה threads
+@lru_cache(maxsize=1024)
+def parse_cached(expression: str) -> Node:
+    return parse(expression)
+
+
+def evaluate(expression: str, **variables: float) -> float:
+    """חישוב בלי אובייקט Calculator, בטוח לשימוש במקביל."""
+    return parse_cached(expression).evaluate(variables)
 
 
 # -------------------------------
 # פונקציית טוקניזציה מותאמת
 # -------------------------------
 
+# אחרי הטוקנים האלה (או בתחילת הביטוי) '-' הוא חלק מהמספר ולא חיסור
+SIGN_PREFIX_TOKENS = ['(', '+', '-', '*', '/', '!', '@', '&', '$', '%', '^', '~',
+                      '<', '>', '<=', '>=', '==', '!=', '&&', '||']
+
+# אופרטורים של שני תווים; נבדקים לפני התו הבודד, כך ש-'5!=3' הוא השוואה ולא עצרת.
+# יוצא מן הכלל: '!==' הוא עצרת ואחריה '==' ('5! == 120')
+TWO_CHAR_TOKENS = ('<=', '>=', '==', '!=', '&&', '||')
+
+
+def _is_pair(first: str, second: str, third: Optional[str]) -> bool:
+    return first + second in TWO_CHAR_TOKENS and not (first == '!' and third == '=')
+
 def tokenize(expression: str) -> List[str]:
     """
     מפצלת את הביטוי לטוקנים.
+    שמות משתנים (אות או קו תחתון בהתחלה) הופכים לטוקן אחד.
     כלל מיוחד: אם מופיע סימן '-' בתחילת הביטוי או לאחר אופרטור/סוגר פתיחה, הוא ישויך כחלק מהמספר.
     בנוסף, אם מופיע '-' אחרי '~' כאשר מיד אחריו מגיע מספר עם עצרת, נטפל במצב בצורה מתאימה.
     """
@@ -248,9 +528,17 @@ def tokenize(expression: str) -> List[str]:
                 num += expr[i]
                 i += 1
             tokens.append(num)
+        elif ch.isalpha() or ch == '_':
+            # שם משתנה: אות או קו תחתון ואחריהם אותיות, ספרות או קו תחתון
+            name = ch
+            i += 1
+            while i < len(expr) and (expr[i].isalnum() or expr[i] == '_'):
+                name += expr[i]
+                i += 1
+            tokens.append(name)
         elif ch == '-':
             # אם אין טוקן קודם או שהקודם הוא סוגר פתיחה או אופרטור, נחבר את '-' לחלק מהמספר
-            if not tokens or tokens[-1] in ['(', '+', '-', '*', '/', '!', '@', '&', '$', '%', '^', '~']:
+            if not tokens or tokens[-1] in SIGN_PREFIX_TOKENS:
                 num = ch
                 i += 1
                 while i < len(expr) and (expr[i].isdigit() or expr[i] == '.'):
@@ -260,28 +548,102 @@ def tokenize(expression: str) -> List[str]:
             else:
                 tokens.append(ch)
                 i += 1
+        elif i + 1 < len(expr) and _is_pair(ch, expr[i + 1], expr[i + 2] if i + 2 < len(expr) else None):
+            tokens.append(expr[i:i + 2])
+            i += 2
         else:
             tokens.append(ch)
             i += 1
     return tokens
 
 
+def iter_token_spans(expression: str, i: int = 0, previous: Optional[str] = None) -> Iterator[Tuple[str, int, int]]:
+    """
+    כמו tokenize, אבל מחזירה לכל טוקן גם את המיקום שלו בטקסט המקורי (עם הרווחים): (טוקן, התחלה, סוף).
+    אפשר להתחיל באמצע הטקסט: i הוא המיקום ו-previous הוא הטוקן שלפניו (None בתחילת הביטוי).
+    כמו ב-tokenize, רווחים באמצע מספר או שם משתנה לא מפרידים ביניהם.
+    """
+    n = len(expression)
+
+    def skip_spaces(j: int) -> int:
+        while j < n and expression[j] == ' ':
+            j += 1
+        return j
+
+    def scan(j: int, accept) -> Tuple[str, int, int]:
+        # expression[j] כבר שייך לטוקן; ממשיכים כל עוד accept מסכים, גם מעבר לרווחים
+        text = expression[j]
+        end = j + 1
+        j = skip_spaces(j + 1)
+        while j < n and accept(expression[j]):
+            text += expression[j]
+            end = j + 1
+            j = skip_spaces(j + 1)
+        return text, end, j
+
+    def is_number_char(c: str) -> bool:
+        return c.isdigit() or c == '.'
+
+    def char_at(j: int) -> Optional[str]:
+        return expression[j] if j < n else None
+
+    def is_name_char(c: str) -> bool:
+        return c.isalnum() or c == '_'
+
+    i = skip_spaces(i)
+    while i < n:
+        ch = expression[i]
+        start = i
+        after = skip_spaces(i + 1)
+        if ch.isdigit() or (ch == '.' and after < n and expression[after].isdigit()):
+            text, end, i = scan(i, is_number_char)
+        elif ch.isalpha() or ch == '_':
+            text, end, i = scan(i, is_name_char)
+        elif ch == '-' and (previous is None or previous in SIGN_PREFIX_TOKENS):
+            text, end, i = scan(i, is_number_char)
+        elif after < n and _is_pair(ch, expression[after], char_at(skip_spaces(after + 1))):
+            # גם כאן רווח בין שני התווים לא מפריד ביניהם, כמו ב-tokenize
+            text, end, i = ch + expression[after], after + 1, skip_spaces(after + 1)
+        else:
+            text, end, i = ch, i + 1, after
+        previous = text
+        yield text, start, end
+
+
+def tokenize_spans(expression: str) -> List[Tuple[str, int, int]]:
+    return list(iter_token_spans(expression))
+
+
 # -------------------------------
 # מחלקת המחשבון שמשתמשת ב-AST
 # -------------------------------
 
 class Calculator:
-    def __init__(self):
-        self.operators = {
-            '!': Factorial(), '~': Negative(), '@': Max(), '&': Min(), '$': Average(),
-            '%': Modulo(), '^': Power(), '*': Multiply(), '/': Divide(), '+': Add(), '-': Subtract()
-        }
-
-    def evaluate(self, expression: str) -> float:
-        tokens = tokenize(expression)
-        parser = Parser(tokens, self.operators)
-        ast = parser.parse()
-        return ast.evaluate()
+    def __init__(self, sampler=None, tiers=None):
+        self.operators = OPERATORS
+        # sampler.Sampler אופציונלי: סופר אילו ביטויים נקראים הכי הרבה ולוקחים הכי הרבה זמן
+        self.sampler = sampler
+        # tiered.Tiers אופציונלי: סופר קריאות לכל ביטוי ומעביר ביטויים חמים מהעץ לקוד מהודר
+        self.tiers = tiers
+
+    def parse(self, expression: str) -> Node:
+        return parse(expression, self.operators)
+
+    def _evaluate(self, expression: str, variables: dict) -> float:
+        if self.tiers is not None:
+            return self.tiers.evaluate(expression, variables, self.parse)
+        return self.parse(expression).evaluate(variables)
+
+    def evaluate(self, expression: str, **variables: float) -> float:
+        sampler = self.sampler
+        if sampler is None or not sampler.sampled():
+            return self._evaluate(expression, variables)
+        start = time.perf_counter()
+        try:
+            return self._evaluate(expression, variables)
+        finally:
+            # גם קריאה שנכשלה בשגיאה עלתה זמן
+            sampler.record(expression, time.perf_counter() - start)
 
 
 # -------------------------------
@@ -0,0 +1,140 @@
+from itertools import islice
+from typing import Dict, List, Tuple
+
+from chatv3 import Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode
+
+
+# -------------------------------
+# Stack program: a flat postfix form of the AST
+# -------------------------------
+
+LOAD_CONST = 0
+LOAD_VAR = 1
+UNARY = 2
+BINARY = 3
+REDUCE = 4  # argument: (operator, operand count), for NaryOpNode
+# argument: (operator, length of the right operand's code), for LogicalOpNode. A && b compiles to
+#   <a> SHORT(&&, len(<b>)) <b> BINARY(&&)
+# SHORT leaves `a` on the stack; when a decides the result it replaces it with the result and
+# skips <b> and the BINARY. Ignoring SHORT is always correct, it only loses the short circuit.
+SHORT = 5
+
+
+class Program:
+    """
+    A compiled expression: a list of (opcode, argument) pairs, a constant pool and
+    variable slots. Operator instructions carry the chatv3 Operator as argument, so
+    evaluation goes through exactly the same Operator.evaluate code as the AST.
+    """
+
+    def __init__(self, code: List[Tuple[int, object]], constants: List[float], variables: Tuple[str, ...]):
+        self.code = code
+        self.constants = constants
+        self.variables = variables
+        self.stack_depth = _stack_depth(code)
+
+    def __len__(self) -> int:
+        return len(self.code)
+
+    def bind(self, args: tuple, kwargs: dict) -> list:
+        """Map positional (slot order) and keyword arguments to the variable slots."""
+        if len(args) > len(self.variables):
+            raise TypeError(f"Expected at most {len(self.variables)} arguments, got {len(args)}")
+        values = list(args)
+        for name in self.variables[len(args):]:
+            if name not in kwargs:
+                raise NameError(f"Unbound variable: {name}")
+            values.append(kwargs[name])
+        return values
+
+    def __call__(self, *args: float, **kwargs: float) -> float:
+        values = self.bind(args, kwargs) if self.variables else ()
+        constants = self.constants
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        code = iter(self.code)
+        for opcode, arg in code:
+            if opcode == LOAD_CONST:
+                push(constants[arg])
+            elif opcode == LOAD_VAR:
+                push(values[arg])
+            elif opcode == UNARY:
+                stack[-1] = arg.evaluate(stack[-1])
+            elif opcode == BINARY:
+                right = pop()
+                stack[-1] = arg.evaluate(stack[-1], right)
+            elif opcode == REDUCE:
+                op, count = arg
+                operands = stack[-count:]
+                del stack[-count:]
+                push(op.reduce(operands))
+            else:
+                op, length = arg
+                decided = op.decided_by(stack[-1])
+                if decided is not None:
+                    stack[-1] = decided
+                    skip(code, length + 1)
+        return stack[0]
+
+
+def skip(code, count: int):
+    """Advance an instruction iterator by `count` instructions."""
+    next(islice(code, count, count), None)
+
+
+def _stack_depth(code: List[Tuple[int, object]]) -> int:
+    depth = deepest = 0
+    for opcode, arg in code:
+        if opcode in (LOAD_CONST, LOAD_VAR):
+            depth += 1
+        elif opcode == BINARY:
+            depth -= 1
+        elif opcode == REDUCE:
+            depth -= arg[1] - 1
+        deepest = max(deepest, depth)
+    return deepest
+
+
+def compile_node(node: Node) -> Program:
+    """Flatten an AST into a Program. Variable slots follow first appearance, left to right."""
+    code: List[Tuple[int, object]] = []
+    constants: List[float] = []
+    constant_slots: Dict[tuple, int] = {}
+    variable_slots: Dict[str, int] = {}
+
+    def emit(current: Node):
+        if isinstance(current, NumberNode):
+            # repr keeps 0.0 and -0.0 (and int vs float) in separate slots
+            key = (type(current.value), repr(current.value))
+            if key not in constant_slots:
+                constant_slots[key] = len(constants)
+                constants.append(current.value)
+            code.append((LOAD_CONST, constant_slots[key]))
+        elif isinstance(current, VariableNode):
+            if current.name not in variable_slots:
+                variable_slots[current.name] = len(variable_slots)
+            code.append((LOAD_VAR, variable_slots[current.name]))
+        elif isinstance(current, UnaryOpNode):
+            emit(current.child)
+            code.append((UNARY, current.op))
+        elif isinstance(current, LogicalOpNode):
+            emit(current.left)
+            short = len(code)
+            code.append(None)
+            emit(current.right)
+            code[short] = (SHORT, (current.op, len(code) - short - 1))
+            code.append((BINARY, current.op))
+        elif isinstance(current, BinaryOpNode):
+            emit(current.left)
+            emit(current.right)
+            code.append((BINARY, current.op))
+        elif isinstance(current, NaryOpNode):
+            for child in current.children:
+                emit(child)
+            code.append((REDUCE, (current.op, len(current.children))))
+        else:
+            raise TypeError(f"Cannot compile node of type {type(current).__name__}")
+
+    emit(node)
+    return Program(code, constants, tuple(variable_slots))
@@ -0,0 +1,271 @@
+import argparse
+import random
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+import chat
+import chatv2
+import chatv3
+import compiler
+import regexcheck
+
+
+# -------------------------------
+# Engines under test
+# -------------------------------
+
+ARITHMETIC = {'+', '-', '*', '/', '%', '^', '@', '&', '$'}
+
+
+class Engine:
+    """
+    One calculator implementation plus the grammar features it is meant to support.
+    Features are operator symbols, 'factorial' (postfix !), 'paren', 'decimal' and
+    'neg_literal' (a '-' glued to a number, e.g. '2*-3').
+    """
+
+    def __init__(self, name: str, evaluate: Callable[[str], float], features: set):
+        self.name = name
+        self.evaluate = evaluate
+        self.features = frozenset(features)
+
+    def supports(self, features: set) -> bool:
+        return features <= self.features
+
+
+def default_engines() -> List[Engine]:
+    # chatv3 is first on purpose: the first engine that supports an expression is the reference
+    return [
+        Engine('chatv3', chatv3.Calculator().evaluate,
+               ARITHMETIC | {'~', 'factorial', 'paren', 'decimal', 'neg_literal'}),
+        Engine('compiled', lambda expression: compiler.compile_node(chatv3.Calculator().parse(expression))(),
+               ARITHMETIC | {'~', 'factorial', 'paren', 'decimal', 'neg_literal'}),
+        Engine('regexcheck', regexcheck.Calculator().evaluate,
+               {'+', '-', '*', '/', '~', 'factorial', 'paren', 'decimal', 'neg_literal'}),
+        Engine('chatv2', chatv2.Calculator().evaluate, ARITHMETIC | {'~', 'decimal', 'neg_literal'}),
+        Engine('chat', chat.Calculator().evaluate, ARITHMETIC | {'~'}),
+    ]
+
+
+# -------------------------------
+# Grammar-based expression generator
+# -------------------------------
+# Trees are plain tuples so they are cheap to build, compare and shrink:
+#   ('num', text) | ('bin', op, left, right) | ('pre', op, child) | ('post', op, child) | ('paren', child)
+
+class Generator:
+    def __init__(self, seed: int = 0, max_depth: int = 4, features: Optional[set] = None):
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.features = set(features) if features is not None else \
+            ARITHMETIC | {'~', 'factorial', 'paren', 'decimal', 'neg_literal'}
+        self.binary = sorted(self.features & ARITHMETIC)
+
+    def number(self) -> tuple:
+        value = str(self.random.randint(0, 20))
+        if 'decimal' in self.features and self.random.random() < 0.2:
+            value += '.' + str(self.random.randint(0, 99))
+        if 'neg_literal' in self.features and self.random.random() < 0.1:
+            value = '-' + value
+        return ('num', value)
+
+    def tree(self, depth: int = 0) -> tuple:
+        if depth >= self.max_depth or self.random.random() < 0.3:
+            return self.number()
+        choice = self.random.random()
+        if choice < 0.1 and '~' in self.features:
+            return ('pre', '~', self.tree(depth + 1))
+        if choice < 0.2 and 'factorial' in self.features:
+            # small operands only, gamma overflows quickly
+            return ('post', '!', ('num', str(self.random.randint(0, 6))))
+        if choice < 0.3 and 'paren' in self.features:
+            return ('paren', self.tree(depth + 1))
+        if not self.binary:
+            return self.number()
+        return ('bin', self.random.choice(self.binary), self.tree(depth + 1), self.tree(depth + 1))
+
+    def expressions(self, count: int) -> List[str]:
+        return [render(self.tree()) for _ in range(count)]
+
+
+def render(tree: tuple) -> str:
+    kind = tree[0]
+    if kind == 'num':
+        return tree[1]
+    if kind == 'bin':
+        return render(tree[2]) + tree[1] + render(tree[3])
+    if kind == 'pre':
+        return tree[1] + render(tree[2])
+    if kind == 'post':
+        return render(tree[2]) + tree[1]
+    return '(' + render(tree[1]) + ')'
+
+
+def features_of(expression: str) -> set:
+    """The grammar features an expression string actually uses."""
+    found = set()
+    for i, ch in enumerate(expression):
+        if ch in ARITHMETIC or ch == '~':
+            found.add(ch)
+        elif ch == '!':
+            found.add('factorial')
+        elif ch in '()':
+            found.add('paren')
+        elif ch == '.':
+            found.add('decimal')
+        if ch == '-' and (i == 0 or not (expression[i - 1].isdigit() or expression[i - 1] in '.)')):
+            found.add('neg_literal')
+    return found
+
+
+def subtrees(tree: tuple):
+    yield tree
+    for child in tree[1:]:
+        if isinstance(child, tuple):
+            yield from subtrees(child)
+
+
+def size(tree: tuple) -> int:
+    return sum(1 for _ in subtrees(tree))
+
+
+def cost(tree: tuple) -> tuple:
+    # fewer nodes first, then shorter text, so '1-1' beats '2-18'
+    return size(tree), len(render(tree))
+
+
+# -------------------------------
+# Differential runner
+# -------------------------------
+
+def outcome(engine: Engine, expression: str):
+    """The value an engine returns, or the name of the exception it raised."""
+    try:
+        return engine.evaluate(expression)
+    except Exception as e:  # every engine raises something different, only the fact matters
+        return type(e).__name__
+
+
+def same_outcome(a, b) -> bool:
+    if isinstance(a, str) or isinstance(b, str):
+        return isinstance(a, str) and isinstance(b, str)
+    if a == b:
+        return True
+    if a != a and b != b:  # both nan
+        return True
+    try:
+        return abs(a - b) <= 1e-9 * max(abs(a), abs(b)) + 1e-12
+    except (OverflowError, TypeError):
+        return False
+
+
+class Disagreement:
+    def __init__(self, expression: str, minimized: str, outcomes: Dict[str, object]):
+        self.expression = expression
+        self.minimized = minimized
+        self.outcomes = outcomes
+
+    def __repr__(self):
+        return f'Disagreement({self.minimized!r}, {self.outcomes})'
+
+
+class Report:
+    def __init__(self):
+        self.checked = 0
+        self.disagreements: List[Disagreement] = []
+        self.timings: Dict[str, List[float]] = {}  # name -> [seconds, expressions]
+
+    def summary(self) -> str:
+        lines = [f'{self.checked} expressions checked, {len(self.disagreements)} disagreements']
+        for name, (seconds, count) in self.timings.items():
+            per_call = seconds / count * 1e6 if count else 0.0
+            lines.append(f'  {name:<12} {count:>7} expressions {seconds:9.4f}s {per_call:8.2f}us/expr')
+        for d in self.disagreements:
+            lines.append(f'  {d.minimized!r} (from {d.expression!r}): {d.outcomes}')
+        return '\n'.join(lines)
+
+
+def disagreeing(engines: List[Engine], expression: str) -> Optional[Dict[str, object]]:
+    """Outcomes per engine when at least two engines that support the expression disagree."""
+    features = features_of(expression)
+    participants = [e for e in engines if e.supports(features)]
+    if len(participants) < 2:
+        return None
+    outcomes = {e.name: outcome(e, expression) for e in participants}
+    reference = outcomes[participants[0].name]
+    if all(same_outcome(reference, value) for value in outcomes.values()):
+        return None
+    return outcomes
+
+
+def minimize(tree: tuple, interesting: Callable[[tuple], bool]) -> tuple:
+    """Greedy shrinking: keep replacing subtrees with a child or a literal while still interesting."""
+    changed = True
+    while changed:
+        changed = False
+        for candidate in _shrinks(tree):
+            if cost(candidate) < cost(tree) and interesting(candidate):
+                tree = candidate
+                changed = True
+                break
+    return tree
+
+
+def _shrinks(tree: tuple):
+    kind = tree[0]
+    if kind == 'num':
+        for literal in ('0', '1', '2'):
+            if literal != tree[1]:
+                yield ('num', literal)
+        return
+    for child in tree[1:]:
+        if isinstance(child, tuple):
+            yield child
+    # shrink inside the children, keeping this node
+    for index, child in enumerate(tree):
+        if isinstance(child, tuple):
+            for smaller in _shrinks(child):
+                yield tree[:index] + (smaller,) + tree[index + 1:]
+
+
+def run(count: int = 1000, seed: int = 0, max_depth: int = 4,
+        engines: Optional[List[Engine]] = None) -> Report:
+    engines = engines if engines is not None else default_engines()
+    generator = Generator(seed, max_depth)
+    trees = [generator.tree() for _ in range(count)]
+    corpus = [render(t) for t in trees]
+    report = Report()
+    report.checked = len(corpus)
+
+    # timing pass: every engine on every expression of the shared corpus it supports
+    for engine in engines:
+        supported = [e for e in corpus if engine.supports(features_of(e))]
+        start = time.perf_counter()
+        for expression in supported:
+            outcome(engine, expression)
+        report.timings[engine.name] = [time.perf_counter() - start, len(supported)]
+
+    seen = set()
+    for tree, expression in zip(trees, corpus):
+        outcomes = disagreeing(engines, expression)
+        if outcomes is None:
+            continue
+        small = minimize(tree, lambda t: disagreeing(engines, render(t)) is not None)
+        text = render(small)
+        # one report per bug shape: '4-1' and '2-1' are the same chatv2 failure
+        shape = re.sub(r'\d+(\.\d+)?', 'n', text)
+        if shape in seen:
+            continue
+        seen.add(shape)
+        report.disagreements.append(Disagreement(expression, text, disagreeing(engines, text)))
+    return report
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Differential check of all calculator engines')
+    arg_parser.add_argument('--count', type=int, default=2000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--depth', type=int, default=4)
+    args = arg_parser.parse_args()
+    print(run(args.count, args.seed, args.depth).summary())
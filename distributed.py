@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bytecode import dumps, loads
+from outofcore import DEFAULT_CHUNK_ROWS, evaluate_chunks, slices
+
+# rows per shard: big enough that a round trip is small next to the evaluation
+DEFAULT_SHARD_ROWS = 1 << 20
+
+Address = Tuple[str, int]
+
+
+# -------------------------------
+# Wire format
+# -------------------------------
+# Every message is a frame: u32 header length, u32 payload length (little-endian), a
+# JSON header, then the payload bytes. Arrays travel as little-endian float64.
+#   program  coordinator -> worker  payload: the expression as bytecode.dumps() output
+#   task     coordinator -> worker  {shard, rows, variables} and the columns one after the
+#                                   other in the payload, or {shard, inputs, start, stop}
+#                                   with .npy paths the worker memory-maps itself
+#   result   worker -> coordinator  {shard}, payload: the shard's output
+#   error    worker -> coordinator  {shard, error, message}: evaluating the shard raised
+
+_FRAME = struct.Struct('<II')
+
+
+def _send(sock: socket.socket, header: dict, payloads=()):
+    encoded = json.dumps(header).encode()
+    sock.sendall(_FRAME.pack(len(encoded), sum(len(payload) for payload in payloads)) + encoded)
+    for payload in payloads:
+        sock.sendall(payload)
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytearray:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed mid-frame")
+        received += count
+    return data
+
+
+def _receive(sock: socket.socket) -> Tuple[dict, bytearray]:
+    header_size, payload_size = _FRAME.unpack(_receive_exactly(sock, _FRAME.size))
+    header = json.loads(_receive_exactly(sock, header_size))
+    return header, _receive_exactly(sock, payload_size)
+
+
+def _float64(values: np.ndarray) -> memoryview:
+    return memoryview(np.ascontiguousarray(values, dtype='<f8')).cast('B')
+
+
+# -------------------------------
+# Worker
+# -------------------------------
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        program = None
+        while True:
+            try:
+                header, payload = _receive(sock)
+            except (ConnectionError, OSError):
+                return
+            if header['type'] == 'program':
+                program = loads(bytes(payload)).program()
+                continue
+            try:
+                out = self._evaluate(program, header, payload)
+            except Exception as e:
+                _send(sock, {'type': 'error', 'shard': header['shard'], 'error': type(e).__name__,
+                             'message': str(e)})
+                continue
+            try:
+                _send(sock, {'type': 'result', 'shard': header['shard']}, [_float64(out)])
+            except OSError:
+                return  # the coordinator hung up, e.g. on a backup copy it no longer needs
+
+    @staticmethod
+    def _evaluate(program, header: dict, payload: bytearray) -> np.ndarray:
+        if header.get('inputs') is not None:
+            start, stop = header['start'], header['stop']
+            columns = {name: np.load(path, mmap_mode='r')[start:stop] for name, path in header['inputs'].items()}
+            rows = stop - start
+        else:
+            rows = header['rows']
+            values = np.frombuffer(payload, dtype='<f8').reshape(len(header['variables']), rows)
+            columns = dict(zip(header['variables'], values))
+        out = np.empty(rows)
+        evaluate_chunks(program, slices(columns, rows, DEFAULT_CHUNK_ROWS), out)
+        return out
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    """
+    A worker: evaluates the shards that coordinators send it, one thread per
+    connection. Run one per host (or several on one host) with
+    `python distributed.py worker --host 0.0.0.0 --port 9000`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Address = ('127.0.0.1', 0)):
+        super().__init__(address, _WorkerHandler)
+
+
+# -------------------------------
+# Coordinator
+# -------------------------------
+
+class ShardFailed(RuntimeError):
+    pass
+
+
+class _Job:
+    """Shard bookkeeping shared by the connection threads of one evaluate call."""
+
+    def __init__(self, bounds: List[Tuple[int, int]], out: np.ndarray, workers: int):
+        self.bounds = bounds
+        self.out = out
+        self.pending = deque(range(len(bounds)))
+        self.running: Dict[int, float] = {}  # shard -> start time of its first attempt
+        self.backed_up = set()
+        self.done = set()
+        self.durations: List[float] = []
+        self.alive = workers
+        self.error: Optional[BaseException] = None if workers else ShardFailed("No workers to run on")
+        self.resubmitted = 0
+        self.condition = threading.Condition()
+
+    def finished(self) -> bool:
+        return self.error is not None or len(self.done) == len(self.bounds)
+
+    def take(self) -> Optional[int]:
+        with self.condition:
+            if self.finished():
+                return None
+            if self.pending:
+                shard = self.pending.popleft()
+                self.running.setdefault(shard, time.perf_counter())
+                return shard
+            # nothing left to hand out: back up the straggler, if one runs much longer
+            # than shards usually take; whichever copy finishes first counts
+            if self.durations:
+                typical = sorted(self.durations)[len(self.durations) // 2]
+                now = time.perf_counter()
+                for shard, started in self.running.items():
+                    if shard not in self.backed_up and now - started > 2 * typical:
+                        self.backed_up.add(shard)
+                        return shard
+            return None
+
+    def complete(self, shard: int, payload: bytearray, seconds: float) -> bool:
+        """Store a shard's result; False if another copy of it finished first."""
+        with self.condition:
+            if shard in self.done or self.error is not None:
+                return False
+            start, stop = self.bounds[shard]
+            self.out[start:stop] = np.frombuffer(payload, dtype='<f8')
+            self.done.add(shard)
+            self.running.pop(shard, None)
+            self.durations.append(seconds)
+            self.condition.notify_all()
+            return True
+
+    def fail(self, error: BaseException):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def lost(self, shards):
+        """A worker went away: its shards go back to the front of the queue."""
+        with self.condition:
+            for shard in shards:
+                if shard not in self.done and shard not in self.pending:
+                    self.pending.appendleft(shard)
+                    self.resubmitted += 1
+            self.alive -= 1
+            if self.alive == 0 and not self.finished():
+                self.error = ShardFailed("Every worker failed or was unreachable")
+            self.condition.notify_all()
+
+
+# exceptions a worker reports by name are raised again as the same type
+_ERRORS = {error.__name__: error for error in (TypeError, ValueError, ZeroDivisionError, OverflowError,
+                                               NameError, FileNotFoundError)}
+
+
+class Coordinator:
+    """
+    Splits a batch into shards of `shard_rows` rows and evaluates them on workers over
+    TCP. Every worker gets a new shard as soon as it returns one (with `pipeline`
+    shards in flight to hide the round trip), so faster workers take more shards;
+    when the queue runs dry, a shard running for more than twice the median shard
+    time is sent again to an idle worker. Shards of a worker that fails, hangs past
+    `timeout` or cannot be reached are resubmitted to the others. An error raised by
+    the expression itself is raised again here, with its type.
+    """
+
+    def __init__(self, addresses: List[Address], shard_rows: int = DEFAULT_SHARD_ROWS, timeout: float = 60.0,
+                 pipeline: int = 2):
+        self.addresses = list(addresses)
+        self.shard_rows = shard_rows
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.shards_by_worker: Dict[Address, int] = {}
+        self.resubmitted = 0
+
+    def evaluate(self, expr, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        """Evaluate over in-memory columns; every shard's columns are sent to its worker."""
+        encoded = dumps(expr)
+        variables = list(loads(encoded).variables)
+        rows = len(columns[variables[0]]) if variables else 1
+
+        def task(shard: int, start: int, stop: int):
+            header = {'type': 'task', 'shard': shard, 'rows': stop - start, 'variables': variables}
+            return header, [_float64(columns[name][start:stop]) for name in variables]
+
+        return self._run(encoded, rows, task)
+
+    def evaluate_npy(self, expr, inputs: Dict[str, str]) -> np.ndarray:
+        """
+        Evaluate over .npy files, one per variable, that every worker can read at the
+        same paths (shared storage): only row ranges go over the network.
+        """
+        encoded = dumps(expr)
+        variables = loads(encoded).variables
+        inputs = {name: os.path.abspath(inputs[name]) for name in variables}
+        rows = len(np.load(inputs[variables[0]], mmap_mode='r')) if variables else 1
+
+        def task(shard: int, start: int, stop: int):
+            return {'type': 'task', 'shard': shard, 'inputs': inputs, 'start': start, 'stop': stop}, []
+
+        return self._run(encoded, rows, task)
+
+    def _run(self, encoded: bytes, rows: int, task) -> np.ndarray:
+        out = np.empty(rows)
+        bounds = [(start, min(start + self.shard_rows, rows)) for start in range(0, rows, self.shard_rows)]
+        job = _Job(bounds, out, len(self.addresses))
+        sockets: List[socket.socket] = []
+        threads = [threading.Thread(target=self._drive, args=(address, job, encoded, task, sockets), daemon=True)
+                   for address in self.addresses]
+        for thread in threads:
+            thread.start()
+        with job.condition:
+            job.condition.wait_for(job.finished)
+        # threads still waiting on a backed-up straggler are woken by closing their sockets
+        for sock in list(sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in threads:
+            thread.join()
+        self.resubmitted += job.resubmitted
+        if job.error is not None:
+            raise job.error
+        return out
+
+    def _drive(self, address: Address, job: _Job, encoded: bytes, task, sockets: List[socket.socket]):
+        in_flight = deque()
+        try:
+            sock = socket.create_connection(address, timeout=self.timeout)
+        except OSError:
+            job.lost([])
+            return
+        sockets.append(sock)
+        with sock:
+            try:
+                _send(sock, {'type': 'program'}, [encoded])
+                while True:
+                    while len(in_flight) < self.pipeline:
+                        shard = job.take()
+                        if shard is None:
+                            break
+                        header, payloads = task(shard, *job.bounds[shard])
+                        _send(sock, header, payloads)
+                        in_flight.append((shard, time.perf_counter()))
+                    if not in_flight:
+                        if job.finished():
+                            return
+                        # only backed-up stragglers are left; look again shortly
+                        with job.condition:
+                            job.condition.wait(0.01)
+                        continue
+                    header, payload = _receive(sock)
+                    shard, sent = in_flight.popleft()
+                    if header['type'] == 'error':
+                        job.fail(_ERRORS.get(header['error'], ShardFailed)(header['message']))
+                        return
+                    # the condition's lock also guards shards_by_worker, shared by every connection thread
+                    with job.condition:
+                        if job.complete(shard, payload, time.perf_counter() - sent):
+                            self.shards_by_worker[address] = self.shards_by_worker.get(address, 0) + 1
+            except Exception:
+                # connection lost, timed out, a garbled frame: whatever it was, this worker is out
+                if not job.finished():
+                    job.lost([shard for shard, _ in in_flight])
+
+
+# -------------------------------
+# Local workers, for tests and the scaling benchmark
+# -------------------------------
+
+class LocalCluster:
+    """`count` worker processes on localhost; terminated on close()."""
+
+    def __init__(self, count: int):
+        self.processes = []
+        self.addresses: List[Address] = []
+        try:
+            for _ in range(count):
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--port', '0'],
+                                           stdout=subprocess.PIPE, text=True)
+                self.processes.append(process)
+                host, port = process.stdout.readline().split()[-1].rsplit(':', 1)
+                self.addresses.append((host, int(port)))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+            process.wait()
+        self.processes = []
+
+    def __enter__(self) -> 'LocalCluster':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+BENCH_EXPRESSION = '(x * 1.5 + y ^ 2) @ (x $ z) - ~y % 7 + (x / 4)!'
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Distributed batch evaluation')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    worker = commands.add_parser('worker', help='serve shards to coordinators')
+    worker.add_argument('--host', default='127.0.0.1')
+    worker.add_argument('--port', type=int, default=9000)
+    bench = commands.add_parser('bench', help='localhost scaling benchmark')
+    bench.add_argument('--rows', type=int, default=8_000_000)
+    bench.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    bench.add_argument('--shard-rows', type=int, default=1 << 18)
+    args = arg_parser.parse_args()
+    if args.command == 'worker':
+        with WorkerServer((args.host, args.port)) as server:
+            host, port = server.server_address[:2]
+            print(f'worker listening on {host}:{port}', flush=True)
+            server.serve_forever()
+    else:
+        from outofcore import evaluate_columns_chunked
+        rng = np.random.default_rng(0)
+        columns = {name: rng.uniform(1, 10, args.rows) for name in 'xyz'}
+        start = time.perf_counter()
+        expected = evaluate_columns_chunked(BENCH_EXPRESSION, columns)
+        single = time.perf_counter() - start
+        print(f'{args.rows} rows, {os.cpu_count()} cores, chunked in-process evaluation {single * 1e3:.0f}ms')
+        with tempfile.TemporaryDirectory() as directory:
+            inputs = {}
+            for name, column in columns.items():
+                inputs[name] = os.path.join(directory, name + '.npy')
+                np.save(inputs[name], column)
+            for count in args.workers:
+                with LocalCluster(count) as cluster:
+                    coordinator = Coordinator(cluster.addresses, shard_rows=args.shard_rows)
+                    timings = {}
+                    for mode in ('columns', 'npy'):
+                        start = time.perf_counter()
+                        result = coordinator.evaluate(BENCH_EXPRESSION, columns) if mode == 'columns' else \
+                            coordinator.evaluate_npy(BENCH_EXPRESSION, inputs)
+                        timings[mode] = time.perf_counter() - start
+                        assert np.array_equal(result, expected)
+                shards = sorted(coordinator.shards_by_worker.values())
+                print(f'{count:>3} workers: shipped columns {timings["columns"] * 1e3:8.0f}ms '
+                      f'({single / timings["columns"]:4.1f}x), shared .npy ranges {timings["npy"] * 1e3:8.0f}ms '
+                      f'({single / timings["npy"]:4.1f}x), shards per worker {shards[0]}-{shards[-1]}')
@@ -0,0 +1,181 @@
+import json
+import time
+from typing import List, Optional, Union
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode, \
+    WindowNode
+from vectorized import kernel, reduce_operands, evaluate_array, pending_rows, rolling
+
+
+# -------------------------------
+# Per-node execution profile
+# -------------------------------
+
+class NodeProfile:
+    """One AST node with what profiling measured for it. Times are in seconds, summed over all calls."""
+
+    def __init__(self, node: Node, children: List['NodeProfile']):
+        self.node = node
+        self.children = children
+        self.calls = 0
+        self.inclusive = 0.0
+        self.magnitude: Optional[float] = None
+        self.allocated = 0  # bytes of the arrays this node produced, vectorized mode only
+
+    @property
+    def exclusive(self) -> float:
+        return self.inclusive - sum(child.inclusive for child in self.children)
+
+    @property
+    def label(self) -> str:
+        node = self.node
+        if isinstance(node, NumberNode):
+            return f'Number {node.value!r}'
+        if isinstance(node, VariableNode):
+            return f'Variable {node.name}'
+        if isinstance(node, NaryOpNode):
+            return f"NaryOp {type(node.op).__name__} '{node.op.symbol}' x{len(node.children)}"
+        if isinstance(node, WindowNode):
+            return f"Window {node.name} {type(node.op).__name__} '{node.op.symbol}' size={node.size}"
+        kind = 'UnaryOp' if isinstance(node, UnaryOpNode) else 'LogicalOp' if isinstance(node, LogicalOpNode) \
+            else 'BinaryOp'
+        return f"{kind} {type(node.op).__name__} '{node.op.symbol}'"
+
+    def to_dict(self, analyze: bool = True) -> dict:
+        result = {'node': self.label}
+        if isinstance(self.node, (UnaryOpNode, BinaryOpNode, NaryOpNode, WindowNode)):
+            result['operator'] = self.node.op.symbol
+        if analyze:
+            result.update(calls=self.calls, inclusive_us=self.inclusive * 1e6, exclusive_us=self.exclusive * 1e6,
+                          magnitude=self.magnitude, allocated_bytes=self.allocated)
+        result['children'] = [child.to_dict(analyze) for child in self.children]
+        return result
+
+
+def _children(node: Node) -> List[Node]:
+    if isinstance(node, (UnaryOpNode, WindowNode)):
+        return [node.child]
+    if isinstance(node, BinaryOpNode):
+        return [node.left, node.right]
+    if isinstance(node, NaryOpNode):
+        return node.children
+    return []
+
+
+def build_profile(node: Node) -> NodeProfile:
+    return NodeProfile(node, [build_profile(child) for child in _children(node)])
+
+
+def _run(profile: NodeProfile, variables: dict, vectorized: bool):
+    """Evaluate like Node.evaluate, timing every node on the way. Only used when profiling."""
+    start = time.perf_counter()
+    node = profile.node
+    if isinstance(node, LogicalOpNode):
+        # the right operand's calls count only the evaluations the short circuit did not skip
+        left = _run(profile.children[0], variables, vectorized)
+        if vectorized:
+            if np.all(pending_rows(node.op, left)):
+                value = kernel(node.op)(left, _run(profile.children[1], variables, vectorized))
+            else:
+                # some rows are decided: evaluate_array runs the right operand on the others only
+                value = evaluate_array(node, **variables)
+            profile.allocated += getattr(value, 'nbytes', 0)
+        else:
+            value = node.op.decided_by(left)
+            if value is None:
+                value = node.op.evaluate(left, _run(profile.children[1], variables, vectorized))
+    elif isinstance(node, (UnaryOpNode, BinaryOpNode)):
+        args = [_run(child, variables, vectorized) for child in profile.children]
+        if vectorized:
+            value = kernel(node.op)(*args)
+            profile.allocated += getattr(value, 'nbytes', 0)
+        else:
+            value = node.op.evaluate(*args)
+    elif isinstance(node, NaryOpNode):
+        args = [_run(child, variables, vectorized) for child in profile.children]
+        if vectorized:
+            value = reduce_operands(node.op, args)
+            profile.allocated += getattr(value, 'nbytes', 0)
+        else:
+            value = node.op.reduce(args)
+    elif isinstance(node, WindowNode):
+        child = _run(profile.children[0], variables, vectorized)
+        if vectorized and np.ndim(child):
+            value = rolling(node.op, child, node.size)
+            profile.allocated += value.nbytes
+        else:
+            # a single evaluation is a series of one sample
+            value = child
+    elif vectorized:
+        value = evaluate_array(node, **variables)
+    else:
+        value = node.evaluate(variables)
+    profile.inclusive += time.perf_counter() - start
+    profile.calls += 1
+    if vectorized:
+        profile.magnitude = float(np.max(np.abs(value))) if np.size(value) else 0.0
+    else:
+        profile.magnitude = abs(value)
+    return value
+
+
+def profile_expression(expr: Union[str, Node], repeat: int = 1, vectorized: bool = False,
+                       **variables) -> NodeProfile:
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    profile = build_profile(node)
+    for _ in range(repeat):
+        _run(profile, variables, vectorized)
+    return profile
+
+
+# -------------------------------
+# Rendering
+# -------------------------------
+
+def _format_time(seconds: float) -> str:
+    return f'{seconds * 1e3:.3f}ms' if seconds >= 1e-3 else f'{seconds * 1e6:.2f}us'
+
+
+def _text(profile: NodeProfile, analyze: bool, vectorized: bool, prefix: str = '', last: bool = True,
+          root: bool = True) -> List[str]:
+    line = profile.label
+    if analyze:
+        # a node that a short circuit always skipped has no result
+        magnitude = 'n/a' if profile.magnitude is None else f'{profile.magnitude:.6g}'
+        line += (f'  (calls={profile.calls} incl={_format_time(profile.inclusive)} '
+                 f'excl={_format_time(profile.exclusive)} |result|={magnitude}')
+        if vectorized:
+            line += f' alloc={profile.allocated}B'
+        line += ')'
+    lines = [line if root else prefix + ('└─ ' if last else '├─ ') + line]
+    child_prefix = '' if root else prefix + ('   ' if last else '│  ')
+    for i, child in enumerate(profile.children):
+        lines.extend(_text(child, analyze, vectorized, child_prefix, i == len(profile.children) - 1, False))
+    return lines
+
+
+def explain(expr: Union[str, Node], analyze: bool = False, format: str = 'text', repeat: int = 1,
+            vectorized: bool = False, **variables) -> str:
+    """
+    The parsed tree of `expr`, like SQL's EXPLAIN. With analyze=True the expression is
+    evaluated `repeat` times (over arrays when vectorized=True) and every node shows its
+    call count, inclusive and exclusive time, result magnitude and, for arrays, the
+    bytes it allocated. format is 'text' or 'json'.
+    """
+    if analyze:
+        profile = profile_expression(expr, repeat, vectorized, **variables)
+    else:
+        profile = build_profile(Calculator().parse(expr) if isinstance(expr, str) else expr)
+    if format == 'json':
+        return json.dumps(profile.to_dict(analyze), indent=2)
+    if format != 'text':
+        raise ValueError(f"Unknown explain format: {format}")
+    return '\n'.join(_text(profile, analyze, vectorized))
+
+
+if __name__ == '__main__':
+    print(explain('7!*(-50 + x * 8) - 20 - ~50', analyze=True, repeat=1000, x=95))
+    print(explain('(x * 1.5 + y ^ 2) @ (x $ y)', analyze=True, vectorized=True,
+                  x=np.linspace(1, 2, 100000), y=np.linspace(2, 3, 100000)))
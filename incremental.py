@@ -0,0 +1,357 @@
+import bisect
+import sys
+import time
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, WindowNode, \
+    WINDOWS, binary_node, iter_token_spans, lowest_precedence
+
+
+# -------------------------------
+# Parse memo
+# -------------------------------
+
+class _Entry:
+    """
+    What parsing at one token index produced, with every position counted from that
+    index, so the entry needs no update when tokens before it are inserted or deleted.
+    `reach` is the last token the parse looked at (the lookahead that stopped it), so
+    the entry stays valid as long as no edit touches tokens start..start + reach.
+    `checkpoints` are the (position, left) states of the operator loop, so a parse that
+    crossed an edit can resume from the last state before it instead of from the start.
+    """
+    __slots__ = ('node', 'end', 'reach', 'checkpoints', 'complete')
+
+    def __init__(self, node: Optional[Node], end: int, reach: int, checkpoints: list, complete: bool = True):
+        self.node = node
+        self.end = end
+        self.reach = reach
+        self.checkpoints = checkpoints
+        self.complete = complete
+
+
+class Session:
+    """
+    An expression under live editing. edit() re-tokenizes only from the token before
+    the edit until the new tokens line up with the old ones again, then re-parses with
+    a memo keyed by token index, reusing every subtree whose tokens did not change.
+    Values are cached per node, so only the nodes on the edited path are re-evaluated.
+
+    Parsing and evaluation cost depends on the size of the edit (plus, for a long
+    operator chain, the part of the chain after the edit), wherever the edit is. The
+    bookkeeping is a gap buffer at the last edit: character offsets after it are kept
+    from the end of the text, and the memo is a list parallel to the tokens, so nothing
+    after an edit is rewritten. Editing somewhere else moves the gap, a pass over the
+    tokens in between.
+    """
+
+    def __init__(self, text: str = '', calculator: Optional[Calculator] = None, **variables: float):
+        self.operators = (calculator or Calculator()).operators
+        self.variables = variables
+        self.text = text
+        # (token, start, end); from `gap` on, start and end are counted from len(text)
+        self.tokens: List[Tuple[str, int, int]] = list(iter_token_spans(text))
+        self.texts = [t for t, _, _ in self.tokens]
+        self.gap = len(self.tokens)
+        # memo[i]: kind -> entry of the parses at token i; reached[i]: the (slot, kind, entry)
+        # of entries that looked up to token i. Both have a slot for the end of input too.
+        self.memo: List[Dict[object, _Entry]] = [{} for _ in range(len(self.tokens) + 1)]
+        self.reached: List[list] = [[] for _ in range(len(self.tokens) + 1)]
+        # entry -> (start, kind) of the entries that start before the gap and reach past it
+        self.spanning: Dict[_Entry, tuple] = {}
+        self.values = weakref.WeakKeyDictionary()
+        self.tree: Optional[Node] = None
+        self.error: Optional[Exception] = None
+        self._reparse()
+
+    # ---- editing ----
+
+    def edit(self, offset: int, delete: int, insert: str = '') -> 'Session':
+        if not 0 <= offset <= offset + delete <= len(self.text):
+            raise ValueError(f"Edit {offset}+{delete} is outside the text of length {len(self.text)}")
+        text = self.text[:offset] + insert + self.text[offset + delete:]
+        # restart one token before the first token the edit touches: a number or name
+        # ending before the edit can still absorb inserted characters across spaces
+        first = max(self._token_at(offset) - 1, 0)
+        self._move_gap(first)
+        old = self.tokens
+        length = len(self.text)
+        position = old[first][1] + length if first > 0 else 0
+        previous = old[first - 1][0] if first > 0 else None
+
+        fresh = []
+        resume = first
+        edit_end = offset + len(insert)
+        synced = len(old)
+        for token in iter_token_spans(text, position, previous):
+            if token[1] >= edit_end:
+                # the first old token that sits after the edited range on the same text;
+                # both are counted from the end of their text
+                start = token[1] - len(text)
+                while resume < len(old) and old[resume][1] < start:
+                    resume += 1
+                if resume < len(old) and old[resume][1] == start and old[resume][0] == token[0]:
+                    synced = resume
+                    break
+            fresh.append(token)
+        # the restart token usually comes out unchanged; it does not count as edited
+        kept = 0
+        while kept < len(fresh) and first + kept < synced and \
+                (fresh[kept][0], fresh[kept][1] - length, fresh[kept][2] - length) == old[first + kept]:
+            kept += 1
+        first += kept
+        fresh = fresh[kept:]
+        self._move_gap(first)
+        self._forget(first, synced)
+        old[first:synced] = [(t, start - len(text), end - len(text)) for t, start, end in fresh]
+        self.texts[first:synced] = [t for t, _, _ in fresh]
+        self.memo[first:synced] = [{} for _ in fresh]
+        self.reached[first:synced] = [[] for _ in fresh]
+        self.text = text
+        self._reparse()
+        return self
+
+    def insert(self, offset: int, text: str) -> 'Session':
+        return self.edit(offset, 0, text)
+
+    def delete(self, offset: int, length: int) -> 'Session':
+        return self.edit(offset, length)
+
+    def _token_at(self, offset: int) -> int:
+        """The index of the first token that ends at or after `offset`."""
+        tokens, gap = self.tokens, self.gap
+        if gap and tokens[gap - 1][2] >= offset:
+            return bisect.bisect_left(tokens, offset, 0, gap, key=lambda token: token[2])
+        return bisect.bisect_left(tokens, offset - len(self.text), gap, len(tokens), key=lambda token: token[2])
+
+    def _store(self, pos: int, kind, entry: _Entry):
+        slot = self.memo[pos]
+        slot[kind] = entry
+        reach = pos + entry.reach
+        reached = self.reached[reach]
+        if len(reached) > 16:
+            # overwritten entries leave their records behind; drop them now and then
+            reached[:] = [record for record in reached if record[0].get(record[1]) is record[2]]
+        reached.append((slot, kind, entry))
+        if pos < self.gap <= reach:
+            self.spanning[entry] = (pos, kind)
+
+    def _move_gap(self, gap: int):
+        old, length = self.gap, len(self.text)
+        tokens, memo, spanning = self.tokens, self.memo, self.spanning
+        if gap > old:
+            for i in range(old, gap):
+                t, start, end = tokens[i]
+                tokens[i] = (t, start + length, end + length)
+            for entry, (start, kind) in list(spanning.items()):
+                if start + entry.reach < gap or memo[start].get(kind) is not entry:
+                    del spanning[entry]
+            for pos in range(old, gap):
+                for kind, entry in memo[pos].items():
+                    if pos + entry.reach >= gap:
+                        spanning[entry] = (pos, kind)
+        elif gap < old:
+            for i in range(gap, old):
+                t, start, end = tokens[i]
+                tokens[i] = (t, start - length, end - length)
+                for entry in memo[i].values():
+                    spanning.pop(entry, None)
+            for reach in range(gap, old):
+                for slot, kind, entry in self.reached[reach]:
+                    start = reach - entry.reach
+                    if start < gap and slot.get(kind) is entry and memo[start] is slot:
+                        spanning[entry] = (start, kind)
+        self.gap = gap
+
+    def _forget(self, first: int, stop: int):
+        """
+        Old tokens [first, stop) are about to be replaced, with the gap at `first`. Entries
+        that start among them are dropped, and entries that start before and reach into or
+        past them are cut back to their checkpoints before `first` (dropped when there are
+        none); entries after them keep their relative positions and stay put.
+        """
+        for slot in self.memo[first:stop]:
+            slot.clear()
+        spanning, self.spanning = self.spanning, {}
+        for entry, (start, kind) in spanning.items():
+            slot = self.memo[start]
+            if slot.get(kind) is not entry:
+                continue
+            del slot[kind]
+            if kind != 'primary':
+                # crosses the edit: keep the loop states that were decided before it
+                checkpoints = entry.checkpoints
+                del checkpoints[bisect.bisect_left(checkpoints, first - start, key=lambda c: c[0]):]
+                if checkpoints:
+                    self._store(start, kind, _Entry(None, 0, checkpoints[-1][0], checkpoints, complete=False))
+
+    # ---- parsing (same grammar and decisions as chatv3.parse_tokens) ----
+
+    def _reparse(self):
+        try:
+            self.tree = self._expression(0, lowest_precedence(self.operators))[0]
+            self.error = None
+        except Exception as e:
+            self.tree = None
+            self.error = e
+
+    def _current(self, pos: int):
+        return self.texts[pos] if pos < len(self.texts) else None
+
+    def _is_postfix(self, token) -> bool:
+        return token in self.operators and self.operators[token].arity == 1 and token == '!'
+
+    def _primary(self, pos: int) -> Tuple[Node, int]:
+        entry = self.memo[pos].get('primary')
+        if entry is not None:
+            return entry.node, pos + entry.end
+        token = self._current(pos)
+        if token is None:
+            raise Exception('Unexpected end of input')
+        if token == '(':
+            node, end = self._expression(pos + 1, lowest_precedence(self.operators))
+            if self._current(end) != ')':
+                raise Exception('Missing closing parenthesis')
+            end += 1
+        elif token in self.operators and self.operators[token].arity == 1 and token not in ['!']:
+            op = self.operators[token]
+            child, end = self._expression(pos + 1, op.precedence)
+            node = UnaryOpNode(op, child)
+        elif token in WINDOWS and self._current(pos + 1) == '(':
+            child, end = self._expression(pos + 2, lowest_precedence(self.operators))
+            if self._current(end) != ',':
+                raise Exception('Missing comma')
+            size = self._current(end + 1)
+            if size is None:
+                raise Exception('Unexpected end of input')
+            if not size.isdecimal() or int(size) == 0:
+                raise Exception(f'Invalid window size: {size}')
+            if self._current(end + 2) != ')':
+                raise Exception('Missing closing parenthesis')
+            node, end = WindowNode(token, WINDOWS[token], child, int(size)), end + 3
+        elif token.isidentifier():
+            node, end = VariableNode(token), pos + 1
+        else:
+            try:
+                node, end = NumberNode(float(token)), pos + 1
+            except ValueError:
+                raise Exception(f'Invalid token: {token}')
+        # a prefix operator's operand stopped on a lookahead token it did not consume, and a
+        # variable named like a window function looked at the token after it for a '('
+        lookahead = isinstance(node, UnaryOpNode) or isinstance(node, VariableNode) and token in WINDOWS
+        reach = end if lookahead and token != '(' else end - 1
+        self._store(pos, 'primary', _Entry(node, end - pos, reach - pos, []))
+        return node, end
+
+    def _expression(self, start: int, min_prec: int) -> Tuple[Node, int]:
+        entry = self.memo[start].get(min_prec)
+        if entry is not None and entry.complete:
+            return entry.node, start + entry.end
+        if entry is not None:
+            checkpoints = entry.checkpoints
+            pos, left = checkpoints[-1]
+            pos += start
+        else:
+            left, pos = self._primary(start)
+            while self._is_postfix(self._current(pos)):
+                left = UnaryOpNode(self.operators['!'], left)
+                pos += 1
+            checkpoints = [(pos - start, left)]
+        resumed = len(checkpoints)
+        try:
+            left, pos = self._operator_loop(start, min_prec, left, pos, checkpoints)
+        except Exception:
+            # a partial entry shares this list; leave it as it was
+            del checkpoints[resumed:]
+            raise
+        self._store(start, min_prec, _Entry(left, pos - start, pos - start, checkpoints))
+        return left, pos
+
+    def _operator_loop(self, start: int, min_prec: int, left: Node, pos: int, checkpoints: list) -> Tuple[Node, int]:
+        while True:
+            token = self._current(pos)
+            if token is None or token not in self.operators or self.operators[token].arity != 2:
+                break
+            op = self.operators[token]
+            if op.precedence < min_prec:
+                break
+            next_min = op.precedence if op.right_association else op.precedence + 1
+            right, pos = self._expression(pos + 1, next_min)
+            left = binary_node(op, left, right)
+            while self._is_postfix(self._current(pos)):
+                left = UnaryOpNode(self.operators['!'], left)
+                pos += 1
+            checkpoints.append((pos - start, left))
+        return left, pos
+
+    # ---- evaluation ----
+
+    def set_variables(self, **variables: float):
+        self.variables = variables
+        self.values = weakref.WeakKeyDictionary()
+
+    def _value(self, node: Node) -> float:
+        value = self.values.get(node)
+        if value is not None:
+            return value
+        if isinstance(node, UnaryOpNode):
+            value = node.op.evaluate(self._value(node.child))
+        elif isinstance(node, LogicalOpNode):
+            left = self._value(node.left)
+            value = node.op.decided_by(left)
+            if value is None:
+                value = node.op.evaluate(left, self._value(node.right))
+        elif isinstance(node, BinaryOpNode):
+            value = node.op.evaluate(self._value(node.left), self._value(node.right))
+        else:
+            value = node.evaluate(self.variables)
+        self.values[node] = value
+        return value
+
+    @property
+    def value(self) -> float:
+        if self.error is not None:
+            raise self.error
+        return self._value(self.tree)
+
+
+# -------------------------------
+# Benchmark: latency per keystroke vs. full re-evaluation
+# -------------------------------
+
+if __name__ == '__main__':
+    # the tree of an n-term chain is n levels deep, for both evaluators
+    sys.setrecursionlimit(10000)
+    calculator = Calculator()
+    for terms in (100, 400, 1600):
+        text = '+'.join(f'({i}*3$2)' for i in range(terms))
+        # typing inside the first term, inside the middle one, and after the last
+        places = (('start', 1), ('middle', text.index(f'({terms // 2}*') + 1), ('end', len(text)))
+        for place, offset in places:
+            session = Session(text)
+            session.value  # the first evaluation fills the value cache
+            keystrokes = '7*2-1+' if place != 'end' else '+7*2-1'
+            latencies = []
+            for k, ch in enumerate(keystrokes):
+                start = time.perf_counter()
+                session.insert(offset + k, ch)
+                try:
+                    session.value
+                except Exception:
+                    pass  # half-typed expressions like '...+' do not parse
+                latencies.append(time.perf_counter() - start)
+            typed = text
+            start = time.perf_counter()
+            for k, ch in enumerate(keystrokes):
+                typed = typed[:offset + k] + ch + typed[offset + k:]
+                try:
+                    calculator.evaluate(typed)
+                except Exception:
+                    pass
+            full = (time.perf_counter() - start) / len(keystrokes)
+            assert session.value == calculator.evaluate(typed)
+            # the first keystroke also moves the gap there from the end of the text
+            print(f'{len(text):>6} chars, {place:<6}: incremental {latencies[0] * 1e3:7.3f}ms first keystroke, '
+                  f'{sum(latencies[1:]) / (len(latencies) - 1) * 1e3:7.3f}ms/keystroke after, '
+                  f'full re-evaluation {full * 1e3:7.3f}ms/keystroke')
@@ -0,0 +1,221 @@
+import math
+import time
+from functools import lru_cache
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, NaryOpNode, Factorial, \
+    Negative, Max, Min, Average, Modulo, Power, Multiply, Divide, Add, Subtract, Less, Greater, LessEqual, GreaterEqual, \
+    Equal, NotEqual, And, Or
+from compiler import Program, compile_node
+from vectorized import run_program
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+
+# -------------------------------
+# Scalar helpers shared by the generated code
+# -------------------------------
+# They raise what Operator.evaluate raises. Under Numba, x ** y and gamma return inf
+# instead of raising on overflow, so the helpers check for that themselves; an infinite
+# result is an overflow only when the operands were finite (inf! is inf, 0 ^ -inf is inf).
+
+def _factorial(x):
+    if x < 0:
+        raise ValueError("Factorial is only defined for non-negative numbers.")
+    result = math.gamma(x + 1)
+    if result == math.inf and x != math.inf:
+        raise OverflowError("math range error")
+    return result
+
+
+def _divide(x, y):
+    if y == 0:
+        raise TypeError("Division is only defined for non-zero numbers.")
+    return x / y
+
+
+def _modulo(x, y):
+    if y == 0:
+        raise ZeroDivisionError("float modulo")
+    return x % y
+
+
+def _power(x, y):
+    if x == 0 and y < 0 and y != -math.inf:
+        raise ZeroDivisionError("0.0 cannot be raised to a negative power")
+    result = x ** y
+    if abs(result) == math.inf and abs(x) != math.inf and abs(y) != math.inf:
+        raise OverflowError("Numerical result out of range")
+    return result
+
+
+HELPERS: Dict[str, Callable] = {
+    '_factorial': _factorial,
+    '_divide': _divide,
+    '_modulo': _modulo,
+    '_power': _power,
+}
+if NUMBA_AVAILABLE:
+    HELPERS = {name: numba.njit(helper) for name, helper in HELPERS.items()}
+
+# how every operator is written in the generated source, {0} and {1} are the operands
+TEMPLATES: Dict[type, str] = {
+    Factorial: '_factorial({0})',
+    Negative: '(-{0})',
+    Max: 'max({0}, {1})',
+    Min: 'min({0}, {1})',
+    Average: '(({0} + {1}) / 2)',
+    Modulo: '_modulo({0}, {1})',
+    Power: '_power({0}, {1})',
+    Multiply: '({0} * {1})',
+    Divide: '_divide({0}, {1})',
+    Add: '({0} + {1})',
+    Subtract: '({0} - {1})',
+    Less: '(1.0 if {0} < {1} else 0.0)',
+    Greater: '(1.0 if {0} > {1} else 0.0)',
+    LessEqual: '(1.0 if {0} <= {1} else 0.0)',
+    GreaterEqual: '(1.0 if {0} >= {1} else 0.0)',
+    Equal: '(1.0 if {0} == {1} else 0.0)',
+    NotEqual: '(1.0 if {0} != {1} else 0.0)',
+    # Python's and / or short-circuit, so the generated code does too
+    And: '(1.0 if {0} and {1} else 0.0)',
+    Or: '(1.0 if {0} or {1} else 0.0)',
+}
+
+
+# -------------------------------
+# Code generation
+# -------------------------------
+
+def _source(node: Node, program: Program, constants: list, element: str) -> str:
+    """
+    One Python expression for the whole tree. Literals become globals c0, c1, ... (appended
+    to `constants`), variables the arguments v0, v1, ... indexed by `element` ('' or '[i]').
+    """
+    if isinstance(node, NumberNode):
+        constants.append(node.value)
+        return f'c{len(constants) - 1}'
+    if isinstance(node, VariableNode):
+        return f'v{program.variables.index(node.name)}{element}'
+    if isinstance(node, NaryOpNode):
+        # a left fold of the binary template; n-ary sums add left to right here, not with fsum
+        template = TEMPLATES.get(type(node.op))
+        if template is None:
+            raise TypeError(f"No JIT template for operator {node.op.symbol!r}")
+        source = _source(node.children[0], program, constants, element)
+        for child in node.children[1:]:
+            source = template.format(source, _source(child, program, constants, element))
+        return source
+    if isinstance(node, (UnaryOpNode, BinaryOpNode)):
+        template = TEMPLATES.get(type(node.op))
+        if template is None:
+            raise TypeError(f"No JIT template for operator {node.op.symbol!r}")
+        children = [node.child] if isinstance(node, UnaryOpNode) else [node.left, node.right]
+        return template.format(*(_source(child, program, constants, element) for child in children))
+    raise TypeError(f"Cannot compile node of type {type(node).__name__}")
+
+
+class JitKernel:
+    """
+    A chatv3 expression lowered to generated Python source: a scalar function and a
+    batch function that runs the whole expression in one loop over the input arrays,
+    without intermediate arrays. Both are compiled with numba.njit when Numba is
+    installed. Without Numba the scalar function still runs as plain Python and
+    batches fall back to the NumPy stack program.
+    """
+
+    def __init__(self, node: Node):
+        self.program = compile_node(node)
+        self.variables = self.program.variables
+        arguments = ', '.join(f'v{i}' for i in range(len(self.variables)))
+        constants = []
+        self.source = (
+            f'def scalar({arguments}):\n'
+            f'    return {_source(node, self.program, constants, "")}\n'
+            f'\n'
+            f'def batch(out{", " if arguments else ""}{arguments}):\n'
+            f'    for i in range(out.shape[0]):\n'
+            f'        out[i] = {_source(node, self.program, constants, "[i]")}\n'
+        )
+        namespace = dict(HELPERS, math=math)
+        namespace.update((f'c{i}', value) for i, value in enumerate(constants))
+        exec(compile(self.source, '<jit>', 'exec'), namespace)
+        if NUMBA_AVAILABLE:
+            self.scalar = numba.njit(namespace['scalar'])
+            self.batch: Optional[Callable] = numba.njit(namespace['batch'])
+        else:
+            self.scalar = namespace['scalar']
+            self.batch = None
+
+    def __call__(self, *args: float, **kwargs: float) -> float:
+        return self.scalar(*self.program.bind(args, kwargs))
+
+    def evaluate(self, columns: Dict[str, np.ndarray], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Evaluate over equally long 1-D columns."""
+        if out is None:
+            rows = len(columns[self.variables[0]]) if self.variables else 1
+            out = np.empty(rows)
+        if self.batch is None:
+            return run_program(self.program, columns, out)
+        self.batch(out, *(np.asarray(columns[name], dtype=np.float64) for name in self.variables))
+        return out
+
+
+@lru_cache(maxsize=256)
+def _cached(expression: str) -> JitKernel:
+    return JitKernel(Calculator().parse(expression))
+
+
+def jit(expr) -> JitKernel:
+    """The compiled kernel of a chatv3 expression; kernels of expression strings are cached."""
+    return _cached(expr) if isinstance(expr, str) else JitKernel(expr)
+
+
+# -------------------------------
+# Benchmark: JIT vs. NumPy vs. pure Python
+# -------------------------------
+
+if __name__ == '__main__':
+    from vectorized import evaluate_columns
+
+    expression = '(x * 1.5 + y ^ 2) @ (x $ z) - ~y % 7 / x'
+    print(f'Numba available: {NUMBA_AVAILABLE}')
+    calculator = Calculator()
+    node = calculator.parse(expression)
+    program = compile_node(node)
+    kernel = jit(expression)
+    values = {'x': 2.5, 'y': 3.5, 'z': 4.5}
+    for name, run in (('tree walk', lambda: node.evaluate(values)), ('stack program', lambda: program(**values)),
+                      ('jit scalar', lambda: kernel(**values))):
+        run()
+        start = time.perf_counter()
+        for _ in range(20000):
+            run()
+        print(f'{name:<14} {(time.perf_counter() - start) / 20000 * 1e6:8.3f}us per call')
+
+    rng = np.random.default_rng(0)
+    for rows in (10_000, 1_000_000):
+        columns = {name: rng.uniform(1, 10, rows) for name in 'xyz'}
+        kernel.evaluate(columns)  # compile outside the timing
+        start = time.perf_counter()
+        fused = kernel.evaluate(columns)
+        jitted = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = evaluate_columns(expression, columns)
+        numpy_time = time.perf_counter() - start
+        sample = min(rows, 10_000)
+        start = time.perf_counter()
+        for i in range(sample):
+            program(x=columns['x'][i], y=columns['y'][i], z=columns['z'][i])
+        python_time = (time.perf_counter() - start) * rows / sample
+        np.testing.assert_allclose(fused, expected)
+        backend = 'numba' if NUMBA_AVAILABLE else 'numpy fallback'
+        print(f'{rows:>9} rows: jit ({backend}) {rows / jitted / 1e6:8.2f}M rows/s, numpy {rows / numpy_time / 1e6:8.2f}M rows/s, '
+              f'pure Python {rows / python_time / 1e6:8.2f}M rows/s')
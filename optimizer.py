@@ -0,0 +1,362 @@
+import random
+import sys
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, Set, Tuple, Union
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, NaryOpNode, WindowNode, \
+    Multiply, Divide, Power, Subtract, Negative, Add, Average, Equal, NotEqual, Greater, GreaterEqual, OPERATORS, \
+    binary_node, parse_cached
+from compiler import Program, compile_node
+
+
+# -------------------------------
+# AST passes
+# -------------------------------
+
+def free_variables(node: Node) -> Set[str]:
+    if isinstance(node, VariableNode):
+        return {node.name}
+    if isinstance(node, (UnaryOpNode, WindowNode)):
+        return free_variables(node.child)
+    if isinstance(node, BinaryOpNode):
+        return free_variables(node.left) | free_variables(node.right)
+    if isinstance(node, NaryOpNode):
+        return set().union(*(free_variables(child) for child in node.children))
+    return set()
+
+
+def has_window(node: Node) -> bool:
+    """Whether the tree has a window function, and so a value that depends on the samples before."""
+    if isinstance(node, WindowNode):
+        return True
+    if isinstance(node, UnaryOpNode):
+        return has_window(node.child)
+    if isinstance(node, BinaryOpNode):
+        return has_window(node.left) or has_window(node.right)
+    if isinstance(node, NaryOpNode):
+        return any(has_window(child) for child in node.children)
+    return False
+
+
+def substitute(node: Node, bindings: dict) -> Node:
+    """A copy of the tree with every bound variable replaced by a NumberNode."""
+    if isinstance(node, VariableNode):
+        return NumberNode(bindings[node.name]) if node.name in bindings else node
+    if isinstance(node, UnaryOpNode):
+        return UnaryOpNode(node.op, substitute(node.child, bindings))
+    if isinstance(node, BinaryOpNode):
+        return binary_node(node.op, substitute(node.left, bindings), substitute(node.right, bindings))
+    if isinstance(node, NaryOpNode):
+        return NaryOpNode(node.op, [substitute(child, bindings) for child in node.children])
+    if isinstance(node, WindowNode):
+        return WindowNode(node.name, node.op, substitute(node.child, bindings), node.size)
+    return node
+
+
+def _is_number(node: Node, value: float) -> bool:
+    # 1 == 1.0 but -0.0 is not a neutral element for '-', so compare the representation too
+    return isinstance(node, NumberNode) and node.value == value and repr(float(node.value)) == repr(float(value))
+
+
+def fold_constants(node: Node) -> Node:
+    """
+    Evaluate every subtree without variables and apply the identities that are exact
+    in IEEE arithmetic (x*1, 1*x, x/1, x^1, x-0, ~~x). A subtree whose evaluation
+    raises is kept as is, so the error still happens when the expression is called.
+    A constant left operand that decides a && / || replaces it, right operand and all.
+    Windows are kept even over a constant: rsum(1, 3) still counts the samples.
+    """
+    if isinstance(node, UnaryOpNode):
+        child = fold_constants(node.child)
+        if isinstance(child, NumberNode):
+            try:
+                return NumberNode(node.op.evaluate(child.value))
+            except (ArithmeticError, ValueError, TypeError):
+                pass
+        if isinstance(node.op, Negative) and isinstance(child, UnaryOpNode) and isinstance(child.op, Negative):
+            return child.child
+        return UnaryOpNode(node.op, child)
+    if isinstance(node, BinaryOpNode):
+        left = fold_constants(node.left)
+        if node.op.short_circuit and isinstance(left, NumberNode):
+            decided = node.op.decided_by(left.value)
+            if decided is not None:
+                return NumberNode(decided)
+        right = fold_constants(node.right)
+        if isinstance(left, NumberNode) and isinstance(right, NumberNode):
+            try:
+                return NumberNode(node.op.evaluate(left.value, right.value))
+            except (ArithmeticError, ValueError, TypeError):
+                pass
+        if isinstance(node.op, (Multiply, Divide, Power)) and _is_number(right, 1):
+            return left
+        if isinstance(node.op, Multiply) and _is_number(left, 1):
+            return right
+        if isinstance(node.op, Subtract) and _is_number(right, 0):
+            return left
+        return binary_node(node.op, left, right)
+    if isinstance(node, NaryOpNode):
+        children = [fold_constants(child) for child in node.children]
+        if all(isinstance(child, NumberNode) for child in children):
+            try:
+                return NumberNode(node.op.reduce([child.value for child in children]))
+            except (ArithmeticError, ValueError, TypeError):
+                pass
+        return NaryOpNode(node.op, children)
+    if isinstance(node, WindowNode):
+        return WindowNode(node.name, node.op, fold_constants(node.child), node.size)
+    return node
+
+
+def flatten(node: Node) -> Node:
+    """
+    Collapse chains of one associative operator (+, *, @, &) into NaryOpNodes, so
+    `a+b+c+d` becomes one node with four children evaluated by a single reduction.
+    Only the left spine the parser builds is collapsed: a right operand with the same
+    operator was parenthesized, `a*(b*c)`, and stays one child, since regrouping changes
+    where floating point overflows and which operand of @ / & a nan meets.
+    Chains are walked in a loop: a long left-deep chain does not recurse.
+    Non-associative operators ($, -, /, ^, %) are left exactly as they are.
+    """
+    if isinstance(node, UnaryOpNode):
+        return UnaryOpNode(node.op, flatten(node.child))
+    if isinstance(node, (BinaryOpNode, NaryOpNode)) and node.op.associative:
+        operator_type = type(node.op)
+        # the right operands from the outermost in, then the start of the chain
+        rights = []
+        current = node
+        while isinstance(current, (BinaryOpNode, NaryOpNode)) and type(current.op) is operator_type:
+            if isinstance(current, BinaryOpNode):
+                rights.append(current.right)
+                current = current.left
+            else:
+                rights.extend(reversed(current.children[1:]))
+                current = current.children[0]
+        operands = [flatten(current)] + [flatten(right) for right in reversed(rights)]
+        return NaryOpNode(node.op, operands)
+    if isinstance(node, BinaryOpNode):
+        return binary_node(node.op, flatten(node.left), flatten(node.right))
+    if isinstance(node, WindowNode):
+        return WindowNode(node.name, node.op, flatten(node.child), node.size)
+    return node
+
+
+def specialize(expr: Union[str, Node], **fixed: float) -> Program:
+    """
+    Bind the known variables, fold what becomes constant and compile the residual.
+    The returned Program takes only the variables that were left free.
+    """
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    return compile_node(fold_constants(substitute(node, fixed)))
+
+
+# -------------------------------
+# Canonical form
+# -------------------------------
+# Spellings of one expression that evaluate exactly alike get one tree and one key.
+# Parentheses and literal spelling ('2', '2.0', '02.') are already gone from the AST.
+# On top of that:
+#   commutative  the operands of a binary +, *, $, == and != are sorted by their keys;
+#                a + b and b + a are the same IEEE operation
+#   mirrored     a > b becomes b < a, a >= b becomes b <= a
+#   literals     ~5 becomes the literal -5
+# Keys spell a number as '#' and its repr, a variable as '$' and its name: a variable
+# named inf or nan must not share a key with the literal.
+# Nothing is reassociated: (a + b) + c and a + (b + c) round differently, so they keep
+# different keys. @ and & are not reordered either: max/min return their first argument
+# when the operands are unordered (nan) or tie (0.0 and -0.0). Neither are NaryOpNode
+# children (prod() multiplies left to right), nor && / || (the right side may not run).
+# When both operands of a reordered operator raise, which exception surfaces may change.
+
+COMMUTATIVE = (Add, Multiply, Average, Equal, NotEqual)
+MIRRORED: Dict[type, str] = {Greater: '<', GreaterEqual: '<='}
+
+
+def _canonical(node: Node) -> Tuple[Node, str]:
+    if isinstance(node, NumberNode):
+        return node, f'#{node.value!r}'
+    if isinstance(node, VariableNode):
+        return node, f'${node.name}'
+    if isinstance(node, UnaryOpNode):
+        child, key = _canonical(node.child)
+        if isinstance(node.op, Negative) and isinstance(child, NumberNode) and isinstance(child.value, float):
+            literal = NumberNode(-child.value)
+            return literal, f'#{literal.value!r}'
+        return UnaryOpNode(node.op, child), f'({node.op.symbol} {key})'
+    if isinstance(node, BinaryOpNode):
+        (left, left_key), (right, right_key) = _canonical(node.left), _canonical(node.right)
+        op = node.op
+        if type(op) in MIRRORED:
+            op = OPERATORS[MIRRORED[type(op)]]
+            (left, left_key), (right, right_key) = (right, right_key), (left, left_key)
+        elif isinstance(op, COMMUTATIVE) and right_key < left_key:
+            (left, left_key), (right, right_key) = (right, right_key), (left, left_key)
+        return binary_node(op, left, right), f'({op.symbol} {left_key} {right_key})'
+    if isinstance(node, NaryOpNode):
+        children, keys = zip(*(_canonical(child) for child in node.children))
+        return NaryOpNode(node.op, list(children)), f'[{node.op.symbol} {" ".join(keys)}]'
+    if isinstance(node, WindowNode):
+        child, key = _canonical(node.child)
+        return WindowNode(node.name, node.op, child, node.size), f'({node.name}:{node.size} {key})'
+    raise TypeError(f"Cannot canonicalize node of type {type(node).__name__}")
+
+
+# the trees are never modified, so the canonical form of a text can be shared
+@lru_cache(maxsize=1024)
+def _canonical_text(expression: str) -> Tuple[Node, str]:
+    return _canonical(parse_cached(expression))
+
+
+def canonicalize(expr: Union[str, Node]) -> Node:
+    """A copy of the tree in canonical form; it evaluates exactly like the original."""
+    return _canonical(Calculator().parse(expr) if isinstance(expr, str) else expr)[0]
+
+
+def canonical_key(expr: Union[str, Node]) -> str:
+    """
+    A string that is equal for two expressions when their canonical trees are equal,
+    e.g. for 'b+a' and '(a + b)', or 'x > 2.0' and '2 < x'. Usable as a cache key.
+    """
+    return (_canonical_text(expr) if isinstance(expr, str) else _canonical(expr))[1]
+
+
+class CanonicalCache:
+    """
+    A bounded LRU cache of objects built by `factory` from the canonical tree, keyed
+    by canonical_key. Every spelling of an expression shares one entry. The variable
+    slots follow the canonical tree, so pass variables by name to what it returns.
+    """
+
+    def __init__(self, factory: Callable[[Node], object], maxsize: int = 1024):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, expr: Union[str, Node]):
+        node, key = _canonical_text(expr) if isinstance(expr, str) else _canonical(expr)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self._entries[key] = self.factory(node)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+
+# -------------------------------
+# Benchmarks: per-call cost of the full expression vs. the residual,
+# of long associative chains before and after flatten(), and cache hit rates by
+# expression text vs. by canonical key
+# -------------------------------
+
+def _spell(node: Node, rng: random.Random) -> str:
+    """One of the many ways to write `node`: operand order, literals, parentheses, spaces."""
+    if isinstance(node, NumberNode):
+        text = rng.choice([f'{node.value:g}', repr(node.value), f'{node.value:.2f}'])
+        return f'({text})' if node.value < 0 else text
+    if isinstance(node, VariableNode):
+        return node.name
+    if isinstance(node, UnaryOpNode):
+        child = _spell(node.child, rng)
+        return f'~({child})' if isinstance(node.op, Negative) else f'({child})!'
+    left, right = _spell(node.left, rng), _spell(node.right, rng)
+    symbol = node.op.symbol
+    if isinstance(node.op, COMMUTATIVE) and rng.random() < 0.5:
+        left, right = right, left
+    elif symbol in ('<', '<=') and rng.random() < 0.5:
+        left, right, symbol = right, left, {'<': '>', '<=': '>='}[symbol]
+    text = f'({left}{rng.choice(["", " "])}{symbol}{rng.choice(["", " "])}{right})'
+    return f'({text})' if rng.random() < 0.2 else text
+
+
+def _random_tree(rng: random.Random, depth: int) -> Node:
+    if depth == 0 or rng.random() < 0.25:
+        return VariableNode(rng.choice('xyz')) if rng.random() < 0.6 else NumberNode(float(rng.randrange(1, 10)))
+    symbol = rng.choice(['+', '+', '*', '*', '$', '-', '/', '^', '@', '<', '<=', '=='])
+    return binary_node(OPERATORS[symbol], _random_tree(rng, depth - 1), _random_tree(rng, depth - 1))
+
+
+def _outcome(node: Node, point: dict) -> str:
+    # repr, so nan equals nan and 0.0 differs from -0.0
+    try:
+        return repr(node.evaluate(point))
+    except (ArithmeticError, ValueError, TypeError):
+        return 'error'
+
+
+def _lru_hit_rate(keys, capacity: int) -> float:
+    cache: OrderedDict = OrderedDict()
+    hits = 0
+    for key in keys:
+        if key in cache:
+            cache.move_to_end(key)
+            hits += 1
+        else:
+            cache[key] = None
+            if len(cache) > capacity:
+                cache.popitem(last=False)
+    return hits / len(keys)
+
+
+if __name__ == '__main__':
+    calculator = Calculator()
+    for terms in (4, 16, 64):
+        # every term depends on fixed parameters; only the last one depends on x
+        formula = '+'.join(f'(p{i}*q{i}^2$r{i})' for i in range(terms)) + '+x*rate'
+        fixed = {f'{name}{i}': 1.0 + i % 7 for i in range(terms) for name in 'pqr'}
+        fixed['rate'] = 1.05
+        full = compile_node(calculator.parse(formula))
+        residual = specialize(formula, **fixed)
+        loops = 20000
+        start = time.perf_counter()
+        for i in range(loops):
+            full(x=i, **fixed)
+        full_time = (time.perf_counter() - start) / loops
+        start = time.perf_counter()
+        for i in range(loops):
+            residual(i)
+        residual_time = (time.perf_counter() - start) / loops
+        assert residual(3.0) == full(x=3.0, **fixed)
+        print(f'{terms:>3} terms: full {len(full):>4} instructions {full_time * 1e6:8.2f}us/call, '
+              f'residual {len(residual):>2} instructions {residual_time * 1e6:6.2f}us/call')
+
+    # the unflattened tree of an n-term chain is n levels deep
+    sys.setrecursionlimit(20000)
+    for terms in (10, 100, 1000, 5000):
+        for symbol in '+@':
+            chain = symbol.join(f'x{i % 10}' for i in range(terms))
+            values = {f'x{i}': i * 0.1 for i in range(10)}
+            tree = calculator.parse(chain)
+            flat = flatten(tree)
+            loops = max(100000 // terms, 10)
+            timings = []
+            for node in (tree, flat):
+                start = time.perf_counter()
+                for _ in range(loops):
+                    node.evaluate(values)
+                timings.append((time.perf_counter() - start) / loops)
+            print(f"{terms:>5} x '{symbol}': binary tree {timings[0] * 1e6:9.2f}us, "
+                  f"flattened {timings[1] * 1e6:9.2f}us ({timings[0] / timings[1]:4.1f}x)")
+
+    # a Zipf-distributed mix of formulas, each call spelled its own way
+    rng = random.Random(0)
+    formulas = [_random_tree(rng, 4) for _ in range(2000)]
+    corpus = [_spell(formulas[k], rng) for k in
+              rng.choices(range(len(formulas)), weights=[1 / (k + 1) for k in range(len(formulas))], k=50000)]
+    start = time.perf_counter()
+    keys = [canonical_key(expression) for expression in corpus]
+    key_time = (time.perf_counter() - start) / len(corpus)
+    point = {'x': 1.5, 'y': 2.5, 'z': -0.5}
+    assert all(_outcome(calculator.parse(text), point) == _outcome(canonicalize(text), point) for text in corpus[:5000])
+    print(f'{len(corpus)} calls, {len(set(corpus))} distinct texts, {len(set(keys))} distinct canonical keys, '
+          f'{key_time * 1e6:.1f}us per key')
+    for capacity in (64, 256, 1024):
+        print(f'LRU of {capacity:>4}: hit rate by text {_lru_hit_rate(corpus, capacity):6.1%}, '
+              f'by canonical key {_lru_hit_rate(keys, capacity):6.1%}')
@@ -0,0 +1,196 @@
+import argparse
+import csv
+import mmap
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+
+from chatv3 import Calculator
+from compiler import Program, compile_node
+from vectorized import run_program, scratch_buffers, evaluate_columns
+
+# 64k float64 rows = 512KB per buffer, small enough to keep a few of them in L2/L3
+DEFAULT_CHUNK_ROWS = 1 << 16
+
+
+# -------------------------------
+# Chunked evaluation with bounded memory
+# -------------------------------
+
+def as_program(expr) -> Program:
+    """The stack program of an expression string or a parsed Node."""
+    return compile_node(Calculator().parse(expr) if isinstance(expr, str) else expr)
+
+
+def evaluate_chunks(program: Program, chunks: Iterator[Tuple[int, Dict[str, np.ndarray]]], out: np.ndarray,
+                    chunk_rows: int = DEFAULT_CHUNK_ROWS) -> np.ndarray:
+    """
+    Evaluate `program` over (start_row, columns) chunks and write each result into
+    out[start_row:...]. The scratch buffers are allocated once for all chunks.
+    """
+    buffers = scratch_buffers(program, chunk_rows)
+    for start, columns in chunks:
+        rows = len(next(iter(columns.values()))) if columns else min(chunk_rows, len(out) - start)
+        run_program(program, columns, out[start:start + rows], buffers)
+    return out
+
+
+def column_rows(columns: Dict[str, np.ndarray]) -> int:
+    """The common length of the columns (1 without any); ValueError when they differ."""
+    lengths = {name: len(column) for name, column in columns.items()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError(f"Columns have different lengths: {lengths}")
+    return next(iter(lengths.values())) if lengths else 1
+
+
+def slices(columns: Dict[str, np.ndarray], rows: int, chunk_rows: int):
+    """(start_row, columns) chunks of `chunk_rows` rows, views into the columns."""
+    for start in range(0, rows, chunk_rows):
+        yield start, {name: column[start:start + chunk_rows] for name, column in columns.items()}
+
+
+def evaluate_columns_chunked(expr, columns: Dict[str, np.ndarray], out: np.ndarray = None,
+                             chunk_rows: int = DEFAULT_CHUNK_ROWS) -> np.ndarray:
+    """Chunked evaluation over arrays or memory maps of equal length."""
+    program = as_program(expr)
+    columns = {name: columns[name] for name in program.variables}
+    rows = column_rows(columns)
+    if out is None:
+        out = np.empty(rows)
+    return evaluate_chunks(program, slices(columns, rows, chunk_rows), out, chunk_rows)
+
+
+def evaluate_npy(expr, inputs: Dict[str, str], output_path: str,
+                 chunk_rows: int = DEFAULT_CHUNK_ROWS) -> np.ndarray:
+    """
+    Memory-map one .npy file per variable and write the result to a memory-mapped
+    .npy at `output_path`. Only the pages of the current chunk need to be resident.
+    """
+    program = as_program(expr)
+    columns = {name: np.load(inputs[name], mmap_mode='r') for name in program.variables}
+    rows = column_rows(columns)
+    out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64, shape=(rows,))
+    buffers = scratch_buffers(program, chunk_rows)
+    for start, chunk in slices(columns, rows, chunk_rows):
+        stop = min(start + chunk_rows, rows)
+        run_program(program, chunk, out[start:stop], buffers)
+        # mapped pages count towards RSS until the kernel evicts them, so drop them ourselves
+        for column in (*columns.values(), out):
+            release(column, start, stop)
+    out.flush()
+    return out
+
+
+def release(column: np.ndarray, start: int, stop: int):
+    """Write back and unmap the pages that hold column[start:stop] of a np.memmap."""
+    mapping = getattr(column, '_mmap', None)
+    if mapping is None or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    # np.memmap maps from the allocation boundary below its file offset
+    base = column.offset % mmap.ALLOCATIONGRANULARITY
+    first = base + start * column.itemsize
+    first -= first % mmap.PAGESIZE
+    length = base + stop * column.itemsize - first
+    length -= length % mmap.PAGESIZE
+    if length <= 0:
+        return
+    if column.flags.writeable:
+        mapping.flush(first, length)
+    mapping.madvise(mmap.MADV_DONTNEED, first, length)
+
+
+def _csv_rows(path: str) -> Iterator[list]:
+    # blank lines come out of csv.reader as empty rows; they are not data
+    with open(path, newline='') as f:
+        yield from (row for row in csv.reader(f) if row)
+
+
+def csv_chunks(path: str, names: Tuple[str, ...], chunk_rows: int):
+    """
+    (start_row, columns) chunks of the named columns of a csv file with a header row.
+    The arrays are reused from one chunk to the next.
+    """
+    # csv cannot be memory-mapped as numbers, so parse it row by row into reused arrays
+    buffers = {name: np.empty(chunk_rows) for name in names}
+    reader = _csv_rows(path)
+    header = next(reader, [])
+    positions = [header.index(name) for name in names]
+    start = filled = 0
+    for row in reader:
+        for name, position in zip(names, positions):
+            buffers[name][filled] = float(row[position])
+        filled += 1
+        if filled == chunk_rows:
+            yield start, buffers
+            start += filled
+            filled = 0
+    if filled:
+        yield start, {name: buffer[:filled] for name, buffer in buffers.items()}
+
+
+def evaluate_csv(expr, csv_path: str, output_path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> np.ndarray:
+    """Stream a csv file with a header row; variables are looked up by column name."""
+    program = as_program(expr)
+    # the output is sized up front, so count the rows first: csv.reader is cheap next to
+    # float(), and a line count would be off for blank lines and quoted newlines
+    rows = max(sum(1 for _ in _csv_rows(csv_path)) - 1, 0)
+    out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64, shape=(rows,))
+    evaluate_chunks(program, csv_chunks(csv_path, program.variables, chunk_rows), out, chunk_rows)
+    out.flush()
+    return out
+
+
+# -------------------------------
+# Benchmark: throughput and peak RSS, chunked vs. in-memory
+# -------------------------------
+
+BENCH_EXPRESSION = '(x * 1.5 + y ^ 2) @ (x $ z) - ~y % 7'
+
+
+def peak_rss_mb() -> float:
+    """The peak resident set size of this process so far."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _bench(mode: str, directory: str):
+    inputs = {name: os.path.join(directory, name + '.npy') for name in 'xyz'}
+    start = time.perf_counter()
+    if mode == 'chunked':
+        out = evaluate_npy(BENCH_EXPRESSION, inputs, os.path.join(directory, 'out.npy'))
+    else:
+        out = evaluate_columns(BENCH_EXPRESSION, {name: np.load(path) for name, path in inputs.items()})
+        np.save(os.path.join(directory, 'out_memory.npy'), out)
+    elapsed = time.perf_counter() - start
+    print(f'{mode:<8} {len(out) / elapsed / 1e6:8.2f}M rows/s  peak RSS {peak_rss_mb():8.1f}MB')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Chunked out-of-core evaluation benchmark')
+    arg_parser.add_argument('--rows', type=int, default=20_000_000)
+    arg_parser.add_argument('--mode', choices=['chunked', 'memory'])
+    arg_parser.add_argument('--dir')
+    args = arg_parser.parse_args()
+    if args.mode:
+        _bench(args.mode, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            rng = np.random.default_rng(0)
+            for name in 'xyz':
+                column = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                                   dtype=np.float64, shape=(args.rows,))
+                for start in range(0, args.rows, DEFAULT_CHUNK_ROWS):
+                    stop = min(start + DEFAULT_CHUNK_ROWS, args.rows)
+                    column[start:stop] = rng.uniform(1, 10, stop - start)
+                column.flush()
+                del column
+            print(f'{args.rows} rows, {BENCH_EXPRESSION}')
+            # separate processes, so each peak RSS belongs to one mode only
+            for mode in ('chunked', 'memory'):
+                subprocess.run([sys.executable, __file__, '--mode', mode, '--dir', directory], check=True)
@@ -0,0 +1,237 @@
+import argparse
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import count
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chatv3 import Calculator
+from compiler import Program, compile_node
+from vectorized import run_program
+
+_segment_ids = count()
+
+# below this many rows per task the round trip costs more than the evaluation
+MIN_TASK_ROWS = 8192
+
+
+# -------------------------------
+# Shared-memory batches
+# -------------------------------
+
+class SharedBatch:
+    """
+    Input columns and the output column of one batch, each in its own
+    multiprocessing.shared_memory segment. Fill `inputs` in place, run the batch,
+    read `output` in place. close() unlinks every segment, also after errors, and
+    takes the batch off `open_batches`, the list of its pool's live batches.
+    """
+
+    def __init__(self, rows: int, variables, open_batches: Optional[List['SharedBatch']] = None):
+        self.rows = rows
+        self.open_batches = open_batches
+        self.segments: List[shared_memory.SharedMemory] = []
+        self.inputs: Dict[str, np.ndarray] = {}
+        self.specs: Dict[str, Tuple[str, int]] = {}
+        try:
+            for name in variables:
+                self.specs[name], self.inputs[name] = self._allocate()
+            self.output_spec, self.output = self._allocate()
+        except BaseException:
+            self.close()
+            raise
+
+    def _allocate(self) -> Tuple[Tuple[str, int], np.ndarray]:
+        segment = shared_memory.SharedMemory(name=f'calc_{os.getpid()}_{next(_segment_ids)}', create=True,
+                                             size=max(self.rows, 1) * 8)
+        self.segments.append(segment)
+        return (segment.name, self.rows), np.ndarray((self.rows,), dtype=np.float64, buffer=segment.buf)
+
+    def close(self):
+        self.inputs = {}
+        self.output = None
+        for segment in self.segments:
+            try:
+                segment.close()
+            except BufferError:
+                # the caller still holds a view; the mapping goes away with it, the name goes now
+                pass
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segments = []
+        if self.open_batches is not None and self in self.open_batches:
+            self.open_batches.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@lru_cache(maxsize=256)
+def _compiled(expression: str) -> Program:
+    return compile_node(Calculator().parse(expression))
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name)
+    # before 3.13 attaching also registers the segment with this worker's resource tracker,
+    # which would unlink it under the parent's feet when the worker exits
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+# worker-local mappings of the current batch, so each worker attaches once per batch, not per task
+_attached: Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray]] = {}
+
+
+def _column(segment_name: str, rows: int) -> np.ndarray:
+    if segment_name not in _attached:
+        segment = _attach(segment_name)
+        _attached[segment_name] = (segment, np.ndarray((rows,), dtype=np.float64, buffer=segment.buf))
+    return _attached[segment_name][1]
+
+
+def _detach_except(keep: set):
+    for segment_name in [n for n in _attached if n not in keep]:
+        segment, column = _attached.pop(segment_name)
+        # the view must be gone before the segment can be closed
+        del column
+        segment.close()
+
+
+def _run_range(expression: str, inputs: Dict[str, Tuple[str, int]], output: Tuple[str, int],
+               start: int, stop: int) -> int:
+    """Worker side: attach to the segments, evaluate rows [start, stop) and write them in place."""
+    program = _compiled(expression)
+    _detach_except({spec[0] for spec in inputs.values()} | {output[0]})
+    columns = {name: _column(*spec)[start:stop] for name, spec in inputs.items()}
+    run_program(program, columns, _column(*output)[start:stop])
+    return stop - start
+
+
+# -------------------------------
+# Process pool
+# -------------------------------
+
+class ProcessPool:
+    """
+    A process pool whose tasks carry only segment names and row ranges.
+    Every batch created by the pool is unlinked when its run ends, including when a
+    worker dies: the parent owns the segments, workers only attach to them.
+    """
+
+    def __init__(self, workers: Optional[int] = None, tasks_per_worker: int = 4):
+        self.workers = workers or os.cpu_count() or 1
+        self.tasks_per_worker = tasks_per_worker
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.batches: List[SharedBatch] = []
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is not None and self.executor._broken:
+            # a worker died since the last run; its executor refuses new work
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor
+
+    def batch(self, rows: int, variables) -> SharedBatch:
+        batch = SharedBatch(rows, variables, self.batches)
+        self.batches.append(batch)
+        return batch
+
+    def run(self, expression: str, batch: SharedBatch):
+        """Evaluate `expression` over `batch.inputs` into `batch.output`."""
+        if batch.rows == 0:
+            return
+        tasks = max(min(self.workers * self.tasks_per_worker, batch.rows // MIN_TASK_ROWS), 1)
+        bounds = [batch.rows * i // tasks for i in range(tasks + 1)]
+        executor = self._executor()
+        try:
+            futures = [executor.submit(_run_range, expression, batch.specs, batch.output_spec, start, stop)
+                       for start, stop in zip(bounds, bounds[1:]) if stop > start]
+            for future in futures:
+                future.result()
+        except BrokenProcessPool:
+            # a worker died: nothing it attached to survives it, drop the pool and our segments
+            self.executor = None
+            batch.close()
+            raise
+
+    def evaluate(self, expression: str, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        """Convenience wrapper: copy the columns in, run, and copy the result out."""
+        variables = _compiled(expression).variables
+        rows = len(columns[variables[0]]) if variables else 1
+        with self.batch(rows, variables) as batch:
+            for name in variables:
+                batch.inputs[name][:] = columns[name]
+            self.run(expression, batch)
+            return batch.output.copy()
+
+    def close(self):
+        for batch in list(self.batches):
+            batch.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# -------------------------------
+# Benchmark: pickled arrays vs. shared memory by batch size
+# -------------------------------
+
+def _run_pickled(expression: str, columns: Dict[str, np.ndarray]) -> np.ndarray:
+    program = _compiled(expression)
+    return run_program(program, columns, np.empty(len(next(iter(columns.values())))))
+
+
+def evaluate_pickled(executor: ProcessPoolExecutor, expression: str, columns: Dict[str, np.ndarray],
+                     tasks: int) -> np.ndarray:
+    rows = len(next(iter(columns.values())))
+    bounds = [rows * i // tasks for i in range(tasks + 1)]
+    futures = [executor.submit(_run_pickled, expression, {n: c[a:b] for n, c in columns.items()})
+               for a, b in zip(bounds, bounds[1:])]
+    return np.concatenate([f.result() for f in futures])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Pickled vs. shared-memory batch transfer')
+    arg_parser.add_argument('--workers', type=int, default=4)
+    args = arg_parser.parse_args()
+    expression = 'x * 1.5 + y $ z'
+    rng = np.random.default_rng(0)
+    with ProcessPool(args.workers) as pool:
+        executor = pool._executor()
+        tasks = args.workers * pool.tasks_per_worker
+        for rows in (10_000, 100_000, 1_000_000, 10_000_000):
+            columns = {name: rng.uniform(1, 10, rows) for name in 'xyz'}
+            pickled_bytes = sum(len(pickle.dumps(c)) for c in columns.values()) + rows * 8
+            evaluate_pickled(executor, expression, columns, tasks)  # warm up the workers
+            start = time.perf_counter()
+            expected = evaluate_pickled(executor, expression, columns, tasks)
+            pickled = time.perf_counter() - start
+            with pool.batch(rows, 'xyz') as batch:
+                for name in 'xyz':
+                    batch.inputs[name][:] = columns[name]
+                start = time.perf_counter()
+                pool.run(expression, batch)
+                shared = time.perf_counter() - start
+                assert np.array_equal(batch.output, expected)
+            print(f'{rows:>10} rows: pickled {pickled * 1e3:8.2f}ms ({pickled_bytes / 1e6:7.1f}MB serialized), '
+                  f'shared memory {shared * 1e3:8.2f}ms, overhead saved {(pickled - shared) * 1e3:8.2f}ms')
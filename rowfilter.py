@@ -0,0 +1,321 @@
+import argparse
+import math
+import time
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, NaryOpNode, \
+    Factorial, Negative, Max, Min, Average, Modulo, Power, Multiply, Divide, Add, Subtract, Less, Greater, \
+    LessEqual, GreaterEqual, Equal, NotEqual, And, Or
+from compiler import compile_node
+from outofcore import DEFAULT_CHUNK_ROWS, evaluate_columns_chunked
+from vectorized import run_program, scratch_buffers, evaluate_columns
+
+
+# -------------------------------
+# Zone maps
+# -------------------------------
+
+class ZoneMap:
+    """
+    Per-chunk minimum and maximum of every column, and whether the chunk has a nan.
+    Chunk i holds rows [i * chunk_rows, (i + 1) * chunk_rows). Build it once and pass
+    it to every filter() over the same columns.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], chunk_rows: int = DEFAULT_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.rows = len(next(iter(columns.values()))) if columns else 1
+        self.minimum: Dict[str, np.ndarray] = {}
+        self.maximum: Dict[str, np.ndarray] = {}
+        self.nan: Dict[str, np.ndarray] = {}
+        starts = np.arange(0, self.rows, chunk_rows)
+        for name, column in columns.items():
+            low = np.minimum.reduceat(column, starts).astype(float)
+            high = np.maximum.reduceat(column, starts).astype(float)
+            nan = np.isnan(low)
+            for chunk in np.flatnonzero(nan):
+                # only the chunks with a nan pay for a second, nan-skipping pass
+                part = column[starts[chunk]:starts[chunk] + chunk_rows]
+                low[chunk], high[chunk] = np.fmin.reduce(part), np.fmax.reduce(part)
+            # a chunk of nan only: no bounds at all
+            low[np.isnan(low)], high[np.isnan(high)] = -math.inf, math.inf
+            self.minimum[name], self.maximum[name], self.nan[name] = low, high, nan
+
+    def __len__(self) -> int:
+        return -(-self.rows // self.chunk_rows)
+
+
+# -------------------------------
+# Interval arithmetic over the AST
+# -------------------------------
+# Every subtree gets, per chunk, bounds [lo, hi] on the values it takes, whether it can
+# be nan, and whether evaluating it can raise (x / 0, a negative factorial, overflow).
+# A predicate is definitely false on a chunk when its bounds are [0, 0] without nan,
+# definitely true when 0 is outside them (nan is true, as in `if`). Both only count
+# when nothing can raise: a chunk that would raise is evaluated, and raises.
+
+class Interval:
+    def __init__(self, lo: np.ndarray, hi: np.ndarray, nan: np.ndarray, error: np.ndarray):
+        self.lo = lo
+        self.hi = hi
+        self.nan = nan
+        self.error = error
+
+    def false(self) -> np.ndarray:
+        return (self.lo == 0) & (self.hi == 0) & ~self.nan
+
+    def true(self) -> np.ndarray:
+        return (self.lo > 0) | (self.hi < 0)
+
+
+def _outward(lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # pow and gamma are not correctly rounded: a few ulps of slack on both sides
+    slack = 8 * np.finfo(float).eps
+    return lo - np.abs(lo) * slack, hi + np.abs(hi) * slack
+
+
+def _corners(function: Callable, a: Interval, b: Interval) -> Interval:
+    """Bounds of an operator that is monotone in each argument: its values at the four corners."""
+    with np.errstate(all='ignore'):
+        values = np.stack([function(x, y) for x in (a.lo, a.hi) for y in (b.lo, b.hi)])
+    lo, hi = values.min(axis=0), values.max(axis=0)
+    # inf - inf, 0 * inf, inf / inf: no bounds
+    unbounded = np.isnan(lo) | np.isnan(hi)
+    return Interval(np.where(unbounded, -math.inf, lo), np.where(unbounded, math.inf, hi),
+                    a.nan | b.nan | unbounded, a.error | b.error)
+
+
+def _contains_zero(a: Interval) -> np.ndarray:
+    return (a.lo <= 0) & (a.hi >= 0)
+
+
+def _finite(*bounds: np.ndarray) -> np.ndarray:
+    return np.logical_and.reduce([np.isfinite(bound) for bound in bounds])
+
+
+def _divide(a: Interval, b: Interval) -> Interval:
+    result = _corners(np.divide, a, b)
+    result.error = result.error | _contains_zero(b)
+    return result
+
+
+def _modulo(a: Interval, b: Interval) -> Interval:
+    positive, negative = b.lo > 0, b.hi < 0
+    # x % y has the sign of y and |x % y| <= |y|; 0 <= x < y leaves x as it is
+    unchanged = positive & (a.lo >= 0) & (a.hi < b.lo)
+    lo = np.where(unchanged, a.lo, np.where(positive, 0.0, np.where(negative, b.lo, -math.inf)))
+    hi = np.where(unchanged, a.hi, np.where(positive, b.hi, np.where(negative, 0.0, math.inf)))
+    nan = a.nan | b.nan | ~_finite(a.lo, a.hi)  # inf % y is nan
+    return Interval(lo, hi, nan, a.error | b.error | _contains_zero(b))
+
+
+def _power(a: Interval, b: Interval) -> Interval:
+    result = _corners(np.power, a, b)
+    lo, hi = _outward(result.lo, result.hi)
+    # x ^ y is monotone in both only for x >= 0; a negative base can give nan anywhere
+    negative = a.lo < 0
+    result.lo, result.hi = np.where(negative, -math.inf, lo), np.where(negative, math.inf, hi)
+    result.nan = result.nan | negative
+    # |x ^ y| = |x| ^ y whatever the sign of x, so overflow shows in the corners over |x|
+    magnitude = Interval(np.where(_contains_zero(a), 0.0, np.minimum(np.abs(a.lo), np.abs(a.hi))),
+                         np.maximum(np.abs(a.lo), np.abs(a.hi)), a.nan, a.error)
+    magnitude = _corners(np.power, magnitude, b)
+    overflow = _finite(a.lo, a.hi, b.lo, b.hi) & ~_finite(magnitude.lo, magnitude.hi)
+    result.error = result.error | (_contains_zero(a) & (b.lo < 0)) | overflow
+    return result
+
+
+# gamma(x + 1) on x >= 0 has its only minimum here
+_FACTORIAL_ARGMIN, _FACTORIAL_MIN = 0.46163214496836234, 0.8856031944108887
+_gamma = np.vectorize(math.gamma, otypes=[float])
+
+
+def _factorial(a: Interval) -> Interval:
+    # math.gamma raises OverflowError past 171.6; 170! is the last finite factorial
+    error = a.error | (a.lo < 0) | (a.hi > 170)
+    low, high = (_gamma(np.clip(bound, 0, 170) + 1) for bound in (a.lo, a.hi))
+    lo, hi = _outward(np.minimum(low, high), np.maximum(low, high))
+    around_minimum = (a.lo <= _FACTORIAL_ARGMIN) & (a.hi >= _FACTORIAL_ARGMIN)
+    lo = np.where(around_minimum, _outward(_FACTORIAL_MIN, _FACTORIAL_MIN)[0], lo)
+    return Interval(lo, hi, a.nan, error)
+
+
+def _comparison(true: Callable, false: Callable) -> Callable:
+    """
+    A comparison from two tests on the bounds. A nan makes every comparison but != false,
+    so a nan operand stops only the "definitely true" side.
+    """
+    def bounds(a: Interval, b: Interval) -> Interval:
+        certain = true(a, b)
+        return Interval(np.where(certain, 1.0, 0.0), np.where(false(a, b), 0.0, 1.0),
+                        np.zeros_like(certain), a.error | b.error)
+    return bounds
+
+
+def _boolean(lo, hi, a: Interval, b: Interval) -> Interval:
+    return Interval(np.where(lo, 1.0, 0.0), np.where(hi, 1.0, 0.0), np.zeros_like(lo), a.error | b.error)
+
+
+def _single(a: Interval) -> np.ndarray:
+    return (a.lo == a.hi) & ~a.nan
+
+
+def _disjoint(a: Interval, b: Interval) -> np.ndarray:
+    return (a.hi < b.lo) | (b.hi < a.lo)
+
+
+BOUNDS: Dict[type, Callable] = {
+    Negative: lambda a: Interval(-a.hi, -a.lo, a.nan, a.error),
+    Factorial: _factorial,
+    Max: lambda a, b: _corners(np.maximum, a, b),
+    Min: lambda a, b: _corners(np.minimum, a, b),
+    Average: lambda a, b: _corners(lambda x, y: (x + y) / 2, a, b),
+    Modulo: _modulo,
+    Power: _power,
+    Multiply: lambda a, b: _corners(np.multiply, a, b),
+    Divide: _divide,
+    Add: lambda a, b: _corners(np.add, a, b),
+    Subtract: lambda a, b: _corners(np.subtract, a, b),
+    Less: _comparison(lambda a, b: (a.hi < b.lo) & ~a.nan & ~b.nan, lambda a, b: a.lo >= b.hi),
+    Greater: _comparison(lambda a, b: (a.lo > b.hi) & ~a.nan & ~b.nan, lambda a, b: a.hi <= b.lo),
+    LessEqual: _comparison(lambda a, b: (a.hi <= b.lo) & ~a.nan & ~b.nan, lambda a, b: a.lo > b.hi),
+    GreaterEqual: _comparison(lambda a, b: (a.lo >= b.hi) & ~a.nan & ~b.nan, lambda a, b: a.hi < b.lo),
+    Equal: _comparison(lambda a, b: _single(a) & _single(b) & (a.lo == b.lo), _disjoint),
+    NotEqual: _comparison(_disjoint, lambda a, b: _single(a) & _single(b) & (a.lo == b.lo)),
+}
+
+
+def bounds(node: Node, zone_map: ZoneMap) -> Interval:
+    """The Interval of `node` on every chunk of the zone map."""
+    chunks = len(zone_map)
+    if isinstance(node, NumberNode):
+        value = float(node.value)
+        return Interval(np.full(chunks, value), np.full(chunks, value),
+                        np.full(chunks, math.isnan(value)), np.zeros(chunks, dtype=bool))
+    if isinstance(node, VariableNode):
+        if node.name not in zone_map.minimum:
+            raise NameError(f"Unbound variable: {node.name}")
+        return Interval(zone_map.minimum[node.name], zone_map.maximum[node.name], zone_map.nan[node.name],
+                        np.zeros(chunks, dtype=bool))
+    if isinstance(node, UnaryOpNode):
+        return _rule(node.op)(bounds(node.child, zone_map))
+    if isinstance(node, BinaryOpNode):
+        left, right = bounds(node.left, zone_map), bounds(node.right, zone_map)
+        if isinstance(node.op, And):
+            # where the left operand is false the right one never runs, nor raises
+            result = _boolean(left.true() & right.true(), ~(left.false() | right.false()), left, right)
+            result.error = left.error | (right.error & ~left.false())
+            return result
+        if isinstance(node.op, Or):
+            result = _boolean(left.true() | right.true(), ~(left.false() & right.false()), left, right)
+            result.error = left.error | (right.error & ~left.true())
+            return result
+        return _rule(node.op)(left, right)
+    if isinstance(node, NaryOpNode):
+        # the operands are reduced left to right, like reduce_operands
+        rule = _rule(node.op)
+        result = bounds(node.children[0], zone_map)
+        for child in node.children[1:]:
+            result = rule(result, bounds(child, zone_map))
+        return result
+    raise TypeError(f"Cannot bound node of type {type(node).__name__}")
+
+
+def _rule(op) -> Callable:
+    try:
+        return BOUNDS[type(op)]
+    except KeyError:
+        raise TypeError(f"No interval rule for operator {op.symbol!r}")
+
+
+# -------------------------------
+# Filtering
+# -------------------------------
+
+def prune(expr, zone_map: ZoneMap) -> Tuple[np.ndarray, np.ndarray]:
+    """Masks of the chunks where a predicate is false on every row, and where it is true on every row."""
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    interval = bounds(node, zone_map)
+    return interval.false() & ~interval.error, interval.true() & ~interval.error
+
+
+def filter(expr, columns: Dict[str, np.ndarray], zone_map: ZoneMap = None,
+           chunk_rows: int = DEFAULT_CHUNK_ROWS) -> np.ndarray:
+    """
+    Indices of the rows where a predicate is true (non-zero), in order. Chunks whose
+    zone map proves the predicate false are never read; chunks where it is proved true
+    are taken whole; only the rest are evaluated. Without a zone_map one is built (a
+    pass over the columns); with one, its chunk size is used.
+
+        filter('t >= 100 && t < 200 && v > 0.5', {'t': t, 'v': v})
+    """
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    program = compile_node(node)
+    rows = len(next(iter(columns.values()))) if columns else 1
+    if not program.variables:
+        return np.arange(rows) if program() else np.zeros(0, dtype=np.int64)
+    columns = {name: columns[name] for name in program.variables}
+    if zone_map is None:
+        zone_map = ZoneMap(columns, chunk_rows)
+    chunk_rows, rows = zone_map.chunk_rows, zone_map.rows
+    never, always = prune(node, zone_map)
+    buffers = scratch_buffers(program, chunk_rows)
+    out = np.empty(chunk_rows)
+    parts = [np.zeros(0, dtype=np.int64)]
+    for chunk in np.flatnonzero(~never):
+        start = chunk * chunk_rows
+        stop = min(start + chunk_rows, rows)
+        if always[chunk]:
+            parts.append(np.arange(start, stop))
+            continue
+        chunk_columns = {name: column[start:stop] for name, column in columns.items()}
+        parts.append(np.flatnonzero(run_program(program, chunk_columns, out[:stop - start], buffers)) + start)
+    return np.concatenate(parts)
+
+
+# -------------------------------
+# Benchmark: selective predicates on a sorted column
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Zone-map row filter benchmark')
+    arg_parser.add_argument('--rows', type=int, default=10_000_000)
+    arg_parser.add_argument('--sample', type=int, default=20000, help='rows timed for the Python loop')
+    args = arg_parser.parse_args()
+    rng = np.random.default_rng(0)
+    # t is sorted, like a timestamp; v is noise
+    columns = {'t': np.sort(rng.uniform(0, 1e6, args.rows)), 'v': rng.uniform(0, 1, args.rows)}
+    start = time.perf_counter()
+    zone_map = ZoneMap(columns)
+    print(f'{args.rows} rows, {len(zone_map)} chunks, zone map built in {(time.perf_counter() - start) * 1e3:.1f}ms')
+    predicates = ('t >= 500000 && t < 501000',
+                  '(t > 250000 && t < 260000 || t > 900000) && v > 0.5',
+                  't / 1000 - 3 < v * 2 || t == 999999',
+                  'v > 0.999')
+    calculator = Calculator()
+    for predicate in predicates:
+        never, always = prune(predicate, zone_map)
+        start = time.perf_counter()
+        rows = filter(predicate, columns, zone_map)
+        filtered = time.perf_counter() - start
+
+        start = time.perf_counter()
+        everything = np.flatnonzero(evaluate_columns(predicate, columns))
+        evaluated = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunked = np.flatnonzero(evaluate_columns_chunked(predicate, columns))
+        chunked_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for row in range(args.sample):
+            calculator.evaluate(predicate, t=columns['t'][row], v=columns['v'][row])
+        loop = (time.perf_counter() - start) * args.rows / args.sample
+
+        assert np.array_equal(rows, everything) and np.array_equal(rows, chunked)
+        print(f'{predicate}: {len(rows) / args.rows:.2%} match, chunks skipped {never.mean():.1%}, '
+              f'taken whole {always.mean():.1%}')
+        print(f'    filter {filtered * 1e3:7.1f}ms, evaluate all then filter {evaluated * 1e3:7.1f}ms, '
+              f'chunked {chunked_time * 1e3:7.1f}ms ({chunked_time / filtered:5.1f}x), Python loop {loop:6.1f}s')
@@ -0,0 +1,144 @@
+import argparse
+import heapq
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from chatv3 import Calculator
+
+
+# -------------------------------
+# Space-saving heavy hitters
+# -------------------------------
+
+class SpaceSaving:
+    """
+    The heaviest keys of a weighted stream in `capacity` counters (Metwally et al.).
+    A new key takes over the smallest counter and starts from its count, so every
+    reported count overestimates the true total by at most its error, and any key whose
+    total exceeds (stream weight) / capacity is in the table.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.counts: Dict[str, float] = {}
+        self.errors: Dict[str, float] = {}
+        # one (count, key) entry per key; a count in the heap is a lower bound, since
+        # increments do not touch the heap. The smallest entry is fixed up when needed.
+        self._heap: List[Tuple[float, str]] = []
+
+    def add(self, key: str, weight: float = 1.0):
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+            return
+        if len(counts) < self.capacity:
+            floor = 0.0
+        else:
+            floor = self._evict()
+        counts[key] = floor + weight
+        self.errors[key] = floor
+        heapq.heappush(self._heap, (floor + weight, key))
+
+    def _evict(self) -> float:
+        heap, counts = self._heap, self.counts
+        while True:
+            count, key = heap[0]
+            if counts[key] == count:
+                heapq.heappop(heap)
+                del counts[key], self.errors[key]
+                return count
+            heapq.heapreplace(heap, (counts[key], key))
+
+    def top(self, n: int) -> List[Tuple[str, float, float]]:
+        """(key, count, error) of the n largest counters, largest first."""
+        keys = heapq.nlargest(n, self.counts, key=self.counts.__getitem__)
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+
+# -------------------------------
+# Sampler for Calculator.evaluate
+# -------------------------------
+
+class Sampler:
+    """
+    Top expressions by number of calls and by total evaluation time, in constant memory.
+    Attach it with Calculator(sampler=Sampler()). Only a `rate` fraction of the calls is
+    timed and recorded, and the counts are scaled back up: a record costs a few
+    microseconds on a long-tailed stream (most distinct expressions evict a counter),
+    and heavy hitters stand out in a sample just as well.
+    """
+
+    def __init__(self, capacity: int = 128, rate: float = 1 / 16):
+        if not 0 < rate <= 1:
+            raise ValueError("rate must be in (0, 1]")
+        self.rate = rate
+        self.calls = 0.0
+        self.seconds = 0.0
+        self.frequent = SpaceSaving(capacity)
+        self.expensive = SpaceSaving(capacity)
+        self._lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        return self.rate == 1.0 or random.random() < self.rate
+
+    def record(self, expression: str, seconds: float):
+        scale = 1 / self.rate
+        with self._lock:
+            self.calls += scale
+            self.seconds += seconds * scale
+            self.frequent.add(expression, scale)
+            self.expensive.add(expression, seconds * scale)
+
+    def snapshot(self, n: int = 10) -> dict:
+        """Estimated totals and the top n expressions by calls and by seconds, as plain data."""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'seconds': self.seconds,
+                'frequent': [{'expression': key, 'calls': count, 'error': error}
+                             for key, count, error in self.frequent.top(n)],
+                'expensive': [{'expression': key, 'seconds': count, 'error': error}
+                              for key, count, error in self.expensive.top(n)],
+            }
+
+
+# -------------------------------
+# Benchmark: per-call overhead and accuracy on a skewed workload
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Heavy-hitter sampler overhead')
+    arg_parser.add_argument('--calls', type=int, default=100_000)
+    arg_parser.add_argument('--distinct', type=int, default=20_000)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+    rng = random.Random(0)
+    # Zipf-like: expression k is drawn with weight 1 / (k + 1)
+    expressions = [f'(x * {k} + {k % 7}) @ y ^ 2 - {k % 5}!' for k in range(args.distinct)]
+    workload = rng.choices(expressions, weights=[1 / (k + 1) for k in range(args.distinct)], k=args.calls)
+    exact = Counter(workload)
+
+    def run(calculator: Calculator) -> float:
+        start = time.perf_counter()
+        for expression in workload:
+            calculator.evaluate(expression, x=1.5, y=2.5)
+        return time.perf_counter() - start
+
+    run(Calculator())  # warm up
+    true_top = {key for key, _ in exact.most_common(10)}
+    print(f'{args.calls} calls over {len(exact)} distinct expressions')
+    for capacity, rate in ((128, 1 / 16), (128, 1.0), (1024, 1 / 16)):
+        # alternate the runs with and without a sampler, so drift hits both alike
+        baseline, sampled = [], []
+        for _ in range(args.repeat):
+            baseline.append(run(Calculator()))
+            sampler = Sampler(capacity, rate)
+            sampled.append(run(Calculator(sampler=sampler)))
+        found = {entry['expression'] for entry in sampler.snapshot(10)['frequent']}
+        print(f'capacity {capacity:>5}, rate {rate:6.4f}: {min(baseline) / args.calls * 1e6:5.1f}us per call, '
+              f'overhead {(min(sampled) / min(baseline) - 1) * 100:5.1f}%, top-10 recall {len(true_top & found) / 10:.0%}')
@@ -0,0 +1,197 @@
+import argparse
+import time
+from typing import Optional, Union
+
+import numpy as np
+
+from autodiff import value_and_grad, differentiable
+from chatv3 import Calculator, Node
+from compiler import compile_node
+from vectorized import evaluate_array
+
+
+class Solution:
+    """
+    Per-element result of solve(): the root, whether it converged, the iterations it
+    took and the final f(root) - target. Elements whose bracket has no sign change are
+    never iterated; their root is nan and converged is False. So are elements where f
+    raises (a division by zero, a factorial of a negative number); their residual is nan.
+    """
+
+    def __init__(self, root: np.ndarray, converged: np.ndarray, iterations: np.ndarray, residual: np.ndarray):
+        self.root = root
+        self.converged = converged
+        self.iterations = iterations
+        self.residual = residual
+
+
+# -------------------------------
+# Lockstep bracketed iterations
+# -------------------------------
+# Every element keeps a bracket [a, b] with f(a) < 0 < f(b) (a may be above b). One
+# iteration evaluates f, and with Newton f', at the current point of every element that
+# is still active, as one array operation; elements that converge or fail leave the
+# active index set, so later iterations only compute the rest.
+#   newton     Newton's step when it stays inside the bracket and shrinks fast enough,
+#              otherwise bisection (Numerical Recipes' rtsafe)
+#   illinois   false position with the Illinois halving, for expressions without derivatives
+
+def solve(expr: Union[str, Node], target, lower, upper, variable: Optional[str] = None, xtol: float = 1e-12,
+          ftol: float = 0.0, max_iterations: int = 100, method: str = 'auto', **fixed) -> Solution:
+    """
+    Solve f(variable) = target for every element of `target` inside [lower, upper].
+    `target`, the bounds and the `fixed` values of the other variables broadcast
+    together. method is 'newton', 'illinois' or 'auto' (newton when every operator has
+    a derivative).
+    """
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    program = compile_node(node)
+    if variable is None:
+        free = [name for name in program.variables if name not in fixed]
+        if len(free) != 1:
+            raise ValueError(f"Cannot tell which variable to solve for among {free}")
+        variable = free[0]
+    if method == 'auto':
+        method = 'newton' if differentiable(program) else 'illinois'
+    if method not in ('newton', 'illinois'):
+        raise ValueError(f"Unknown solver method: {method}")
+
+    shape = np.broadcast_shapes(np.shape(target), np.shape(lower), np.shape(upper),
+                                *(np.shape(value) for value in fixed.values()))
+
+    def flat(value) -> np.ndarray:
+        return np.broadcast_to(np.asarray(value, dtype=float), shape).ravel().copy()
+
+    targets = flat(target)
+    parameters = {name: flat(value) for name, value in fixed.items()}
+
+    def residual(x: np.ndarray, index: np.ndarray, derivative: bool):
+        points = {name: values[index] for name, values in parameters.items()}
+        points[variable] = x
+        try:
+            if derivative:
+                value, gradient = value_and_grad(program, **points)
+                return value - targets[index], np.broadcast_to(gradient[variable], x.shape)
+            return np.broadcast_to(evaluate_array(node, **points), x.shape) - targets[index], None
+        except (ArithmeticError, ValueError, TypeError):
+            # a kernel raises for the whole array when one element is outside its domain
+            # (x = -2 in 1 / (x + 2)); halve until the failing elements are found, and give
+            # them a nan residual so that they leave the solve unconverged
+            if x.size == 1:
+                return np.full(1, np.nan), np.full(1, np.nan) if derivative else None
+            middle = x.size // 2
+            f_low, df_low = residual(x[:middle], index[:middle], derivative)
+            f_high, df_high = residual(x[middle:], index[middle:], derivative)
+            return np.concatenate((f_low, f_high)), np.concatenate((df_low, df_high)) if derivative else None
+
+    a, b = flat(lower), flat(upper)
+    everything = np.arange(a.size)
+    f_a, _ = residual(a, everything, False)
+    f_b, _ = residual(b, everything, False)
+    root = np.full(a.size, np.nan)
+    converged = np.zeros(a.size, dtype=bool)
+    iterations = np.zeros(a.size, dtype=np.int64)
+    final = np.full(a.size, np.nan)
+    for end, f_end in ((a, f_a), (b, f_b)):
+        exact = f_end == 0
+        root[exact], final[exact], converged[exact] = end[exact], 0.0, True
+    # orient every bracket so that f(a) < 0 < f(b)
+    swap = f_a > 0
+    a[swap], b[swap] = b[swap], a[swap]
+    f_a[swap], f_b[swap] = f_b[swap], f_a[swap]
+    active = np.flatnonzero(~converged & (f_a < 0) & (f_b > 0))
+
+    x = (a + b) / 2
+    # the last step and the one before, for rtsafe's "shrinks fast enough" test
+    step = np.abs(b - a)
+    previous_step = step.copy()
+    side = np.zeros(a.size, dtype=np.int8)  # illinois: which end moved last, -1 a, 1 b
+    for iteration in range(1, max_iterations + 1):
+        if active.size == 0:
+            break
+        current = x[active]
+        f, df = residual(current, active, method == 'newton')
+        iterations[active] = iteration
+        negative = f < 0
+        a[active[negative]] = current[negative]
+        b[active[~negative]] = current[~negative]
+        if method == 'illinois':
+            moved = np.where(negative, -1, 1)
+            # the end that stayed twice in a row has its f halved, so it gets pulled in
+            stuck = side[active] == moved
+            f_b[active[stuck & negative]] /= 2
+            f_a[active[stuck & ~negative]] /= 2
+            f_a[active[negative]] = f[negative]
+            f_b[active[~negative]] = f[~negative]
+            side[active] = moved
+        low, high = a[active], b[active]
+        if method == 'newton':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                newton = current - f / df
+                inside = (newton - low) * (newton - high) < 0
+                fast = np.abs(2 * f) <= np.abs(previous_step[active] * df)
+            candidate = np.where(inside & fast & np.isfinite(newton), newton, (low + high) / 2)
+        else:
+            fa, fb = f_a[active], f_b[active]
+            candidate = high - fb * (high - low) / (fb - fa)
+            candidate = np.where(np.isfinite(candidate), candidate, (low + high) / 2)
+        previous_step[active] = step[active]
+        step[active] = np.abs(candidate - current)
+        scale = xtol * (1 + np.abs(current))
+        done = (f == 0) | (np.abs(f) <= ftol) | (np.abs(high - low) <= scale)
+        if method == 'newton':
+            # Newton's own step, taken or not: it can round onto the bracket end it came from
+            done |= np.abs(newton - current) <= scale
+        failed = np.isnan(f)
+        settled = active[done & ~failed]
+        # the last evaluated point is the answer; its residual is known
+        root[settled] = current[done & ~failed]
+        final[settled] = f[done & ~failed]
+        converged[settled] = True
+        x[active] = candidate
+        active = active[~(done | failed)]
+    return Solution(root.reshape(shape), converged.reshape(shape), iterations.reshape(shape), final.reshape(shape))
+
+
+def bisect(expr: str, target: float, lower: float, upper: float, variable: str, xtol: float = 1e-12,
+           max_iterations: int = 200) -> float:
+    """The scalar Python bisection with Calculator.evaluate that solve() replaces."""
+    calculator = Calculator()
+    f_lower = calculator.evaluate(expr, **{variable: lower}) - target
+    for _ in range(max_iterations):
+        middle = (lower + upper) / 2
+        f_middle = calculator.evaluate(expr, **{variable: middle}) - target
+        if (f_middle < 0) == (f_lower < 0):
+            lower, f_lower = middle, f_middle
+        else:
+            upper = middle
+        if abs(upper - lower) <= xtol * (1 + abs(middle)):
+            break
+    return (lower + upper) / 2
+
+
+# -------------------------------
+# Benchmark: thousands of targets, lockstep solve vs. a bisection per target
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Vectorized root finding benchmark')
+    arg_parser.add_argument('--targets', type=int, default=10_000)
+    arg_parser.add_argument('--sample', type=int, default=100, help='targets timed for the scalar bisection')
+    args = arg_parser.parse_args()
+    expression = 'x ^ 3 + x $ 2 + (x / 4)! * 3'
+    targets = np.linspace(5, 900, args.targets)  # f(0) = 4, f(10) > 1000
+    for method in ('newton', 'illinois'):
+        start = time.perf_counter()
+        solution = solve(expression, targets, 0, 10, method=method)
+        elapsed = time.perf_counter() - start
+        assert solution.converged.all()
+        print(f'{method:<9} {args.targets} targets: {elapsed * 1e3:8.1f}ms, iterations mean '
+              f'{solution.iterations.mean():5.1f} max {solution.iterations.max():3d}, '
+              f'max |residual| {np.abs(solution.residual).max():.1e}')
+    sample = targets[:: max(len(targets) // args.sample, 1)]
+    start = time.perf_counter()
+    roots = [bisect(expression, target, 0, 10, 'x') for target in sample]
+    scalar = (time.perf_counter() - start) * len(targets) / len(sample)
+    np.testing.assert_allclose(roots, solve(expression, sample, 0, 10).root, rtol=1e-9)
+    print(f'scalar bisection: {scalar * 1e3:8.1f}ms (extrapolated from {len(sample)} targets)')
@@ -0,0 +1,183 @@
+import argparse
+import operator
+import time
+from typing import Callable, Dict, Union
+
+import numpy as np
+
+from chatv3 import Calculator, Node, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode, WindowNode, Max, Min, \
+    Average, Add
+from explain import _children
+from vectorized import evaluate_columns
+
+
+# -------------------------------
+# Rolling window state
+# -------------------------------
+# The block scheme of vectorized.rolling, one sample at a time: the running prefix of the
+# current block, and the suffixes of the last complete block, computed once when it
+# completes. A window is suffix + prefix, so a sample costs O(1) amortized and the values
+# are the ones vectorized.rolling computes, bit for bit, nan, inf and signed zeros included.
+
+def _maximum(x: float, y: float) -> float:
+    # np.maximum: nan wins, and a tie returns the first argument
+    return x if x >= y or x != x else y
+
+
+def _minimum(x: float, y: float) -> float:
+    return x if x <= y or x != x else y
+
+
+COMBINE: Dict[type, Callable[[float, float], float]] = {
+    Add: operator.add,
+    Average: operator.add,  # the sum, divided by the number of samples in the window
+    Max: _maximum,
+    Min: _minimum,
+}
+
+
+class Window:
+    """op over the last `size` values pushed, or over all of them while there are fewer."""
+
+    def __init__(self, op, size: int):
+        if type(op) not in COMBINE:
+            raise TypeError(f"No rolling window for operator {op.symbol!r}")
+        self.combine = COMBINE[type(op)]
+        self.average = isinstance(op, Average)
+        self.size = size
+        self.count = 0
+        self.block = []
+        self.prefix = 0.0
+        self.suffix = []
+
+    def push(self, value: float) -> float:
+        combine = self.combine
+        block = self.block
+        block.append(value)
+        filled = len(block)
+        self.prefix = prefix = value if filled == 1 else combine(self.prefix, value)
+        self.count += 1
+        if self.count <= self.size or filled == self.size:
+            result = prefix
+        else:
+            result = combine(self.suffix[filled], prefix)
+        if filled == self.size:
+            # the block is complete: its suffixes serve the next `size` windows
+            suffix = block
+            for i in range(filled - 2, -1, -1):
+                suffix[i] = combine(suffix[i + 1], suffix[i])
+            self.suffix = suffix
+            self.block = []
+        if self.average:
+            return result / min(self.count, self.size)
+        return result
+
+
+# -------------------------------
+# Streaming evaluation
+# -------------------------------
+
+class Stream:
+    """
+    An expression evaluated over a series, one sample at a time: push() takes the variables
+    of the next sample and returns the value at it. Window functions keep their state
+    between samples; a window inside the right operand of && / || sees only the samples
+    where that operand runs, like in vectorized.evaluate_array. Variables are taken as
+    floats, like the vectorized engines, so both give the same series.
+    """
+
+    def __init__(self, expr: Union[str, Node]):
+        self.node = Calculator().parse(expr) if isinstance(expr, str) else expr
+        self.windows: Dict[WindowNode, Window] = {}
+        # the subtrees without windows are evaluated with Node.evaluate as they are
+        self._stateful = set()
+        self._mark(self.node)
+
+    def _mark(self, node: Node) -> bool:
+        stateful = isinstance(node, WindowNode)
+        if stateful:
+            self.windows[node] = Window(node.op, node.size)
+        for child in _children(node):
+            stateful = self._mark(child) or stateful
+        if stateful:
+            self._stateful.add(node)
+        return stateful
+
+    def reset(self):
+        """Start a new series."""
+        self.windows = {node: Window(node.op, node.size) for node in self.windows}
+
+    def push(self, **variables: float) -> float:
+        return self._value(self.node, {name: float(value) for name, value in variables.items()})
+
+    def extend(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        """push() every row of the columns, in order; the values at every row."""
+        if not columns:
+            return np.array([self.push()])
+        names = list(columns)
+        values = np.empty(len(columns[names[0]]))
+        for row, point in enumerate(zip(*(np.asarray(columns[name], dtype=float).tolist() for name in names))):
+            values[row] = self._value(self.node, dict(zip(names, point)))
+        return values
+
+    def _value(self, node: Node, variables: dict) -> float:
+        if node not in self._stateful:
+            return node.evaluate(variables)
+        if isinstance(node, WindowNode):
+            return self.windows[node].push(self._value(node.child, variables))
+        if isinstance(node, UnaryOpNode):
+            return node.op.evaluate(self._value(node.child, variables))
+        if isinstance(node, LogicalOpNode):
+            left = self._value(node.left, variables)
+            decided = node.op.decided_by(left)
+            if decided is not None:
+                return decided
+            return node.op.evaluate(left, self._value(node.right, variables))
+        if isinstance(node, BinaryOpNode):
+            return node.op.evaluate(self._value(node.left, variables), self._value(node.right, variables))
+        if isinstance(node, NaryOpNode):
+            return node.op.reduce([self._value(child, variables) for child in node.children])
+        raise TypeError(f"Cannot stream node of type {type(node).__name__}")
+
+
+# -------------------------------
+# Benchmark: cost per sample by window size, streaming and vectorized, against
+# recomputing every window from its samples
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Rolling window benchmark')
+    arg_parser.add_argument('--rows', type=int, default=1_000_000)
+    arg_parser.add_argument('--stream-rows', type=int, default=100_000)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 100, args.rows)
+    for size in (10, 1_000, 100_000, 1_000_000):
+        for name in ('mavg', 'rmax'):
+            expression = f'{name}(x * 2 - 1, {size})'
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                vectorized = evaluate_columns(expression, {'x': x})
+                timings.append(time.perf_counter() - start)
+            vectorized_time = min(timings) / args.rows
+
+            stream = Stream(expression)
+            head = {'x': x[:args.stream_rows]}
+            start = time.perf_counter()
+            streamed = stream.extend(head)
+            stream_time = (time.perf_counter() - start) / args.stream_rows
+            assert np.array_equal(streamed, vectorized[:args.stream_rows])
+
+            # recomputing the window at a sample: O(size), measured on a few samples at the end
+            series = x * 2 - 1
+            samples = range(args.rows - 20, args.rows)
+            start = time.perf_counter()
+            for row in samples:
+                window = series[max(row - size + 1, 0):row + 1]
+                window.mean() if name == 'mavg' else window.max()
+            naive_time = (time.perf_counter() - start) / len(samples)
+            print(f'{name} window {size:>9}: vectorized {vectorized_time * 1e9:6.1f}ns/sample, '
+                  f'streaming {stream_time * 1e6:5.2f}us/sample, '
+                  f'recomputed {naive_time * 1e6:9.2f}us/sample')
@@ -0,0 +1,140 @@
+import argparse
+import itertools
+import time
+from typing import Dict, FrozenSet, Tuple, Union
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode
+from compiler import compile_node
+from optimizer import flatten
+from vectorized import kernel, reduce_operands, run_program, evaluate_array
+
+
+# -------------------------------
+# Dependency analysis
+# -------------------------------
+
+def dependencies(node: Node, table: Dict[int, FrozenSet[str]] = None) -> Dict[int, FrozenSet[str]]:
+    """The variables every subtree depends on, by id(subtree), in one bottom-up pass."""
+    if table is None:
+        table = {}
+    if isinstance(node, VariableNode):
+        table[id(node)] = frozenset([node.name])
+    elif isinstance(node, UnaryOpNode):
+        table[id(node)] = dependencies(node.child, table)[id(node.child)]
+    elif isinstance(node, BinaryOpNode):
+        dependencies(node.left, table)
+        dependencies(node.right, table)
+        table[id(node)] = table[id(node.left)] | table[id(node.right)]
+    elif isinstance(node, NaryOpNode):
+        for child in node.children:
+            dependencies(child, table)
+        table[id(node)] = frozenset().union(*(table[id(child)] for child in node.children))
+    else:
+        table[id(node)] = frozenset()
+    return table
+
+
+# -------------------------------
+# Evaluation over an open grid
+# -------------------------------
+# Axis k of the grid is an array of shape (1, ..., n_k, ..., 1), so a subtree that uses
+# the axes A is evaluated once per point of the sub-grid of A and has that shape; NumPy
+# broadcasting spreads it over the other axes only where it meets a subtree that uses them.
+
+def _evaluate(node: Node, axes: Dict[str, np.ndarray], table: Dict[int, FrozenSet[str]]):
+    if isinstance(node, NumberNode):
+        return np.float64(node.value)
+    if isinstance(node, VariableNode):
+        if node.name not in axes:
+            raise NameError(f"Unbound variable: {node.name}")
+        return axes[node.name]
+    if isinstance(node, UnaryOpNode):
+        return kernel(node.op)(_evaluate(node.child, axes, table))
+    if isinstance(node, LogicalOpNode):
+        # the short circuit picks grid points, which evaluate_array does on the broadcast grid
+        return evaluate_array(node, **axes)
+    if isinstance(node, BinaryOpNode):
+        return kernel(node.op)(_evaluate(node.left, axes, table), _evaluate(node.right, axes, table))
+    if isinstance(node, NaryOpNode):
+        # reduce operands with the same axes first, at the size of their sub-grid; only the
+        # group results meet at the combined shape (sums and products are regrouped)
+        groups: Dict[FrozenSet[str], list] = {}
+        for child in node.children:
+            groups.setdefault(table[id(child)], []).append(_evaluate(child, axes, table))
+        partials = [reduce_operands(node.op, values) if len(values) > 1 else values[0]
+                    for _, values in sorted(groups.items(), key=lambda item: len(item[0]))]
+        return reduce_operands(node.op, partials) if len(partials) > 1 else partials[0]
+    raise TypeError(f"Cannot evaluate node of type {type(node).__name__}")
+
+
+def grid_axes(**values) -> Tuple[Dict[str, np.ndarray], Tuple[int, ...]]:
+    """
+    Open-grid arrays for the swept variables, in keyword order, and the grid shape.
+    Scalars are fixed values and add no axis.
+    """
+    swept = [(name, np.asarray(value, dtype=float)) for name, value in values.items() if np.ndim(value) > 0]
+    for name, value in swept:
+        if value.ndim != 1:
+            raise ValueError(f"Sweep values of {name} must be one-dimensional")
+    shape = tuple(len(value) for _, value in swept)
+    axes = {name: np.float64(value) for name, value in values.items() if np.ndim(value) == 0}
+    for k, (name, value) in enumerate(swept):
+        axes[name] = value.reshape([-1 if i == k else 1 for i in range(len(swept))])
+    return axes, shape
+
+
+def sweep(expr: Union[str, Node], **values) -> np.ndarray:
+    """
+    Evaluate an expression over the Cartesian grid of the given ranges or arrays, one
+    axis per swept variable in keyword order; scalar keywords are fixed. Every subtree
+    is computed only over the axes it depends on, so work that varies along one axis
+    costs that axis' length, not the grid size.
+
+        sweep('x ^ 2 + y!', x=range(100), y=np.linspace(0, 3, 50)).shape == (100, 50)
+    """
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    node = flatten(node)
+    axes, shape = grid_axes(**values)
+    result = _evaluate(node, axes, dependencies(node))
+    return np.broadcast_to(result, shape).copy()
+
+
+# -------------------------------
+# Benchmark: 3-D and 4-D grids, sweep vs. a dense grid vs. point by point
+# -------------------------------
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Parameter sweep benchmark')
+    arg_parser.add_argument('--sample', type=int, default=20000, help='points timed for point-by-point evaluation')
+    args = arg_parser.parse_args()
+    cases = (
+        ('(x ^ 2.5 + (x / 4)! $ 3) * (y / 7 @ y ^ 0.5) - z % 3 + (z * 0.25)! / (x + 1)',
+         {'x': np.linspace(0, 9, 120), 'y': np.linspace(1, 4, 120), 'z': np.linspace(0, 8, 120)}),
+        ('(x ^ 2.5 + (x / 4)! $ 3) * (y / 7 @ y ^ 0.5) - z % 3 + (w * 0.25)! / (z + 1) + x * w',
+         {'x': np.linspace(0, 9, 40), 'y': np.linspace(1, 4, 40), 'z': np.linspace(0, 8, 40),
+          'w': np.linspace(0, 2, 40)}),
+    )
+    calculator = Calculator()
+    for expression, values in cases:
+        start = time.perf_counter()
+        swept = sweep(expression, **values)
+        sweep_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dense = {name: grid.ravel() for name, grid in zip(values, np.meshgrid(*values.values(), indexing='ij'))}
+        program = compile_node(calculator.parse(expression))
+        full = run_program(program, dense, np.empty(swept.size)).reshape(swept.shape)
+        dense_time = time.perf_counter() - start
+
+        points = itertools.islice(itertools.product(*values.values()), args.sample)
+        start = time.perf_counter()
+        for point in points:
+            program(*(point[list(values).index(name)] for name in program.variables))
+        point_time = (time.perf_counter() - start) * swept.size / min(args.sample, swept.size)
+
+        np.testing.assert_allclose(swept, full, rtol=1e-12, atol=1e-12)  # sums are regrouped
+        print(f'{len(values)}-D grid {"x".join(map(str, swept.shape))} ({swept.size} points): '
+              f'sweep {sweep_time * 1e3:8.1f}ms, dense grid {dense_time * 1e3:8.1f}ms, '
+              f'point by point {point_time * 1e3:9.0f}ms ({point_time / sweep_time:.0f}x)')
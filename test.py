@@ -38,5 +38,1151 @@ class TestCalculator(unittest.TestCase):
         self.assertEqual(self.calc.evaluate('~-10 + 4!'), 34)  # ~-10 = 10, 10 + 4! = 10 + 24 = 34
         self.assertEqual(self.calc.evaluate('2! + 3! * 4'), 26)
 
+class TestDifferential(unittest.TestCase):
+    def setUp(self):
+        import differential
+        self.differential = differential
+
+    def test_generator_is_deterministic(self):
+        first = self.differential.Generator(seed=3).expressions(50)
+        second = self.differential.Generator(seed=3).expressions(50)
+        self.assertEqual(first, second)
+
+    def test_generated_expressions_evaluate_on_chatv3(self):
+        from chatv3 import Calculator
+        calc = Calculator()
+        for expression in self.differential.Generator(seed=1, features={'+', '*', 'paren'}).expressions(100):
+            calc.evaluate(expression)
+
+    def test_minimize_shrinks_disagreement(self):
+        engines = [e for e in self.differential.default_engines() if e.name in ('chatv3', 'chatv2')]
+        tree = ('bin', '+', ('bin', '-', ('num', '20'), ('num', '6')), ('num', '7'))
+        self.assertIsNotNone(self.differential.disagreeing(engines, self.differential.render(tree)))
+        small = self.differential.minimize(
+            tree, lambda t: self.differential.disagreeing(engines, self.differential.render(t)) is not None)
+        self.assertLess(self.differential.size(small), self.differential.size(tree))
+        self.assertEqual(self.differential.render(small).count('-'), 1)
+
+    def test_run_reports_timings_for_every_engine(self):
+        report = self.differential.run(count=200, seed=0)
+        self.assertEqual(set(report.timings), {'chatv3', 'compiled', 'regexcheck', 'chatv2', 'chat'})
+        self.assertEqual(report.timings['chatv3'][1], 200)
+
+
+class TestVariables(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def test_variables(self):
+        self.assertEqual(self.calc.evaluate('x * 2 + y!', x=3, y=3), 12)
+        self.assertEqual(self.calc.evaluate('~rate_1 @ 0', rate_1=-4), 4)
+
+    def test_unbound_variable(self):
+        with self.assertRaises(NameError):
+            self.calc.evaluate('x + 1')
+
+
+class TestSpecialize(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        from compiler import compile_node
+        self.calc = Calculator()
+        self.compile_node = compile_node
+
+    def test_compiled_program_matches_tree(self):
+        expression = '7!*(-50 + x * 8) - 20 - ~y'
+        program = self.compile_node(self.calc.parse(expression))
+        self.assertEqual(program.variables, ('x', 'y'))
+        self.assertEqual(program(95, 50), self.calc.evaluate(expression, x=95, y=50))
+        self.assertEqual(program(x=95, y=50), 3578430)
+
+    def test_residual_only_takes_free_variables(self):
+        from optimizer import specialize
+        expression = '(a * b ^ 2 $ c) + x * rate - 0'
+        residual = specialize(expression, a=2, b=3, c=4, rate=1.5)
+        self.assertEqual(residual.variables, ('x',))
+        self.assertLess(len(residual), len(self.compile_node(self.calc.parse(expression))))
+        self.assertEqual(residual(10), self.calc.evaluate(expression, a=2, b=3, c=4, rate=1.5, x=10))
+
+    def test_errors_are_kept_for_call_time(self):
+        from optimizer import specialize
+        residual = specialize('x + 1 / d', d=0)
+        with self.assertRaises(TypeError):
+            residual(1)
+
+
+class TestVectorized(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        from chatv3 import Calculator
+        self.np = np
+        self.calc = Calculator()
+        rng = np.random.default_rng(0)
+        self.columns = {'x': rng.uniform(1, 5, 1000), 'y': rng.uniform(1, 5, 1000)}
+        self.expression = '(x * 2 - y ^ 2) @ (x $ y) + ~y % 3 / x & 4! - (x / 2)!'
+
+    def expected(self):
+        return [self.calc.evaluate(self.expression, x=x, y=y) for x, y in zip(self.columns['x'], self.columns['y'])]
+
+    def test_columns_match_scalar(self):
+        from vectorized import evaluate_array, evaluate_columns
+        self.np.testing.assert_allclose(evaluate_columns(self.expression, self.columns), self.expected())
+        self.np.testing.assert_allclose(evaluate_array(self.calc.parse(self.expression), **self.columns),
+                                        self.expected())
+
+    def test_domain_errors(self):
+        from vectorized import evaluate_columns
+        with self.assertRaises(TypeError):
+            evaluate_columns('1 / x', {'x': self.np.array([1.0, 0.0])})
+        with self.assertRaises(ValueError):
+            evaluate_columns('x!', {'x': self.np.array([1.0, -2.0])})
+
+    def test_chunked_npy_and_csv(self):
+        import os
+        import tempfile
+        from outofcore import evaluate_columns_chunked, evaluate_npy, evaluate_csv
+        self.np.testing.assert_allclose(evaluate_columns_chunked(self.expression, self.columns, chunk_rows=77),
+                                        self.expected())
+        with tempfile.TemporaryDirectory() as directory:
+            inputs = {}
+            for name, column in self.columns.items():
+                inputs[name] = os.path.join(directory, name + '.npy')
+                self.np.save(inputs[name], column)
+            out = evaluate_npy(self.expression, inputs, os.path.join(directory, 'out.npy'), chunk_rows=300)
+            self.np.testing.assert_allclose(self.np.load(os.path.join(directory, 'out.npy')), self.expected())
+            del out
+            csv_path = os.path.join(directory, 'in.csv')
+            with open(csv_path, 'w') as f:
+                f.write('y,x\n')
+                for x, y in zip(self.columns['x'], self.columns['y']):
+                    f.write(f'{float(y)!r},{float(x)!r}\n')
+            out = evaluate_csv(self.expression, csv_path, os.path.join(directory, 'out_csv.npy'), chunk_rows=128)
+            self.np.testing.assert_allclose(out, self.expected())
+            del out
+
+    def test_blank_csv_lines_and_unequal_columns(self):
+        import os
+        import tempfile
+        from outofcore import evaluate_columns_chunked, evaluate_csv
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'in.csv')
+            with open(csv_path, 'w') as f:
+                f.write('x,y\n1,2\n\n3,4\n"5","6\n"\n\n\n')
+            out = evaluate_csv('x * 10 + y', csv_path, os.path.join(directory, 'out.npy'), chunk_rows=2)
+            self.assertEqual(out.tolist(), [12.0, 34.0, 56.0])
+            del out
+        with self.assertRaises(ValueError):
+            evaluate_columns_chunked('x + y', {'x': self.np.ones(3), 'y': self.np.ones(4)})
+
+    def test_zero_to_minus_infinity(self):
+        import math
+        from vectorized import evaluate_columns
+        x = self.np.array([0.0, -0.0, 2.0])
+        y = self.np.array([-math.inf, -math.inf, -math.inf])
+        self.assertEqual(evaluate_columns('x ^ y', {'x': x, 'y': y}).tolist(), [math.inf, math.inf, 0.0])
+        with self.assertRaises(ZeroDivisionError):
+            evaluate_columns('x ^ -1', {'x': x})
+
+
+class TestSharedMemoryPool(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        from parallel import ProcessPool
+        self.np = np
+        self.pool = ProcessPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def leftover_segments(self):
+        import os
+        prefix = f'calc_{os.getpid()}_'
+        return [name for name in os.listdir('/dev/shm') if name.startswith(prefix)]
+
+    def test_matches_in_process_evaluation(self):
+        from vectorized import evaluate_columns
+        rng = self.np.random.default_rng(1)
+        columns = {'x': rng.uniform(1, 5, 50000), 'y': rng.uniform(1, 5, 50000)}
+        expression = 'x * y - x $ y ^ 2'
+        self.np.testing.assert_array_equal(self.pool.evaluate(expression, columns),
+                                           evaluate_columns(expression, columns))
+        self.assertEqual(self.leftover_segments(), [])
+        self.pool.evaluate(expression, columns)
+        self.assertEqual(self.pool.batches, [])  # a long-lived pool keeps no closed batches
+
+    def test_worker_crash_leaves_no_segments(self):
+        import os
+        from concurrent.futures.process import BrokenProcessPool
+        with self.assertRaises(BrokenProcessPool):
+            with self.pool.batch(1000, ['x']):
+                self.pool._executor().submit(os._exit, 1).result()
+        self.assertEqual(self.leftover_segments(), [])
+        # the pool starts fresh workers after a crash
+        self.assertEqual(list(self.pool.evaluate('x + 1', {'x': self.np.arange(3.0)})), [1.0, 2.0, 3.0])
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def outcome(self, evaluate):
+        try:
+            return evaluate()
+        except Exception as e:
+            return type(e).__name__, str(e)
+
+    def test_token_spans_match_tokenize(self):
+        from chatv3 import tokenize, tokenize_spans
+        for expression in ['~-5+90', ' 1 2 + ab c ', '7!*(-50 + 95 * 8) - 20 - ~50', '.5-.5', '- -3']:
+            spans = tokenize_spans(expression)
+            self.assertEqual([t for t, _, _ in spans], tokenize(expression))
+            for text, start, end in spans:
+                self.assertEqual(expression[start:end].replace(' ', ''), text)
+
+    def test_random_edits_match_full_evaluation(self):
+        import random
+        from incremental import Session
+        rng = random.Random(7)
+        alphabet = '0123456789. -+*/!@&$%^~()x'
+        for _ in range(300):
+            session = Session(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 15))), x=2.0)
+            for _ in range(10):
+                offset = rng.randint(0, len(session.text))
+                delete = rng.randint(0, min(3, len(session.text) - offset))
+                session.edit(offset, delete, ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 3))))
+                expected = self.outcome(lambda: self.calc.evaluate(session.text, x=2.0))
+                actual = self.outcome(lambda: session.value)
+                if expected == expected:  # nan never equals itself
+                    self.assertEqual(actual, expected, session.text)
+
+    def test_unchanged_subtrees_are_reused(self):
+        from incremental import Session
+        session = Session('(1+2)*3 + 4')
+        self.assertEqual(session.value, 13)
+        product = session.tree.left
+        session.insert(len(session.text), '0')
+        self.assertEqual(session.value, 49)
+        self.assertIs(session.tree.left, product)
+
+    def test_edits_anywhere_reuse_what_follows(self):
+        from incremental import Session
+        text = '+'.join(f'({i}*3$2)' for i in range(50))
+        session = Session(text)
+        session.value
+        last = session.tree.right
+        for offset, delete, insert in ((1, 0, '7*'), (None, 0, '1'), (1, 0, '-1+'), (6, 4, '')):
+            if offset is None:
+                offset = session.text.index('(25*') + 1
+            session.edit(offset, delete, insert)
+            self.assertEqual(session.value, self.calc.evaluate(session.text), session.text)
+            # the terms after the edit were not parsed again
+            self.assertIs(session.tree.right, last)
+        session.insert(len(session.text) - 3, '5')
+        self.assertEqual(session.value, self.calc.evaluate(session.text))
+
+
+class TestExplain(unittest.TestCase):
+    def test_plain_tree(self):
+        from explain import explain
+        text = explain('~-5 + x')
+        self.assertEqual(text.splitlines()[0], "BinaryOp Add '+'")
+        self.assertIn("UnaryOp Negative '~'", text)
+        self.assertIn('Variable x', text)
+        self.assertNotIn('calls=', text)
+
+    def test_analyze_counts_and_times(self):
+        import json
+        from explain import explain, profile_expression
+        profile = profile_expression('2 * x + 3!', repeat=5, x=4)
+        self.assertEqual(profile.calls, 5)
+        self.assertEqual(profile.magnitude, 14)
+        for child in profile.children:
+            self.assertEqual(child.calls, 5)
+            self.assertLessEqual(child.inclusive, profile.inclusive)
+        self.assertGreaterEqual(profile.exclusive, 0)
+        tree = json.loads(explain('2 * x + 3!', analyze=True, format='json', x=4))
+        self.assertEqual(tree['operator'], '+')
+        self.assertEqual(tree['children'][1]['children'][0]['magnitude'], 3)
+
+    def test_vectorized_allocations(self):
+        import numpy as np
+        from explain import profile_expression
+        profile = profile_expression('x * 2 + x', vectorized=True, x=np.ones(100))
+        self.assertEqual(profile.allocated, 800)
+        self.assertEqual(profile.children[1].allocated, 0)
+
+
+class TestJit(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def test_scalar_matches_calculator(self):
+        from jit import jit
+        for expression in ['3! + 2 ^ 3 * x', '(x @ 2) & (y $ 1) - ~x % 3', '-0 - x / y', '4', '(x/2)!']:
+            with self.subTest(expression=expression):
+                self.assertEqual(jit(expression)(x=2.5, y=4), self.calc.evaluate(expression, x=2.5, y=4))
+        self.assertIs(jit('x + 1'), jit('x + 1'))
+        self.assertEqual(jit('x - y')(5, 3), 2)
+
+    def test_errors_match(self):
+        from jit import jit
+        with self.assertRaises(TypeError):
+            jit('1 / x')(x=0)
+        with self.assertRaises(ValueError):
+            jit('x!')(x=-1)
+        with self.assertRaises(ZeroDivisionError):
+            jit('x ^ -1')(x=0)
+        with self.assertRaises(NameError):
+            jit('x + y')(x=1)
+
+    def test_special_values_match_tree(self):
+        import itertools
+        import math
+        from bytecode import dumps, loads
+        from compiler import compile_node
+        from jit import jit
+
+        def outcome(evaluate):
+            try:
+                return repr(evaluate())  # tells -0.0 from 0.0
+            except Exception as e:
+                return type(e).__name__
+
+        values = [0.0, -0.0, 1.0, -1.0, 2.5, 400.0, math.inf, -math.inf, math.nan]
+        for expression in ['x!', 'x ^ y', 'x / y', 'x % y', 'x @ y', 'x $ y', 'x & y', 'x * y - ~x', 'x == y || y']:
+            node = self.calc.parse(expression)
+            engines = {'jit': jit(node), 'program': compile_node(node), 'bytecode': loads(dumps(node))}
+            for x, y in itertools.product(values, repeat=2):
+                expected = outcome(lambda: node.evaluate({'x': x, 'y': y}))
+                for name, engine in engines.items():
+                    with self.subTest(expression=expression, engine=name, x=x, y=y):
+                        self.assertEqual(outcome(lambda: engine(x=x, y=y)), expected)
+
+    def test_batch_matches_numpy(self):
+        import numpy as np
+        from jit import jit
+        from vectorized import evaluate_columns
+        rng = np.random.default_rng(1)
+        columns = {'x': rng.uniform(1, 5, 500), 'y': rng.uniform(1, 5, 500)}
+        expression = '(x * 2 - y ^ 2) @ (x $ y) + ~y % 3 / x & 4!'
+        np.testing.assert_allclose(jit(expression).evaluate(columns), evaluate_columns(expression, columns))
+
+
+class TestBytecode(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def test_round_trip(self):
+        from bytecode import dumps, loads
+        expression = '(x * 2 - y ^ 2) @ (x $ -0) + ~y % 3 / x & 4! - (x / 2)!'
+        encoded = dumps(expression)
+        self.assertEqual(encoded[:4], b'CALC')
+        self.assertEqual(loads(encoded)(x=2.5, y=1.5), self.calc.evaluate(expression, x=2.5, y=1.5))
+        self.assertEqual(loads(memoryview(bytearray(encoded)))(2.5, 1.5), self.calc.evaluate(expression, x=2.5, y=1.5))
+        program = loads(encoded).program()
+        self.assertEqual(program.variables, ('x', 'y'))
+        self.assertEqual(program(x=2.5, y=1.5), self.calc.evaluate(expression, x=2.5, y=1.5))
+        self.assertEqual(dumps(program), encoded)
+
+    def test_invalid_buffers(self):
+        from bytecode import dumps, loads
+        encoded = dumps('1 + x')
+        with self.assertRaises(ValueError):
+            loads(b'NOPE' + encoded[4:])
+        with self.assertRaises(ValueError):
+            loads(encoded[:4] + bytes([9, 0]) + encoded[6:])
+        with self.assertRaises(ValueError):
+            loads(encoded[:20])
+        with self.assertRaises(NameError):
+            loads(encoded)()
+
+
+class TestReentrantParse(unittest.TestCase):
+    def test_registry_is_read_only(self):
+        from chatv3 import OPERATORS, Calculator
+        with self.assertRaises(TypeError):
+            OPERATORS['#'] = OPERATORS['+']
+        self.assertIs(Calculator().operators, OPERATORS)
+
+    def test_module_level_api(self):
+        from chatv3 import Calculator, evaluate, parse
+        calc = Calculator()
+        for expression in ['~-5+90', '3!! - 2 ^ 3 ^ 2', '(1 + x) * 4 $ y']:
+            self.assertEqual(parse(expression).evaluate({'x': 2, 'y': 3}), calc.evaluate(expression, x=2, y=3))
+            self.assertEqual(evaluate(expression, x=2, y=3), calc.evaluate(expression, x=2, y=3))
+        for broken in ['(1 + 2', '1 +', '# 2']:
+            with self.assertRaises(Exception):
+                parse(broken)
+
+    def test_parser_shares_the_grammar(self):
+        from chatv3 import OPERATORS, Parser, parse, tokenize
+        tokens = tokenize('(1 + x) * 4 $ y ) 7')
+        parser = Parser(tokens, OPERATORS)
+        node = parser.parse()
+        self.assertEqual(node.evaluate({'x': 2, 'y': 3}), parse('(1 + x) * 4 $ y').evaluate({'x': 2, 'y': 3}))
+        self.assertEqual(parser.current(), ')')  # the parser stops where the expression ends
+
+    def test_shared_calculator_across_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from chatv3 import Calculator
+        calc = Calculator()
+        expressions = [f'({i} * x + {i % 5}!) @ {i} - ~x' for i in range(200)]
+        expected = [calc.evaluate(e, x=1.5) for e in expressions]
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda e: calc.evaluate(e, x=1.5), expressions * 4))
+        self.assertEqual(results, expected * 4)
+
+
+class TestFlatten(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def test_chains_become_nary(self):
+        from chatv3 import NaryOpNode, BinaryOpNode
+        from optimizer import flatten
+        node = flatten(self.calc.parse('a + b + (c + d) + e * f * g - h $ i $ j'))
+        self.assertIsInstance(node, BinaryOpNode)
+        self.assertIsInstance(node.left, NaryOpNode)
+        # the parenthesized (c + d) stays a group of its own
+        self.assertEqual(len(node.left.children), 4)
+        self.assertIsInstance(node.left.children[2], NaryOpNode)
+        self.assertEqual(len(node.left.children[2].children), 2)
+        self.assertIsInstance(node.left.children[3], NaryOpNode)
+        self.assertEqual(len(node.left.children[3].children), 3)
+        # '$' is not associative and keeps its binary shape
+        self.assertIsInstance(node.right, BinaryOpNode)
+        self.assertIsInstance(node.right.left, BinaryOpNode)
+
+    def test_same_values_on_every_backend(self):
+        import numpy as np
+        from bytecode import dumps, loads
+        from compiler import compile_node
+        from jit import jit
+        from optimizer import flatten
+        from vectorized import evaluate_columns
+        expression = '1 + x + x * 2 * y + 3! @ x @ y & 4 & y - x ^ 2 ^ 0.5 + 0.1 + 0.2'
+        node = flatten(self.calc.parse(expression))
+        expected = self.calc.evaluate(expression, x=2.5, y=1.5)
+        for evaluate in (lambda: node.evaluate({'x': 2.5, 'y': 1.5}), lambda: compile_node(node)(x=2.5, y=1.5),
+                         lambda: loads(dumps(node))(x=2.5, y=1.5), lambda: jit(node)(x=2.5, y=1.5)):
+            self.assertAlmostEqual(evaluate(), expected, places=12)
+        columns = {'x': np.linspace(1, 3, 100), 'y': np.linspace(3, 1, 100)}
+        np.testing.assert_allclose(evaluate_columns(node, columns),
+                                   [self.calc.evaluate(expression, x=x, y=y) for x, y in zip(columns['x'], columns['y'])])
+
+    def test_fsum_and_errors(self):
+        from optimizer import flatten
+        self.assertEqual(flatten(self.calc.parse('0.1 + 0.2 + 0.3 - 0.6 + 1e100 + 1 - 1e100')).evaluate(), 1.0)
+        with self.assertRaises(TypeError):
+            flatten(self.calc.parse('1 + 2 + 3 / 0')).evaluate()
+
+    def test_parenthesized_groups_keep_their_values(self):
+        import math
+        from optimizer import flatten
+        nan = math.nan
+        cases = (('a * (b * c)', dict(a=1e300, b=1e300, c=1e-300)),
+                 ('a * b * (c * d)', dict(a=1e300, b=10, c=1e300, d=1e-300)),
+                 ('a * (b * c) * d', dict(a=1e300, b=1e300, c=1e-300, d=1e-300)),
+                 ('a @ (b @ c)', dict(a=1.0, b=nan, c=2.0)),
+                 ('a & (b & c)', dict(a=1.0, b=nan, c=0.0)),
+                 ('a + (b + c)', dict(a=1e308, b=1e308, c=-1e308)))
+        for expression, point in cases:
+            with self.subTest(expression=expression):
+                expected = self.calc.evaluate(expression, **point)
+                self.assertTrue(math.isfinite(expected))
+                self.assertEqual(flatten(self.calc.parse(expression)).evaluate(point), expected)
+
+    def test_long_chain_does_not_recurse(self):
+        from optimizer import flatten
+        node = flatten(self.calc.parse('+'.join(['x'] * 5000)))
+        self.assertEqual(node.evaluate({'x': 0.5}), 2500)
+
+
+class TestBulkTokenize(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'expressions.txt')
+        self.lines = ['-5 + 3 - -2', '(x1 - 4) * - 7', '1 2 . 5 x y2 .. 5 . 7x', '', 'a-b-.5--3',
+                      '~-10 + 4!', '  ', 'é + 1', '5..3.x_1_ ^ -.5', '3\t+ 4', 'x- 3 . 5@-2']
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text: str):
+        with open(self.path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def test_lines_match_tokenize(self):
+        from chatv3 import tokenize
+        from bulktokenize import iter_token_lines
+        expected = [tokenize(line) for line in self.lines]
+        for text in ('\n'.join(self.lines), '\n'.join(self.lines) + '\n'):
+            self.write(text)
+            for block_size in (4, 1 << 18):
+                self.assertEqual(list(iter_token_lines(self.path, block_size)), expected)
+
+    def test_offsets(self):
+        from chatv3 import tokenize
+        from bulktokenize import token_offsets
+        self.write('\n'.join(self.lines))
+        offsets = token_offsets(self.path, block_size=16)
+        self.assertEqual(len(offsets), len(self.lines))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for i, line in enumerate(self.lines):
+            self.assertEqual(offsets.tokens(data, i), tokenize(line))
+        self.assertEqual(data[offsets.starts[0]:offsets.ends[0]], b'-5')
+
+    def test_offsets_of_an_open_last_line(self):
+        from chatv3 import tokenize
+        from bulktokenize import token_offsets
+        # a last line without '\n' that has no tokens, in ASCII and non-ASCII blocks
+        for lines in (['1', '    '], ['   '], ['é', '  '], ['1 + 2', 'é + 1']):
+            self.write('\n'.join(lines))
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            for block_size in (4, 1 << 18):
+                offsets = token_offsets(self.path, block_size)
+                self.assertEqual(len(offsets), len(lines))
+                self.assertEqual([offsets.tokens(data, i) for i in range(len(lines))],
+                                 [tokenize(line) for line in lines])
+
+    def test_empty_file(self):
+        from bulktokenize import iter_token_lines, token_offsets
+        self.write('')
+        self.assertEqual(list(iter_token_lines(self.path)), [])
+        self.assertEqual(len(token_offsets(self.path)), 0)
+
+
+class TestAutodiff(unittest.TestCase):
+    def test_matches_finite_differences(self):
+        from chatv3 import Calculator
+        from autodiff import value_and_grad, finite_differences
+        expression = '(x * 2.5 + y) ^ 2 $ (x / 3)! - x % y @ ~y + x & y * 3 ^ x'
+        point = {'x': 1.7, 'y': 0.9}
+        expected = finite_differences(expression, **point)
+        for mode in ('reverse', 'forward'):
+            value, gradient = value_and_grad(expression, mode, **point)
+            self.assertAlmostEqual(float(value), Calculator().evaluate(expression, **point))
+            for name in point:
+                self.assertAlmostEqual(float(gradient[name]), expected[name], places=5)
+
+    def test_batched_and_flattened(self):
+        import numpy as np
+        from chatv3 import Calculator
+        from autodiff import value_and_grad
+        from optimizer import flatten
+        node = flatten(Calculator().parse('x * y * z * 2 + x + y @ z @ x'))
+        points = {'x': np.array([1.0, 0.0, 3.0]), 'y': np.array([2.0, 5.0, -1.0]), 'z': 4.0}
+        value, gradient = value_and_grad(node, **points)
+        x, y, z = points['x'], points['y'], points['z']
+        np.testing.assert_allclose(gradient['x'], y * z * 2 + 1 + (x > np.maximum(y, z)))
+        np.testing.assert_allclose(gradient['y'], x * z * 2 + ((y >= z) & (y >= x)))
+        np.testing.assert_allclose(gradient['z'], x * y * 2 + ((z > y) & (z >= x)))
+        forward = value_and_grad(node, 'forward', **points)
+        np.testing.assert_allclose(forward[0], value)
+        for name in points:
+            np.testing.assert_allclose(forward[1][name], gradient[name])
+
+    def test_digamma(self):
+        import math
+        from autodiff import digamma
+        self.assertAlmostEqual(float(digamma(1)), -0.5772156649015329, places=12)
+        for x in (0.3, 2.5, 7.0, 40.0):
+            h = 1e-6
+            numeric = (math.lgamma(x + h) - math.lgamma(x - h)) / (2 * h)
+            self.assertAlmostEqual(float(digamma(x)), numeric, places=6)
+
+    def test_errors(self):
+        from autodiff import value_and_grad
+        with self.assertRaises(NameError):
+            value_and_grad('x + y', x=1.0)
+        with self.assertRaises(TypeError):
+            value_and_grad('x / 0', x=1.0)
+        with self.assertRaises(ValueError):
+            value_and_grad('x', 'sideways', x=1.0)
+
+
+class TestSweep(unittest.TestCase):
+    def test_matches_point_by_point(self):
+        import itertools
+        import numpy as np
+        from chatv3 import Calculator
+        from sweep import sweep
+        expression = '(x ^ 2 + (x / 2)!) * (y @ 1.5) - z % 3 + x * z + y + 4'
+        values = {'x': [0.0, 1.5, 3.0], 'y': range(4), 'z': np.linspace(1, 2, 5)}
+        grid = sweep(expression, **values)
+        self.assertEqual(grid.shape, (3, 4, 5))
+        calculator = Calculator()
+        for index in itertools.product(*(range(n) for n in grid.shape)):
+            point = {name: float(list(axis)[i]) for (name, axis), i in zip(values.items(), index)}
+            self.assertAlmostEqual(grid[index], calculator.evaluate(expression, **point))
+
+    def test_fixed_values_and_dependencies(self):
+        from chatv3 import Calculator
+        from sweep import sweep, dependencies
+        grid = sweep('x * k + 1', x=[1, 2, 3], k=2)
+        self.assertEqual(grid.tolist(), [3.0, 5.0, 7.0])
+        self.assertEqual(sweep('2 + 3', x=[1, 2]).tolist(), [5.0, 5.0])
+        node = Calculator().parse('x ^ 2 + y')
+        table = dependencies(node)
+        self.assertEqual(table[id(node)], {'x', 'y'})
+        self.assertEqual(table[id(node.left)], {'x'})
+        with self.assertRaises(NameError):
+            sweep('x + y', x=[1, 2])
+        with self.assertRaises(ValueError):
+            sweep('x', x=[[1, 2]])
+
+
+class TestSolve(unittest.TestCase):
+    def test_newton_and_illinois(self):
+        import numpy as np
+        from solve import solve
+        targets = np.array([[2.0, 10.0], [50.0, 120.0]])
+        for method in ('auto', 'newton', 'illinois'):
+            solution = solve('x ^ 3 + x', targets, 0, 5, method=method)
+            self.assertTrue(solution.converged.all())
+            self.assertEqual(solution.root.shape, (2, 2))
+            np.testing.assert_allclose(solution.root ** 3 + solution.root, targets, rtol=1e-10)
+
+    def test_fixed_and_unbracketed(self):
+        import numpy as np
+        from solve import solve
+        solution = solve('(a * x!) - 1', [0.0, 5.0, -1.0, 5.0], 1, 4, a=[1.0, 1.0, 1.0, 0.5])
+        self.assertEqual(solution.converged.tolist(), [True, True, False, True])
+        self.assertEqual(solution.iterations[0], 0)  # f(1) = 0: the bracket end is the root
+        self.assertTrue(np.isnan(solution.root[2]))
+        self.assertAlmostEqual(solution.root[1], 3.0, places=9)
+        with self.assertRaises(ValueError):
+            solve('x + y', 1.0, 0, 1)
+
+    def test_failing_elements(self):
+        import numpy as np
+        from solve import solve
+        # the second element iterates onto x = -2, the third starts there
+        for method in ('newton', 'illinois'):
+            solution = solve('x*x*x + 1/(x+2)', [1.0, 0.4, 1.0, 1.0], [0.0, -4.0, -2.0, 0.0], [1.0, 0.0, 0.0, 1.0],
+                             method=method)
+            self.assertEqual(solution.converged.tolist(), [True, False, False, True])
+            self.assertTrue(np.isnan(solution.residual[1:3]).all())
+            self.assertTrue(np.isnan(solution.root[1:3]).all())
+            np.testing.assert_allclose(solution.root[[0, 3]] ** 3 + 1 / (solution.root[[0, 3]] + 2), 1.0, rtol=1e-10)
+
+
+class TestAggregate(unittest.TestCase):
+    def test_streaming_matches_materialized(self):
+        import math
+        import numpy as np
+        from aggregate import aggregate
+        from vectorized import evaluate_columns
+        rng = np.random.default_rng(1)
+        columns = {'x': rng.uniform(0, 5, 10000), 'y': rng.uniform(1, 2, 10000)}
+        values = evaluate_columns('x ^ 2 - y * 3', columns)
+        state = aggregate('x ^ 2 - y * 3', columns, edges=[0, 5, 10, 15], chunk_rows=999)
+        self.assertEqual(state.count, 10000)
+        self.assertAlmostEqual(state.sum, math.fsum(values), places=8)
+        self.assertEqual((state.minimum, state.maximum), (values.min(), values.max()))
+        counts = np.histogram(values, [0, 5, 10, 15])[0]
+        self.assertEqual(state.histogram.tolist(), counts.tolist())
+        self.assertEqual(state.outside, 10000 - counts.sum())
+
+    def test_merge_and_compensation(self):
+        import math
+        import numpy as np
+        from aggregate import Aggregate
+        values = np.array([1e16, 1.0, -1e16, 1.0] * 50)
+        parts = [Aggregate().update(values[i:i + 3]) for i in range(0, len(values), 3)]
+        merged = Aggregate()
+        for part in reversed(parts):
+            merged = merged.merge(part)
+        self.assertEqual(merged.count, 200)
+        self.assertEqual(merged.sum, 100.0)
+        self.assertEqual(merged.mean, 0.5)
+        self.assertTrue(math.isnan(Aggregate().update(np.array([1.0, math.nan])).maximum))
+        self.assertTrue(math.isnan(Aggregate().mean))
+        with self.assertRaises(ValueError):
+            Aggregate([0, 1]).merge(Aggregate())
+
+    def test_infinite_sums(self):
+        import math
+        import warnings
+        import numpy as np
+        from aggregate import Aggregate
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(Aggregate().update(np.array([1.0, np.inf])).sum, math.inf)
+            merged = Aggregate().update(np.array([1e308])).merge(Aggregate().update(np.array([1e308])))
+            self.assertEqual(merged.sum, math.inf)
+            self.assertTrue(math.isnan(Aggregate().update(np.array([np.inf, -np.inf])).sum))
+
+    def test_npy_row_ranges(self):
+        import os
+        import tempfile
+        import numpy as np
+        from aggregate import aggregate_npy
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'x.npy')
+            np.save(path, np.arange(1000, dtype=float))
+            halves = [aggregate_npy('x * 2', {'x': path}, start=a, stop=b, chunk_rows=128)
+                      for a, b in ((0, 600), (600, 1000))]
+            total = halves[0].merge(halves[1])
+            self.assertEqual((total.count, total.sum, total.minimum, total.maximum), (1000, 999000.0, 0.0, 1998.0))
+
+
+class TestComparisons(unittest.TestCase):
+    def setUp(self):
+        from chatv3 import Calculator
+        self.calc = Calculator()
+
+    def test_operators_and_precedence(self):
+        cases = {'1 + 2 < 4': 1.0, '3 >= 3 && 2 != 2': 0.0, '0 && 1 || 1': 1.0, '2 <= 1 || 4 == 2 * 2': 1.0,
+                 '1 < 2 == 1': 1.0, '5! == 120': 1.0, '3 > 2 + 2': 0.0, '(1 || 0) + 1': 2.0}
+        for expression, expected in cases.items():
+            with self.subTest(expression=expression):
+                self.assertEqual(self.calc.evaluate(expression), expected)
+
+    def test_tokenize_pairs(self):
+        from chatv3 import tokenize
+        self.assertEqual(tokenize('a<=-3'), ['a', '<=', '-3'])
+        self.assertEqual(tokenize('5!==3'), ['5', '!', '==', '3'])
+        self.assertEqual(tokenize('x && y||z'), ['x', '&&', 'y', '||', 'z'])
+        self.assertEqual(tokenize('x&&&y'), ['x', '&&', '&', 'y'])
+
+    def test_short_circuit(self):
+        import numpy as np
+        from bytecode import dumps, loads
+        from compiler import compile_node
+        from vectorized import evaluate_array, evaluate_columns
+        expression = 'x != 0 && 1 / x > 2 || x == 0 && y'
+        self.assertEqual(self.calc.evaluate(expression, x=0, y=1), 1.0)
+        self.assertEqual(self.calc.evaluate(expression, x=0.25, y=0), 1.0)
+        with self.assertRaises(TypeError):
+            self.calc.evaluate('x == 0 && 1 / x > 2', x=0)
+        program = compile_node(self.calc.parse(expression))
+        self.assertEqual(program(x=0, y=0), 0.0)
+        self.assertEqual(loads(dumps(program))(x=0, y=1), 1.0)
+        x, y = np.array([0.0, 0.25, 1.0, 0.0]), np.array([1.0, 0.0, 0.0, 0.0])
+        expected = [1.0, 1.0, 0.0, 0.0]
+        self.assertEqual(evaluate_columns(expression, {'x': x, 'y': y}).tolist(), expected)
+        self.assertEqual(evaluate_array(self.calc.parse(expression), x=x, y=y).tolist(), expected)
+
+
+class TestRowFilter(unittest.TestCase):
+    def test_matches_full_evaluation(self):
+        import numpy as np
+        from rowfilter import filter
+        from vectorized import evaluate_columns
+        rng = np.random.default_rng(2)
+        columns = {'t': np.sort(rng.uniform(0, 100, 5000)), 'v': rng.uniform(-1, 1, 5000)}
+        columns['v'][::97] = np.nan
+        for predicate in ('t >= 40 && t < 45', 't < 10 || v > 0.5 && t $ 60 > 70', 'v != v || t > 99',
+                          '(t / 10)! < 2 && v', 't - 50 > 0 == v < 0', 't % 7'):
+            with self.subTest(predicate=predicate):
+                expected = np.flatnonzero(evaluate_columns(predicate, columns))
+                self.assertEqual(filter(predicate, columns, chunk_rows=128).tolist(), expected.tolist())
+
+    def test_pruning(self):
+        import numpy as np
+        from rowfilter import ZoneMap, filter, prune
+        t = np.arange(1000, dtype=float)
+        zone_map = ZoneMap({'t': t}, chunk_rows=100)
+        never, always = prune('t >= 250 && t < 400', zone_map)
+        self.assertEqual(np.flatnonzero(~never).tolist(), [2, 3])
+        self.assertEqual(np.flatnonzero(always).tolist(), [3])
+        # a chunk where the predicate could raise is never decided by its zone map
+        never, always = prune('1 / (t - 550) > 5', zone_map)
+        self.assertFalse(never[5])
+        with self.assertRaises(TypeError):
+            filter('1 / (t - 550) > 5', {'t': t}, zone_map)
+        self.assertEqual(len(filter('t < 550 && 1 / (t - 550) > 5', {'t': t}, zone_map)), 0)
+
+
+class TestSampler(unittest.TestCase):
+    def test_space_saving_bounds(self):
+        import random
+        from collections import Counter
+        from sampler import SpaceSaving
+        rng = random.Random(3)
+        stream = [f'e{min(int(rng.paretovariate(1.2)), 500)}' for _ in range(20000)]
+        sketch = SpaceSaving(20)
+        for key in stream:
+            sketch.add(key)
+        exact = Counter(stream)
+        self.assertEqual(len(sketch.counts), 20)
+        for key, count, error in sketch.top(20):
+            self.assertGreaterEqual(count, exact[key])
+            self.assertLessEqual(count - error, exact[key])
+        # every key above stream length / capacity is kept
+        for key, count in exact.items():
+            if count > len(stream) / 20:
+                self.assertIn(key, sketch.counts)
+
+    def test_calculator_sampler(self):
+        from chatv3 import Calculator
+        from sampler import Sampler
+        sampler = Sampler(capacity=3, rate=1.0)
+        calculator = Calculator(sampler=sampler)
+        for expression in ['1 + 2'] * 5 + ['x * 2'] * 3 + ['3!']:
+            calculator.evaluate(expression, x=1)
+        with self.assertRaises(TypeError):
+            calculator.evaluate('1 / 0')
+        snapshot = sampler.snapshot(2)
+        self.assertEqual(snapshot['calls'], 10)
+        self.assertEqual([entry['expression'] for entry in snapshot['frequent']], ['1 + 2', 'x * 2'])
+        self.assertEqual(snapshot['frequent'][0]['calls'], 5)
+        self.assertEqual(len(snapshot['expensive']), 2)
+        self.assertGreater(snapshot['seconds'], 0)
+        with self.assertRaises(ValueError):
+            Sampler(rate=0)
+
+
+class TestWorkload(unittest.TestCase):
+    def test_capture_and_replay(self):
+        import json
+        import os
+        import tempfile
+        from workload import Capture, CapturingCalculator, load, replay
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'workload.jsonl')
+            with Capture(path) as capture:
+                calculator = CapturingCalculator(capture)
+                self.assertEqual(calculator.evaluate('x * 2 + 1', x=3), 7.0)
+                self.assertEqual(calculator.evaluate('x < 2 && 5!', x=1), 1.0)
+                with self.assertRaises(TypeError):
+                    calculator.evaluate('1 / x', x=0)
+            records = load(path)
+            self.assertEqual([entry.get('error') for entry in records], [None, None, 'TypeError'])
+            self.assertEqual(records[0]['variables'], {'x': 3})
+            for engine in ('tree', 'compiled', 'bytecode'):
+                report = replay(records, engine)
+                self.assertEqual((len(report.latencies), report.mismatches), (3, []))
+                self.assertGreater(report.throughput, 0)
+            # a different recorded result, and a recorded error that no longer happens
+            records[0]['result'] = 8.0
+            records[2]['variables'] = {'x': 1}
+            with open(path, 'w') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in records)
+            report = replay(load(path), 'compiled', pacing='recorded', speed=1000)
+            self.assertEqual([mismatch.index for mismatch in report.mismatches], [0, 2])
+
+    def test_capture_with_tiers_and_numpy_values(self):
+        import os
+        import tempfile
+        import numpy as np
+        from tiered import Tiers
+        from workload import Capture, CapturingCalculator, load
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'workload.jsonl')
+            tiers = Tiers(1, None)
+            with Capture(path) as capture:
+                calculator = CapturingCalculator(capture, tiers=tiers)
+                self.assertEqual(calculator.evaluate('x * 2 + y', x=np.int64(3), y=np.float32(0.5)), 6.5)
+                with self.assertRaises(TypeError):
+                    calculator.evaluate('1 / x', x=np.int64(0))
+            self.assertEqual(tiers.tier('x * 2 + y'), 'program')
+            records = load(path)
+            self.assertEqual(records[0]['variables'], {'x': 3.0, 'y': 0.5})
+            self.assertEqual((records[0]['result'], records[1]['error']), (6.5, 'TypeError'))
+
+
+class TestCanonical(unittest.TestCase):
+    def test_equal_keys(self):
+        from optimizer import canonical_key
+        for a, b in (('b+a', '(a + b)'), ('x * (2.0 $ y)', '(y $ 2) * x'), ('x > 2', '2.0 < x'),
+                     ('~5 * x', 'x * -5'), ('(a == b) + 1', '1 + (b == a)'), ('y >= x', 'x <= y')):
+            with self.subTest(a=a, b=b):
+                self.assertEqual(canonical_key(a), canonical_key(b))
+
+    def test_inexact_rewrites_are_not_made(self):
+        import math
+        from optimizer import canonical_key, canonicalize
+        for a, b in (('(a + b) + c', 'a + (b + c)'), ('x @ y', 'y @ x'), ('x && y', 'y && x'), ('a - b', 'b - a')):
+            with self.subTest(a=a, b=b):
+                self.assertNotEqual(canonical_key(a), canonical_key(b))
+        nan = math.nan
+        self.assertEqual(canonicalize('y @ x').evaluate({'x': nan, 'y': 1.0}), 1.0)
+        self.assertEqual(canonicalize('b * 3 + a').evaluate({'a': 1.5, 'b': 2.0}), 7.5)
+
+    def test_cache(self):
+        from compiler import compile_node
+        from optimizer import CanonicalCache
+        cache = CanonicalCache(compile_node, maxsize=2)
+        self.assertEqual(cache.get('x * 2 + y')(x=1, y=5), 7.0)
+        self.assertEqual(cache.get('(y + (2 * x))')(x=1, y=5), 7.0)
+        cache.get('x - 1')
+        cache.get('x - 2')
+        cache.get('y+2*x')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_variables_named_like_literals(self):
+        import math
+        from compiler import compile_node
+        from optimizer import CanonicalCache, canonical_key
+        self.assertNotEqual(canonical_key('1' * 400), canonical_key('inf'))
+        cache = CanonicalCache(compile_node)
+        self.assertEqual(cache.get('1' * 400)(), math.inf)
+        self.assertEqual(cache.get('inf')(inf=5.0), 5.0)
+
+
+class TestDistributed(unittest.TestCase):
+    def setUp(self):
+        import threading
+        from distributed import WorkerServer
+        self.servers = [WorkerServer() for _ in range(2)]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_results_in_order_despite_failures(self):
+        import socket
+        import threading
+        import numpy as np
+        from distributed import Coordinator
+        from vectorized import evaluate_columns
+        # one worker that drops the connection on its first task, one address nobody listens on
+        crashing = socket.create_server(('127.0.0.1', 0))
+        threading.Thread(target=lambda: crashing.accept()[0].close(), daemon=True).start()
+        unused = socket.create_server(('127.0.0.1', 0))
+        unreachable = unused.getsockname()
+        unused.close()
+        addresses = [server.server_address for server in self.servers] + [crashing.getsockname(), unreachable]
+        rng = np.random.default_rng(4)
+        columns = {'x': rng.uniform(1, 10, 50000), 'y': rng.uniform(0, 3, 50000)}
+        coordinator = Coordinator(addresses, shard_rows=3000, timeout=10)
+        result = coordinator.evaluate('x * 2 + y! - x $ y', columns)
+        self.assertTrue(np.array_equal(result, evaluate_columns('x * 2 + y! - x $ y', columns)))
+        # a shard finished twice (by a straggler's backup) counts once
+        self.assertEqual(sum(coordinator.shards_by_worker.values()), 17)
+        crashing.close()
+
+    def test_npy_ranges_and_errors(self):
+        import os
+        import tempfile
+        import numpy as np
+        from distributed import Coordinator, ShardFailed
+        coordinator = Coordinator([server.server_address for server in self.servers], shard_rows=100)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 't.npy')
+            np.save(path, np.arange(1000, dtype=float))
+            self.assertEqual(coordinator.evaluate_npy('t * 2', {'t': path}).tolist(), list(range(0, 2000, 2)))
+        with self.assertRaises(TypeError):
+            coordinator.evaluate('1 / (x - 5)', {'x': np.arange(1000, dtype=float)})
+        with self.assertRaises(ShardFailed):
+            Coordinator([]).evaluate('x', {'x': np.ones(10)})
+
+
+class TestBulk(unittest.TestCase):
+    def test_status_and_position(self):
+        import bulk
+        cases = {
+            '1 +': (bulk.SYNTAX_ERROR, 3, 'Unexpected end of input'),
+            ' (1 + 2': (bulk.SYNTAX_ERROR, 7, 'Missing closing parenthesis'),
+            '3 * # 4': (bulk.SYNTAX_ERROR, 4, 'Invalid token: #'),
+            '  5 / (x - x)': (bulk.DIVISION_BY_ZERO, 4, 'Division is only defined for non-zero numbers.'),
+            'x + q': (bulk.UNBOUND_VARIABLE, 4, 'Unbound variable: q'),
+            '( -3 ) !': (bulk.DOMAIN_ERROR, 7, 'Factorial is only defined for non-negative numbers.'),
+            '10 ^ 400': (bulk.OVERFLOW, 3, None),
+            '200!': (bulk.OVERFLOW, 3, None),
+            '4 % (x - 1)': (bulk.DIVISION_BY_ZERO, 2, None),
+            '(~8) ^ 0.5 < 1': (bulk.TYPE_ERROR, 11, None),
+            '(~8) ^ 0.5': (bulk.NOT_REAL, -1, None),
+            'x == 0 || 1 / 0': (bulk.DIVISION_BY_ZERO, 12, None),
+            'x == 1 || 1 / 0': (bulk.OK, -1, None),
+            'x + 1 # 2': (bulk.SYNTAX_ERROR, 6, 'Unexpected token: #'),
+            '(x + 1) 2': (bulk.SYNTAX_ERROR, 8, 'Unexpected token: 2'),
+            '+'.join(['1'] * 3000): (bulk.TOO_DEEP, 1, 'Expression is nested too deeply'),
+            '(' * 3000 + '1' + ')' * 3000: (bulk.TOO_DEEP, 2999, None),
+            '~' * 3000 + '1': (bulk.TOO_DEEP, 2999, None),
+        }
+        result = bulk.evaluate_lines(list(cases), {'x': 1})
+        for index, (line, (status, position, message)) in enumerate(cases.items()):
+            with self.subTest(line=line):
+                self.assertEqual(result.outcome(index)[:2], (status, position))
+                if message is not None:
+                    self.assertEqual(result.outcome(index)[2], message)
+        ok = [index for index, (status, _, _) in enumerate(cases.values()) if status == bulk.OK]
+        self.assertEqual(result.values[ok].tolist(), [1.0])
+        self.assertEqual([line for line, *_ in result.errors()], [i for i in range(len(cases)) if i not in ok])
+        self.assertEqual(bulk.check('10 ^ 400')[2], 'Numerical result out of range')
+        # 0.0 ^ -inf is inf in Calculator too
+        self.assertEqual(bulk.check('0 ^ y', {'y': -float('inf')}), (bulk.OK, -1, None, float('inf')))
+
+    def test_matches_calculator(self):
+        import math
+        import bulk
+        from chatv3 import Calculator, parse_tokens, tokenize
+        from differential import Generator, same_outcome
+        calc = Calculator()
+        lines = Generator(seed=5).expressions(300) + ['(x * 3', 'y / (x - 2)', '(x - 5)!', 'x ^ 2000', 'z + 1']
+        raised = {bulk.SYNTAX_ERROR: Exception, bulk.UNBOUND_VARIABLE: NameError,
+                  bulk.DIVISION_BY_ZERO: ArithmeticError, bulk.DOMAIN_ERROR: ValueError, bulk.OVERFLOW: OverflowError,
+                  bulk.TYPE_ERROR: TypeError}
+        for line in lines:
+            status, _, _, value = bulk.check(line, {'x': 2.0, 'y': 3.0})
+            with self.subTest(line=line):
+                try:
+                    expected = calc.evaluate(line, x=2.0, y=3.0)
+                except Exception as e:
+                    self.assertNotEqual(status, bulk.OK)
+                    # Divide raises TypeError for a zero divisor
+                    self.assertIsInstance(e, (raised[status], TypeError) if status == bulk.DIVISION_BY_ZERO
+                                          else raised[status])
+                    continue
+                tokens = tokenize(line)
+                if parse_tokens(tokens)[1] < len(tokens):
+                    # Calculator ignores what is left after the expression ('0!-2' is 0!), bulk does not
+                    self.assertEqual(status, bulk.SYNTAX_ERROR)
+                    continue
+                self.assertEqual(status, bulk.OK)
+                self.assertTrue(same_outcome(value, expected) or (math.isnan(value) and math.isnan(expected)))
+
+
+class TestWindows(unittest.TestCase):
+    def test_parse(self):
+        from chatv3 import Calculator, WindowNode, parse, parse_tokens_checked, tokenize
+        node = parse('rmax(x * 2, 3)')
+        self.assertIsInstance(node, WindowNode)
+        self.assertEqual((node.name, node.op.symbol, node.size), ('rmax', '@', 3))
+        # a single evaluation is a series of one sample
+        self.assertEqual(Calculator().evaluate('mavg(x, 5) + rsum(x, 2)', x=2), 4)
+        self.assertEqual(Calculator().evaluate('mavg + 1', mavg=2), 3)
+        for text, error in (('mavg(x 3)', 'Missing comma'), ('rsum(x, 0)', 'Invalid window size: 0'),
+                            ('rsum(x, 2.5)', 'Invalid window size: 2.5'), ('rmin(x, 3', 'Missing closing parenthesis'),
+                            ('rmin(x,', 'Unexpected end of input')):
+            with self.subTest(text=text):
+                self.assertEqual(parse_tokens_checked(tokenize(text))[2], error)
+
+    def test_vectorized_matches_recomputing(self):
+        import numpy as np
+        from vectorized import evaluate_columns
+        y = np.random.default_rng(0).normal(size=60)
+        reducers = {'rmax': np.max, 'rmin': np.min, 'rsum': np.sum, 'mavg': np.mean}
+        for name, reducer in reducers.items():
+            for size in (1, 3, 7, 100):
+                with self.subTest(name=name, size=size):
+                    expected = [reducer(y[max(row - size + 1, 0):row + 1]) for row in range(len(y))]
+                    np.testing.assert_allclose(evaluate_columns(f'{name}(y, {size})', {'y': y}), expected, rtol=1e-12)
+        # no subtraction: an inf or nan leaves the windows once it is out of them
+        x = np.array([1.0, np.inf, 2.0, 3.0, np.nan, 4.0, 5.0, 6.0])
+        self.assertEqual(evaluate_columns('rsum(x, 2)', {'x': x})[[0, 1, 2, 3, 6, 7]].tolist(),
+                         [1.0, np.inf, np.inf, 5.0, 9.0, 11.0])
+        self.assertEqual(evaluate_columns('rmax(x, 3)', {'x': x})[-1], 6.0)
+        self.assertEqual(evaluate_columns('rsum(2, 3)', {'x': x}).tolist(), [2, 4, 6, 6, 6, 6, 6, 6])
+
+    def test_stream_matches_vectorized(self):
+        import numpy as np
+        from stream import Stream
+        from vectorized import evaluate_columns
+        rng = np.random.default_rng(1)
+        columns = {'x': rng.normal(size=200), 'y': rng.normal(size=200)}
+        columns['x'][[7, 50]] = np.nan, np.inf
+        columns['y'][[3, 4]] = 0.0, -0.0
+        for text in ('mavg(x, 3)', 'rmax(y, 4) - rmin(y, 4)', 'rsum(x, 7) * rmax(x * y, 16)', 'mavg(rsum(y, 2), 200)',
+                     'rmin(y, 1000)', 'y > 0 && rsum(1, 3) + mavg(x, 5)'):
+            with self.subTest(text=text):
+                vectorized = evaluate_columns(text, columns)
+                self.assertTrue(np.array_equal(Stream(text).extend(columns), vectorized, equal_nan=True))
+                stream = Stream(text)
+                pushed = [stream.push(x=x, y=y) for x, y in zip(columns['x'], columns['y'])]
+                self.assertTrue(np.array_equal(pushed, vectorized, equal_nan=True))
+        stream = Stream('rsum(x, 2)')
+        self.assertEqual([stream.push(x=value) for value in (1, 2, 3)], [1, 3, 5])
+        stream.reset()
+        self.assertEqual(stream.push(x=4), 4)
+
+    def test_passes(self):
+        from chatv3 import WindowNode, parse
+        from compiler import compile_node
+        from incremental import Session
+        from optimizer import canonical_key, fold_constants
+        self.assertEqual(canonical_key('mavg(b + a, 3)'), canonical_key('mavg((a+b), 3)'))
+        self.assertNotEqual(canonical_key('mavg(a + b, 3)'), canonical_key('mavg(a + b, 4)'))
+        self.assertNotEqual(canonical_key('mavg(a, 3)'), canonical_key('rsum(a, 3)'))
+        self.assertIsInstance(fold_constants(parse('rsum(1 + 2, 3)')), WindowNode)
+        with self.assertRaises(TypeError):
+            compile_node(parse('rsum(x, 3)'))
+        session = Session('mavg + 1', mavg=2)
+        session.insert(4, '(x, 2)')
+        self.assertIsInstance(session.tree.left, WindowNode)
+
+
+class TestTiers(unittest.TestCase):
+    def test_promotion(self):
+        from chatv3 import Calculator
+        from tiered import Tiers
+        tiers = Tiers(compile_at=2, generate_at=4)
+        calculator = Calculator(tiers=tiers)
+        expression = '(x * 3 + 1) @ y ^ 2 - 3! / (x + 2) $ y'
+        seen = []
+        for x in range(6):
+            self.assertEqual(calculator.evaluate(expression, x=x, y=2.5), Calculator().evaluate(expression, x=x, y=2.5))
+            seen.append(tiers.tier(expression))
+        self.assertEqual(seen, ['tree', 'program', 'program', 'generated', 'generated', 'generated'])
+        self.assertEqual((tiers.calls(expression), tiers.promotions), (6, {'program': 1, 'generated': 1}))
+        # a tier that is off is skipped
+        tiers = Tiers(None, 1)
+        Calculator(tiers=tiers).evaluate('1 + 2')
+        self.assertEqual(tiers.tier('1 + 2'), 'generated')
+        # a window function has no compiled form and stays on the tree
+        tiers = Tiers(1, 2)
+        calculator = Calculator(tiers=tiers)
+        self.assertEqual([calculator.evaluate('rsum(x, 3) + 1', x=x) for x in range(3)], [1, 2, 3])
+        self.assertEqual(tiers.tier('rsum(x, 3) + 1'), 'tree')
+
+    def test_errors_and_bounds(self):
+        from chatv3 import Calculator
+        from tiered import Tiers
+        tiers = Tiers(1, 1, capacity=3)
+        calculator = Calculator(tiers=tiers)
+        # compiled forms bind every variable up front, the tree only the ones it reaches
+        self.assertEqual(calculator.evaluate('x == 1 || y', x=1), 1.0)
+        with self.assertRaises(NameError):
+            calculator.evaluate('x == 0 || y', x=1)
+        with self.assertRaises(TypeError):
+            calculator.evaluate('1 / x', x=0)
+        with self.assertRaises(Exception):
+            calculator.evaluate('(1 +')
+        self.assertIsNone(tiers.tier('(1 +'))
+        for k in range(10):
+            calculator.evaluate(f'x + {k}', x=1)
+        self.assertEqual((len(tiers), tiers.evictions), (3, 10))
+        self.assertIsNone(tiers.tier('x + 0'))
+        self.assertEqual(tiers.tier('x + 9'), 'generated')
+
+    def test_tiers_agree_on_special_values(self):
+        import itertools
+        import math
+        from chatv3 import Calculator
+        from tiered import Tiers
+
+        def outcome(evaluate):
+            try:
+                return repr(evaluate())  # tells -0.0 from 0.0
+            except Exception as e:
+                return type(e).__name__
+
+        values = [0.0, -0.0, 1.0, -2.5, 400.0, math.inf, -math.inf, math.nan]
+        expressions = ['x!', 'x ^ y', 'x / y', 'x % y', '(x @ y) - (x $ y) & y', '~x * y + x', 'x < y || x == y']
+        tree = Calculator()
+        for tier, tiers in (('program', Tiers(1, None)), ('generated', Tiers(None, 1))):
+            calculator = Calculator(tiers=tiers)
+            for expression, (x, y) in itertools.product(expressions, itertools.product(values, repeat=2)):
+                with self.subTest(tier=tier, expression=expression, x=x, y=y):
+                    self.assertEqual(outcome(lambda: calculator.evaluate(expression, x=x, y=y)),
+                                     outcome(lambda: tree.evaluate(expression, x=x, y=y)))
+            self.assertEqual({tiers.tier(expression) for expression in expressions}, {tier})
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,61 @@
+import argparse
+import sys
+import sysconfig
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from chatv3 import parse
+
+
+# -------------------------------
+# Benchmark: parse + evaluate throughput by thread count
+# -------------------------------
+# Every thread calls the stateless chatv3.parse on its own expressions; the only shared
+# objects are the read-only operator registry and the expression list. On a free-threaded
+# build (python3.13t and later) the threads run in parallel, on a standard build the GIL
+# serializes them and the speedup stays around 1x.
+
+def _expressions(count: int) -> List[str]:
+    return [f'({i} * x + {i % 7}! - y ^ 2) @ (x $ {i}.5) % 97 - ~y / {i + 1}' for i in range(count)]
+
+
+def _work(expressions: List[str], rounds: int) -> float:
+    total = 0.0
+    for _ in range(rounds):
+        for expression in expressions:
+            total += parse(expression).evaluate({'x': 1.5, 'y': 2.5})
+    return total
+
+
+def gil_enabled() -> bool:
+    check = getattr(sys, '_is_gil_enabled', None)
+    return check() if check is not None else True
+
+
+def run(threads: int, expressions: List[str], rounds: int) -> float:
+    """Seconds for `threads` threads to each parse and evaluate every expression `rounds` times."""
+    with ThreadPoolExecutor(threads) as executor:
+        start = time.perf_counter()
+        futures = [executor.submit(_work, expressions, rounds) for _ in range(threads)]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    assert len(set(results)) == 1
+    return elapsed
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Multi-threaded parse/evaluate scaling')
+    arg_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    arg_parser.add_argument('--rounds', type=int, default=5)
+    args = arg_parser.parse_args()
+    expressions = _expressions(200)
+    free_threaded = bool(sysconfig.get_config_var('Py_GIL_DISABLED'))
+    print(f'Python {sys.version.split()[0]}, free-threaded build: {free_threaded}, GIL enabled: {gil_enabled()}')
+    base = None
+    for threads in args.threads:
+        elapsed = run(threads, expressions, args.rounds)
+        # every thread does the same amount of work, so throughput is threads * work / elapsed
+        throughput = threads * len(expressions) * args.rounds / elapsed
+        base = base or throughput
+        print(f'{threads:>3} threads: {throughput:10.0f} expressions/s, speedup {throughput / base:5.2f}x')
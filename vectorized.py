@@ -0,0 +1,309 @@
+import math
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from chatv3 import Calculator, Node, NumberNode, VariableNode, UnaryOpNode, BinaryOpNode, LogicalOpNode, NaryOpNode, \
+    WindowNode, Factorial, Negative, Max, Min, Average, Modulo, Power, Multiply, Divide, Add, Subtract, Less, Greater, LessEqual, \
+    GreaterEqual, Equal, NotEqual, And, Or
+from compiler import Program, LOAD_CONST, LOAD_VAR, UNARY, BINARY, REDUCE, SHORT, compile_node, skip
+from optimizer import free_variables, has_window
+
+
+# -------------------------------
+# Operator kernels over numpy arrays
+# -------------------------------
+# Every kernel accepts an optional preallocated `out` and raises the same exception
+# types as the scalar Operator.evaluate when any element is out of the domain.
+
+_gamma = np.vectorize(math.gamma, otypes=[float])
+
+
+def _factorial(x, out=None):
+    if np.any(np.less(x, 0)):
+        raise ValueError("Factorial is only defined for non-negative numbers.")
+    result = _gamma(np.add(x, 1))
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
+
+
+def _average(x, y, out=None):
+    # with out=None and 0-d inputs np.add returns a scalar, which cannot be an `out`
+    return np.divide(np.add(x, y, out=out), 2, out=out)
+
+
+def _modulo(x, y, out=None):
+    if np.any(np.equal(y, 0)):
+        raise ZeroDivisionError("float modulo")
+    return np.remainder(x, y, out=out)
+
+
+def _power(x, y, out=None):
+    # 0 ^ -inf is inf, like 0.0 ** -math.inf
+    if np.any(np.equal(x, 0) & np.less(y, 0) & np.not_equal(y, -np.inf)):
+        raise ZeroDivisionError("0.0 cannot be raised to a negative power")
+    with np.errstate(over='raise', divide='ignore'):
+        try:
+            return np.power(x, y, out=out)
+        except FloatingPointError:
+            raise OverflowError("Numerical result out of range")
+
+
+def _divide(x, y, out=None):
+    if np.any(np.equal(y, 0)):
+        raise TypeError("Division is only defined for non-zero numbers.")
+    return np.divide(x, y, out=out)
+
+
+def _boolean(ufunc: np.ufunc) -> Callable:
+    # 1.0 / 0.0 like the scalar operators, not NumPy bools (np.negative rejects those)
+    def apply(x, y, out=None):
+        return ufunc(x, y).astype(float) if out is None else ufunc(x, y, out=out)
+    return apply
+
+
+KERNELS: Dict[type, Callable] = {
+    Factorial: _factorial,
+    Negative: np.negative,
+    Max: np.maximum,
+    Min: np.minimum,
+    Average: _average,
+    Modulo: _modulo,
+    Power: _power,
+    Multiply: np.multiply,
+    Divide: _divide,
+    Add: np.add,
+    Subtract: np.subtract,
+    Less: _boolean(np.less),
+    Greater: _boolean(np.greater),
+    LessEqual: _boolean(np.less_equal),
+    GreaterEqual: _boolean(np.greater_equal),
+    Equal: _boolean(np.equal),
+    NotEqual: _boolean(np.not_equal),
+    # eager forms, for when both operands are there anyway; see short_circuit()
+    And: _boolean(np.logical_and),
+    Or: _boolean(np.logical_or),
+}
+
+
+def kernel(op) -> Callable:
+    try:
+        return KERNELS[type(op)]
+    except KeyError:
+        raise TypeError(f"No vectorized kernel for operator {op.symbol!r}")
+
+
+# ufuncs whose .reduce evaluates a whole NaryOpNode chain in one call. Unlike the
+# scalar math.fsum, np.add.reduce over the operand axis adds left to right.
+REDUCERS: Dict[type, np.ufunc] = {
+    Add: np.add,
+    Multiply: np.multiply,
+    Max: np.maximum,
+    Min: np.minimum,
+}
+
+
+def reduce_operands(op, operands: list, out=None):
+    if type(op) not in REDUCERS:
+        raise TypeError(f"No vectorized reduction for operator {op.symbol!r}")
+    # np.stack copies, so `out` may be the buffer of one of the operands
+    operands = np.broadcast_arrays(*operands) if out is None else [np.broadcast_to(o, out.shape) for o in operands]
+    return REDUCERS[type(op)].reduce(np.stack(operands), axis=0, out=out)
+
+
+# -------------------------------
+# Rolling windows
+# -------------------------------
+# The window of `size` rows at row i covers rows i-size+1..i, or 0..i at the start of the
+# series. Cut into blocks of `size` rows, a window is the suffix of one block and the
+# prefix of the next, so one accumulate per direction gives every window in O(n), whatever
+# the size (van Herk / Gil-Werman). Nothing is subtracted, so inf and nan stay in exactly
+# the windows that hold them; stream.Window combines the same values in the same order.
+
+WINDOW_UFUNCS: Dict[type, np.ufunc] = {
+    Add: np.add,
+    Average: np.add,  # the sum, divided by the number of samples in the window
+    Max: np.maximum,
+    Min: np.minimum,
+}
+
+
+def window_counts(rows: int, size: int) -> np.ndarray:
+    """The number of samples in the window at each row."""
+    return np.minimum(np.arange(1, rows + 1), size)
+
+
+def rolling(op, values, size: int) -> np.ndarray:
+    """op over the last `size` values at every row of a one-dimensional series."""
+    if type(op) not in WINDOW_UFUNCS:
+        raise TypeError(f"No rolling window for operator {op.symbol!r}")
+    ufunc = WINDOW_UFUNCS[type(op)]
+    values = np.asarray(values, dtype=float)
+    if values.ndim != 1:
+        raise ValueError("Windows run over one-dimensional series")
+    rows = len(values)
+    if rows == 0:
+        return np.empty(0)
+    # a window longer than the series never slides: one block, all prefix
+    block = min(size, rows)
+    blocks = np.zeros((-(-rows // block), block))
+    blocks.ravel()[:rows] = values
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()[:rows]
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    result = prefix.copy()
+    result[block:] = ufunc(suffix[1:rows - block + 1], prefix[block:])
+    # a window that is exactly one block is its prefix alone
+    result[block - 1::block] = prefix[block - 1::block]
+    if isinstance(op, Average):
+        result /= window_counts(rows, size)
+    return result
+
+
+# -------------------------------
+# Short circuit over arrays
+# -------------------------------
+# A row-wise && / || evaluates its right operand only on the rows where the left one does
+# not decide the result, so `x != 0 && 1 / x > 2` does not raise on the rows with x == 0.
+
+def pending_rows(op, left: np.ndarray) -> np.ndarray:
+    """The rows whose result the left operand of op does not decide."""
+    return np.not_equal(left, 0) if op.decided_by(1.0) is None else np.equal(left, 0)
+
+
+def _combine(op, left: np.ndarray, pending: np.ndarray, right_of: Callable) -> np.ndarray:
+    # on the decided rows op(left, 0) is the decided value whatever the right operand is
+    right = np.zeros(left.shape)
+    if pending.any():
+        right[pending] = right_of(pending)
+    return kernel(op)(left, right)
+
+
+def short_circuit(program: Program, index: int, left, columns: Dict[str, np.ndarray],
+                  shape: tuple) -> Optional[np.ndarray]:
+    """
+    The value of the && / || whose SHORT instruction is program.code[index], given its
+    left operand: the right operand runs as a sub-program over the pending rows only.
+    None when no row is decided; then running the instructions as they are is cheaper.
+    """
+    op, length = program.code[index][1]
+    left = np.broadcast_to(left, shape)
+    pending = pending_rows(op, left)
+    if pending.all():
+        return None
+    right = Program(program.code[index + 1:index + 1 + length], program.constants, program.variables)
+
+    def right_of(rows: np.ndarray) -> np.ndarray:
+        subset = {}
+        for name in program.variables:
+            if name not in columns:
+                raise NameError(f"Unbound variable: {name}")
+            subset[name] = np.broadcast_to(columns[name], shape)[rows]
+        return run_program(right, subset, np.empty(np.count_nonzero(rows)))
+
+    return _combine(op, left, pending, right_of)
+
+
+# -------------------------------
+# Evaluation
+# -------------------------------
+
+def evaluate_array(node: Node, **arrays) -> np.ndarray:
+    """
+    Tree-walking evaluation where every variable is an array. Inputs broadcast
+    against each other, so a subtree only has the shape of the variables it uses.
+    """
+    if isinstance(node, NumberNode):
+        return np.float64(node.value)
+    if isinstance(node, VariableNode):
+        if node.name not in arrays:
+            raise NameError(f"Unbound variable: {node.name}")
+        return np.asarray(arrays[node.name], dtype=float)
+    if isinstance(node, UnaryOpNode):
+        return kernel(node.op)(evaluate_array(node.child, **arrays))
+    if isinstance(node, LogicalOpNode):
+        left = evaluate_array(node.left, **arrays)
+        # a window in the right operand sees only the pending rows, but all of them, even
+        # over a constant; the right operand then needs the row count of every input
+        names = list(arrays) if has_window(node.right) else \
+            [name for name in free_variables(node.right) if name in arrays]
+        shape = np.broadcast_shapes(np.shape(left), *(np.shape(arrays[name]) for name in names))
+        left = np.broadcast_to(left, shape)
+        pending = pending_rows(node.op, left)
+        if pending.all():
+            return kernel(node.op)(left, evaluate_array(node.right, **arrays))
+        return _combine(node.op, left, pending, lambda rows: evaluate_array(
+            node.right, **{name: np.broadcast_to(arrays[name], shape)[rows] for name in names}))
+    if isinstance(node, BinaryOpNode):
+        return kernel(node.op)(evaluate_array(node.left, **arrays), evaluate_array(node.right, **arrays))
+    if isinstance(node, NaryOpNode):
+        return reduce_operands(node.op, [evaluate_array(child, **arrays) for child in node.children])
+    if isinstance(node, WindowNode):
+        values = evaluate_array(node.child, **arrays)
+        if np.ndim(values) == 0:
+            # one sample per row of the inputs, even where the child does not use them
+            values = np.broadcast_to(values, np.broadcast_shapes(*(np.shape(a) for a in arrays.values())))
+        # without any array input the series is a single sample, as in Node.evaluate
+        return rolling(node.op, values, node.size) if np.ndim(values) else values
+    raise TypeError(f"Cannot evaluate node of type {type(node).__name__}")
+
+
+def scratch_buffers(program: Program, rows: int) -> List[np.ndarray]:
+    """One buffer per stack slot, enough to run `program` over `rows` rows without allocating."""
+    return [np.empty(rows) for _ in range(program.stack_depth)]
+
+
+def run_program(program: Program, columns: Dict[str, np.ndarray], out: np.ndarray,
+                buffers: Optional[List[np.ndarray]] = None) -> np.ndarray:
+    """
+    Run a compiled Program over equally long column slices and write into `out`.
+    The result of an instruction that leaves the stack at depth d goes to buffers[d-1],
+    so intermediate results reuse the same few arrays for every chunk.
+    """
+    rows = len(out)
+    if buffers is None:
+        buffers = scratch_buffers(program, rows)
+    inputs = [columns[name] for name in program.variables]
+    constants = program.constants
+    stack = []
+    code = iter(enumerate(program.code))
+    for index, (opcode, arg) in code:
+        if opcode == LOAD_CONST:
+            stack.append(constants[arg])
+        elif opcode == LOAD_VAR:
+            stack.append(inputs[arg])
+        elif opcode == UNARY:
+            target = buffers[len(stack) - 1][:rows]
+            stack[-1] = kernel(arg)(stack[-1], out=target)
+        elif opcode == BINARY:
+            right = stack.pop()
+            target = buffers[len(stack) - 1][:rows]
+            stack[-1] = kernel(arg)(stack[-1], right, out=target)
+        elif opcode == REDUCE:
+            op, count = arg
+            operands = stack[-count:]
+            del stack[-count:]
+            target = buffers[len(stack)][:rows]
+            stack.append(reduce_operands(op, operands, out=target))
+        elif opcode == SHORT:
+            value = short_circuit(program, index, stack[-1], columns, (rows,))
+            if value is not None:
+                stack[-1] = value
+                skip(code, arg[1] + 1)
+    np.copyto(out, stack[0])
+    return out
+
+
+def evaluate_columns(expr, columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    In-memory evaluation of a chatv3 expression (text or AST) over whole columns. The rows
+    are one series in order, so window functions run along them.
+    """
+    node = Calculator().parse(expr) if isinstance(expr, str) else expr
+    rows = len(next(iter(columns.values()))) if columns else 1
+    if has_window(node):
+        # the stack program is row-wise and has no instruction for a window
+        return np.broadcast_to(evaluate_array(node, **columns), (rows,)).copy()
+    program = compile_node(node)
+    return run_program(program, columns, np.empty(rows))
@@ -0,0 +1,264 @@
+import argparse
+import json
+import numbers
+import os
+import random
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bytecode import dumps, loads
+from chatv3 import Calculator, parse_cached
+from compiler import compile_node
+from differential import same_outcome
+from optimizer import CanonicalCache
+import jit
+from sampler import Sampler
+
+
+# -------------------------------
+# Capture
+# -------------------------------
+# One JSON object per evaluated expression, appended to a JSONL log:
+#   {"at": <time.time()>, "expression": ..., "variables": {...}, "seconds": ...,
+#    "result": <float or repr>} or "error": <exception class name> instead of "result"
+
+def _plain(value):
+    return float(value) if isinstance(value, numbers.Real) else repr(value)
+
+
+class Capture:
+    """An append-only workload log; usable from several threads, close() flushes it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def record(self, expression: str, variables: dict, seconds: float, result=None,
+               error: Optional[BaseException] = None):
+        # NumPy scalars (np.int64, np.float32) have no JSON form either, and a log entry
+        # must never make the caller's evaluate() fail
+        entry = {'at': time.time(), 'expression': expression,
+                 'variables': {name: _plain(value) for name, value in variables.items()}, 'seconds': seconds}
+        if error is not None:
+            entry['error'] = type(error).__name__
+        else:
+            # complex results of a negative base to a fractional power have no JSON form
+            entry['result'] = _plain(result)
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> 'Capture':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CapturingCalculator(Calculator):
+    """
+    A Calculator that logs every evaluate() call, its timing and its outcome to a Capture.
+    Other arguments (sampler, tiers) go to Calculator.
+    """
+
+    def __init__(self, capture: Capture, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.capture = capture
+
+    def evaluate(self, expression: str, **variables: float) -> float:
+        start = time.perf_counter()
+        try:
+            result = super().evaluate(expression, **variables)
+        except Exception as e:
+            self.capture.record(expression, variables, time.perf_counter() - start, error=e)
+            raise
+        self.capture.record(expression, variables, time.perf_counter() - start, result)
+        return result
+
+
+def load(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# -------------------------------
+# Engines to replay through
+# -------------------------------
+# Each factory returns a fresh evaluate(expression, variables) with cold caches.
+
+def _compiled_engine() -> Callable[[str, dict], float]:
+    compiled = lru_cache(maxsize=1024)(lambda expression: compile_node(Calculator().parse(expression)))
+    return lambda expression, variables: compiled(expression)(**variables)
+
+
+def _bytecode_engine() -> Callable[[str, dict], float]:
+    decoded = lru_cache(maxsize=1024)(lambda expression: loads(dumps(expression)))
+    return lambda expression, variables: decoded(expression)(**variables)
+
+
+def _canonical_engine() -> Callable[[str, dict], float]:
+    # one compiled Program per canonical form, shared by every spelling of it
+    cache = CanonicalCache(compile_node)
+    return lambda expression, variables: cache.get(expression)(**variables)
+
+
+def _sampled_engine() -> Callable[[str, dict], float]:
+    calculator = Calculator(sampler=Sampler())
+    return lambda expression, variables: calculator.evaluate(expression, **variables)
+
+
+def _parse_cached_engine() -> Callable[[str, dict], float]:
+    parse_cached.cache_clear()
+    return lambda expression, variables: parse_cached(expression).evaluate(variables)
+
+
+def _jit_engine() -> Callable[[str, dict], float]:
+    jit._cached.cache_clear()
+    return lambda expression, variables: jit.jit(expression)(**variables)
+
+
+ENGINES: Dict[str, Callable[[], Callable[[str, dict], float]]] = {
+    'tree': lambda: lambda expression, variables: Calculator().evaluate(expression, **variables),
+    'sampled': _sampled_engine,
+    'parse_cached': _parse_cached_engine,
+    'compiled': _compiled_engine,
+    'canonical': _canonical_engine,
+    'bytecode': _bytecode_engine,
+    'jit': _jit_engine,
+}
+
+
+# -------------------------------
+# Replay
+# -------------------------------
+
+class Mismatch:
+    def __init__(self, index: int, expression: str, recorded, replayed):
+        self.index = index
+        self.expression = expression
+        self.recorded = recorded
+        self.replayed = replayed
+
+    def __repr__(self):
+        return f'Mismatch(#{self.index} {self.expression!r}: recorded {self.recorded!r}, replayed {self.replayed!r})'
+
+
+class ReplayReport:
+    def __init__(self, engine: str, latencies: np.ndarray, seconds: float, mismatches: List[Mismatch]):
+        self.engine = engine
+        self.latencies = latencies
+        self.seconds = seconds
+        self.mismatches = mismatches
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.seconds if self.seconds else 0.0
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.latencies, q)) if len(self.latencies) else 0.0
+
+    def summary(self) -> str:
+        lines = [f'{self.engine:<13} {len(self.latencies):>7} calls {self.throughput:10.0f}/s  '
+                 + '  '.join(f'p{q} {self.percentile(q) * 1e6:8.2f}us' for q in (50, 90, 99))
+                 + f'  max {self.percentile(100) * 1e6:8.1f}us  {len(self.mismatches)} mismatches']
+        lines.extend(f'  {mismatch!r}' for mismatch in self.mismatches[:10])
+        return '\n'.join(lines)
+
+
+def _recorded(entry: dict) -> Tuple[str, object]:
+    return ('error', entry['error']) if 'error' in entry else ('result', entry['result'])
+
+
+def _replayed(evaluate: Callable[[str, dict], float], entry: dict) -> Tuple[str, object]:
+    try:
+        result = evaluate(entry['expression'], entry['variables'])
+    except Exception as e:
+        return 'error', type(e).__name__
+    return 'result', result if isinstance(result, (int, float)) else repr(result)
+
+
+def _matches(recorded: Tuple[str, object], replayed: Tuple[str, object]) -> bool:
+    (kind, expected), (replayed_kind, value) = recorded, replayed
+    if kind != replayed_kind:
+        return False
+    if kind == 'error':
+        return True  # like differential.same_outcome: engines raise different types, only the fact matters
+    if isinstance(expected, str) or isinstance(value, str):
+        return expected == value  # reprs of non-float results
+    return same_outcome(expected, value)
+
+
+def replay(records: List[dict], engine: str = 'tree', pacing: str = 'fast', speed: float = 1.0) -> ReplayReport:
+    """
+    Feed captured calls through an engine and compare every outcome with the recorded
+    one (results to 1e-9 relative, errors by the fact that one was raised).
+    pacing='recorded' keeps the captured gaps between calls, divided by `speed`;
+    'fast' sends them back to back. Latency is the engine call alone.
+    """
+    if pacing not in ('fast', 'recorded'):
+        raise ValueError(f"Unknown pacing: {pacing}")
+    evaluate = ENGINES[engine]()
+    latencies = np.empty(len(records))
+    mismatches = []
+    first = records[0]['at'] if records else 0.0
+    start = time.perf_counter()
+    for index, entry in enumerate(records):
+        if pacing == 'recorded':
+            delay = start + (entry['at'] - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        before = time.perf_counter()
+        outcome = _replayed(evaluate, entry)
+        latencies[index] = time.perf_counter() - before
+        recorded = _recorded(entry)
+        if not _matches(recorded, outcome):
+            mismatches.append(Mismatch(index, entry['expression'], recorded[1], outcome[1]))
+    return ReplayReport(engine, latencies, time.perf_counter() - start, mismatches)
+
+
+# -------------------------------
+# Replay benchmark: every engine against one captured workload
+# -------------------------------
+
+def _synthetic(path: str, calls: int):
+    # a skewed mix of a few hundred expressions, some of them raising
+    rng = random.Random(0)
+    expressions = [f'(x * {k} + {k % 7}) @ y ^ 2 - {k % 5}! / (x - {k % 3})' for k in range(500)]
+    weights = [1 / (k + 1) for k in range(len(expressions))]
+    with Capture(path) as capture:
+        calculator = CapturingCalculator(capture)
+        for expression in rng.choices(expressions, weights=weights, k=calls):
+            try:
+                calculator.evaluate(expression, x=float(rng.randrange(4)), y=rng.uniform(0, 3))
+            except (ArithmeticError, TypeError):  # chatv3 raises TypeError for division by zero
+                pass
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Replay a captured workload through calculator engines')
+    arg_parser.add_argument('log', nargs='?', help='JSONL capture; without one a synthetic workload is captured')
+    arg_parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    arg_parser.add_argument('--pacing', choices=['fast', 'recorded'], default='fast')
+    arg_parser.add_argument('--speed', type=float, default=1.0, help='recorded pacing: replay this many times faster')
+    arg_parser.add_argument('--calls', type=int, default=50_000, help='size of the synthetic workload')
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.log
+        if path is None:
+            path = os.path.join(directory, 'workload.jsonl')
+            _synthetic(path, args.calls)
+        records = load(path)
+        print(f'{len(records)} calls, {len({entry["expression"] for entry in records})} distinct expressions, '
+              f'{args.pacing} pacing')
+        for engine in args.engines:
+            print(replay(records, engine, args.pacing, args.speed).summary())